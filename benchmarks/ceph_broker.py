@@ -0,0 +1,68 @@
+"""Compare Ceph operations per second through the broker and the CLI.
+
+Needs access to a live cluster, e.g. on a KVM host:
+
+    python benchmarks/ceph_broker.py --pool rbd.ssd --image test00.root
+
+If no broker is running at the given socket, one is started in-process
+for the duration of the benchmark.
+
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from fc.qemu.hazmat.cephbroker import BrokerBackend, running_broker
+from fc.qemu.hazmat.libceph import CLIBackend, open_native_backend
+from fc.qemu.util import log
+
+
+def measure(label, backend, pool, image, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        backend.image_info(pool, image)
+        backend.lock_list(pool, image)
+    duration = time.perf_counter() - started
+    ops = 2 * count / duration
+    print(f"{label:>8}: {2 * count} ops in {duration:.2f}s = {ops:.1f} ops/s")
+    return ops
+
+
+def main():
+    a = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    a.add_argument("--pool", required=True)
+    a.add_argument("--image", required=True)
+    a.add_argument("--count", type=int, default=50)
+    a.add_argument("--conf", default="/etc/ceph/ceph.conf")
+    a.add_argument("--name", default="client.admin")
+    a.add_argument("--socket", default="/run/fc-qemu.ceph.sock")
+    args = a.parse_args()
+
+    def direct():
+        return CLIBackend(args.conf, args.name, log)
+
+    cli_ops = measure("cli", direct(), args.pool, args.image, args.count)
+
+    if os.path.exists(args.socket):
+        broker = BrokerBackend(args.socket, log, direct)
+        broker_ops = measure(
+            "broker", broker, args.pool, args.image, args.count
+        )
+    else:
+        backend = open_native_backend(args.conf, args.name, log) or direct()
+        with tempfile.TemporaryDirectory() as tmp:
+            socket = os.path.join(tmp, "ceph.sock")
+            with running_broker(socket, backend, log):
+                broker = BrokerBackend(socket, log, direct)
+                broker_ops = measure(
+                    "broker", broker, args.pool, args.image, args.count
+                )
+        backend.shutdown()
+
+    print(f"speedup: {broker_ops / cli_ops:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Compare handling a large consul payload with and without pre-filtering.
+
+Generates a synthetic `node/` payload where only a few VMs belong to this
+host and runs it through
+
+* the previous approach: load the whole payload, decode every event,
+  build an agent and stage its config,
+* the event handler with a fresh generation index,
+* the event handler again with the index from the previous run, as
+  happens whenever consul delivers the prefix after any change.
+
+Runs against a temporary directory, `ensure` is replaced by `true`:
+
+    python benchmarks/consul_events.py --events 5000 --local 50
+
+"""
+
+import argparse
+import base64
+import json
+import tempfile
+import time
+from io import StringIO
+from pathlib import Path
+
+import structlog
+
+import fc.qemu.agent
+from fc.qemu.agent import Agent, ConsulEventHandler, unwrap_consul_armour
+from fc.qemu.consulevents import GenerationIndex, iter_events
+from fc.qemu.hazmat.qemu import Qemu
+from fc.qemu.sysconfig import sysconfig
+
+
+def payload(count, local, this_host):
+    events = []
+    for i in range(count):
+        name = f"vm{i:05d}"
+        config = {
+            "name": name,
+            "consul-generation": 0,
+            "parameters": {
+                "name": name,
+                "machine": "virtual",
+                "kvm_host": this_host if i < local else f"kvm{i % 97:02d}",
+                "online": True,
+                "resource_group": "test",
+                "rbd_pool": "rbd.ssd",
+                "memory": 1024,
+                "cores": 1,
+                "disk": 20,
+                "interfaces": {},
+            },
+        }
+        value = base64.b64encode(json.dumps(config).encode("ascii"))
+        events.append(
+            {
+                "Key": f"node/{name}",
+                "ModifyIndex": 1000 + i,
+                "Value": value.decode("ascii"),
+            }
+        )
+    return json.dumps(events)
+
+
+def use_prefix(path):
+    (path / "run").mkdir(parents=True)
+    (path / "etc/qemu/vm").mkdir(parents=True)
+    Agent.prefix = path
+    Qemu.prefix = path
+
+
+def legacy(data):
+    for event in json.loads(data):
+        config = unwrap_consul_armour(event["Value"])
+        config["consul-generation"] = event["ModifyIndex"]
+        agent = Agent(config["name"], config)
+        agent.stage_new_config()
+
+
+def prefiltered(data):
+    index = GenerationIndex(Agent.prefix / "run/fc-qemu.consul-generations")
+    handler = ConsulEventHandler(index)
+    for event in iter_events(StringIO(data)):
+        if not index.is_settled(event):
+            handler.handle(event)
+    index.save()
+    index.close()
+
+
+def measure(label, f, data, count):
+    started = time.perf_counter()
+    f(data)
+    duration = time.perf_counter() - started
+    print(
+        f"{label:>12}: {duration:7.2f}s "
+        f"{duration / count * 1e6:8.1f}µs/event"
+    )
+    return duration
+
+
+def main():
+    a = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    a.add_argument("--events", type=int, default=5000)
+    a.add_argument("--local", type=int, default=50)
+    args = a.parse_args()
+
+    sysconfig.load_system_config()
+    structlog.configure(logger_factory=structlog.ReturnLoggerFactory())
+    fc.qemu.agent.EXECUTABLE = "true"
+    data = payload(args.events, args.local, sysconfig.agent["this_host"])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_prefix(Path(tmp) / "legacy")
+        before = measure("legacy", legacy, data, args.events)
+
+        use_prefix(Path(tmp) / "index")
+        measure("first run", prefiltered, data, args.events)
+        after = measure("repeated", prefiltered, data, args.events)
+
+    print(f"speedup (repeated payload): {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Measure the cold-start time and imported modules of fc-qemu subcommands.
+
+Every sample starts a fresh interpreter that parses the command line and
+imports everything the subcommand needs before it starts working. Record
+a baseline and compare later runs against it:
+
+    python benchmarks/startup.py --save /tmp/startup.json
+    python benchmarks/startup.py --compare /tmp/startup.json
+
+The comparison fails (exit code 1) if a subcommand imports more modules
+than in the baseline or its median wall time grew by more than the
+tolerance.
+
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Sample command lines for the subcommands. "client" is the path of a
+# command that is forwarded to the agent daemon.
+COMMANDS = {
+    "client": None,
+    "ls": ["ls"],
+    "check": ["check"],
+    "status": ["status", "test00"],
+    "ensure": ["ensure", "test00"],
+    "start": ["start", "test00"],
+    "snapshot": ["snapshot", "test00", "backup"],
+    "snapshot-gc": ["snapshot-gc"],
+    "inmigrate": ["inmigrate", "test00"],
+    "outmigrate": ["outmigrate", "test00"],
+    "report-supported-cpu-models": ["report-supported-cpu-models"],
+    "handle-consul-event": ["handle-consul-event"],
+    "supervised-qemu": None,
+}
+
+CHILD = """
+import json
+import sys
+
+name, argv = sys.argv[1], json.loads(sys.argv[2])
+if name == "supervised-qemu":
+    import fc.qemu.hazmat.supervise
+elif name == "client":
+    from fc.qemu import daemon, main
+
+    main.build_parser().parse_args(["status", "test00"])
+else:
+    from fc.qemu import main
+
+    args = main.build_parser().parse_args(argv)
+    # This is what main.run() loads before dispatching.
+    from fc.qemu.agent import Agent
+    from fc.qemu.logging import init_logging
+    from fc.qemu.sysconfig import sysconfig
+    from fc.qemu.util import log
+
+    sysconfig.load_system_config()
+    getattr(Agent, args.func)
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def sample(name, argv):
+    started = time.perf_counter()
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD, name, json.dumps(argv)]
+    )
+    return time.perf_counter() - started, json.loads(output)
+
+
+def measure(names, count):
+    results = {}
+    for name in names:
+        durations = []
+        for _ in range(count):
+            duration, modules = sample(name, COMMANDS[name])
+            durations.append(duration)
+        results[name] = {
+            "time": statistics.median(durations),
+            "modules": len(modules),
+            "fc.qemu": sorted(m for m in modules if m.startswith("fc.qemu")),
+        }
+        print(
+            f"{name:>28}: {results[name]['time'] * 1000:7.1f}ms "
+            f"{len(modules):5d} modules"
+        )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        if result["modules"] > before["modules"]:
+            new = sorted(set(result["fc.qemu"]) - set(before["fc.qemu"]))
+            regressions.append(
+                f"{name}: {result['modules']} modules imported, "
+                f"was {before['modules']} (new in fc.qemu: {new})"
+            )
+        if result["time"] > before["time"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: {result['time'] * 1000:.1f}ms, "
+                f"was {before['time'] * 1000:.1f}ms"
+            )
+    return regressions
+
+
+def main():
+    a = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    a.add_argument("--count", type=int, default=5, help="samples per command")
+    a.add_argument("--save", help="write the results to this file")
+    a.add_argument("--compare", help="compare against results in this file")
+    a.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative growth of the wall time (default: 0.2)",
+    )
+    a.add_argument("commands", nargs="*", default=list(COMMANDS))
+    args = a.parse_args()
+
+    results = measure(args.commands, args.count)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
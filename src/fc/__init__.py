@@ -1,3 +1,2 @@
-import pkg_resources
-
-pkg_resources.declare_namespace(__name__)
+# pkg_resources takes longer to import than all of fc-qemu's startup.
+__path__ = __import__("pkgutil").extend_path(__path__, __name__)
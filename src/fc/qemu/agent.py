@@ -1,8 +1,10 @@
 import codecs
+import collections
 import contextlib
 import copy
 import datetime
 import fcntl
+import functools
 import json
 import math
 import os
@@ -10,6 +12,7 @@ import shutil
 import socket
 import subprocess
 import sys
+import threading
 import time
 import typing
 from ipaddress import ip_interface
@@ -17,13 +20,7 @@ from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from typing import Optional
 
-import colorama
-import consulate
-import consulate.models.agent
-import requests
-import yaml
-
-from . import directory, util
+from . import configstore, util
 from .exc import (
     ConfigChanged,
     EnvironmentChanged,
@@ -32,19 +29,25 @@ from .exc import (
     VMConfigNotFound,
     VMStateInconsistent,
 )
-from .hazmat.ceph import Ceph
-from .hazmat.cpuscan import scan_cpus
+from .hazmat.ceph import Ceph, ImageIndex
 from .hazmat.qemu import Qemu, detect_current_machine_type
-from .incoming import IncomingServer
-from .outgoing import Outgoing
 from .sysconfig import sysconfig
 from .timeout import TimeOut
 from .util import GiB, MiB, locate_live_service, log
 
 
-def _handle_consul_event(event):
-    handler = ConsulEventHandler()
-    handler.handle(event)
+def _handle_consul_event(event, index=None, received=None):
+    handler = ConsulEventHandler(index)
+    handler.handle(event, received)
+
+
+def _consul_event_worker(queue, handler):
+    while (item := queue.get()) is not None:
+        key, event, received = item
+        try:
+            handler.handle(event, received)
+        finally:
+            queue.done(key)
 
 
 OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
@@ -134,9 +137,38 @@ class ConsulEventHandler(object):
 
     """
 
-    def handle(self, event):
+    def __init__(self, index=None, limiter=None):
+        # A GenerationIndex to record node events that are settled without
+        # running `ensure`.
+        self.index = index
+        # An AdaptiveRateLimiter to space out `ensure` runs.
+        self.limiter = limiter
+
+    def settle(self, event):
+        if self.index is not None:
+            self.index.settle(event)
+
+    def concerns_this_host(self, config):
+        """Whether a VM is assigned to this host or has been here before."""
+        if config["parameters"].get("kvm_host") == sysconfig.agent.get(
+            "this_host"
+        ):
+            return True
+        name = config["name"]
+        return any(
+            path.exists()
+            for path in [
+                Agent.prefix / "etc/qemu/vm" / f"{name}.cfg",
+                Agent.prefix / "etc/qemu/vm" / f".{name}.cfg.staging",
+                Agent.prefix / "run" / f"qemu.{name}.pid",
+            ]
+        )
+
+    def handle(self, event, received=None):
         """Actual handling of a single Consul event in a
         separate process."""
+        if received is None:
+            received = time.monotonic()
         try:
             log.debug("handle-key", key=event["Key"])
             prefix = event["Key"].split("/")[0]
@@ -144,6 +176,11 @@ class ConsulEventHandler(object):
                 log.debug("ignore-key", key=event["Key"], reason="empty value")
                 return
             getattr(self, prefix)(event)
+            log.debug(
+                "event-settled",
+                key=event["Key"],
+                latency=round(time.monotonic() - received, 3),
+            )
         except BaseException as e:  # noqa
             # This must be a bare-except as it protects threads and the main
             # loop from dying. It could be that I'm wrong, but I'm leaving this
@@ -164,12 +201,23 @@ class ConsulEventHandler(object):
                 machine=vm,
                 reason="is a physical machine",
             )
+            self.settle(event)
+            return
+        if not self.concerns_this_host(config):
+            log.debug(
+                "ignore-consul-event",
+                machine=vm,
+                reason="not assigned to this host",
+            )
+            self.settle(event)
             return
         log_ = log.bind(machine=vm)
         agent = Agent(vm, config)
         log_.info("processing-consul-event", consul_event="node")
         if agent.stage_new_config():
             cmd = [EXECUTABLE, "-D", "ensure", vm]
+            if self.limiter is not None:
+                self.limiter.wait()
             log_.info("launch-ensure", cmd=cmd)
             s = subprocess.Popen(
                 cmd,
@@ -181,6 +229,8 @@ class ConsulEventHandler(object):
             stdout, stderr = s.communicate()
             exit_code = s.wait()
             log_.debug("launch-ensure", exit_code=exit_code)
+            if exit_code and self.limiter is not None:
+                self.limiter.failed()
             if exit_code:
                 # Avoid logging things twice. However, if it failed then
                 # we might be missing output that was generated before setting
@@ -190,6 +240,7 @@ class ConsulEventHandler(object):
             log_.info(
                 "ignore-consul-event", machine=vm, reason="config is unchanged"
             )
+            self.settle(event)
 
     def snapshot(self, event):
         value = unwrap_consul_armour(event["Value"])
@@ -204,7 +255,11 @@ class ConsulEventHandler(object):
         with agent:
             log_.info("snapshot")
             try:
-                agent.snapshot(snapshot, keep=0)
+                agent.snapshot(
+                    snapshot,
+                    keep=0,
+                    freeze_timeout=agent.snapshot_freeze_timeout,
+                )
             except InvalidCommand:
                 # The VM isn't in a state to make a snapshot. This is important
                 # information for regular users but not for consul - ignoring
@@ -315,8 +370,7 @@ def tmp_size(disk):
 
 
 def iproute2_json(log, args):
-    cmd = "ip -j {}".format(" ".join(args))
-    data = util.cmd(cmd, log, encoding="utf-8")
+    data = util.cmd(["ip", "-j"] + list(args), log, encoding="utf-8")
     return json.loads(data) if data else None
 
 
@@ -326,6 +380,37 @@ def sorted_ipset(items):
     return sorted(items, key=lambda x: (x.version, x.ip))
 
 
+class RouteDumps:
+    """Routes of the host's VRFs, shared by agents handling many VMs.
+
+    Each VRF is listed once instead of once per VM interface. Agents that
+    change the routes of a VRF must invalidate it.
+
+    """
+
+    def __init__(self):
+        self._vrfs = {}
+        self._lock = threading.Lock()
+
+    def routes(self, log, vrf, dev):
+        with self._lock:
+            if vrf not in self._vrfs:
+                self._vrfs[vrf] = [
+                    route
+                    for version in ["-4", "-6"]
+                    for route in iproute2_json(
+                        log, [version, "route", "show", "vrf", vrf]
+                    )
+                    or []
+                ]
+            routes = self._vrfs[vrf]
+        return [route for route in routes if route.get("dev") == dev]
+
+    def invalidate(self, vrf):
+        with self._lock:
+            self._vrfs.pop(vrf, None)
+
+
 class Agent(object):
     """The agent to control a single VM."""
 
@@ -371,6 +456,13 @@ class Agent(object):
 
     ceph_attach_on_enter = True
 
+    # How long the guest was frozen for the last snapshot, in seconds.
+    frozen_time = None
+
+    # Shared between the agents of `ensure-all`.
+    image_index = None
+    host_routes = None
+
     def __init__(self, name, enc=None):
         # Update configuration values from system or test config.
         self.log = log.bind(machine=name)
@@ -391,9 +483,14 @@ class Agent(object):
         else:
             self.enc = self._load_enc()
 
-        self.consul = consulate.Consul(token=self.consul_token)
         self.contexts = ()
 
+    @functools.cached_property
+    def consul(self):
+        import consulate
+
+        return consulate.Consul(token=self.consul_token)
+
     @property
     def config_file(self):
         return self.prefix / "etc/qemu/vm" / f"{self.name}.cfg"
@@ -417,7 +514,7 @@ class Agent(object):
     def _load_enc(self):
         try:
             with self.config_file.open() as f:
-                return yaml.safe_load(f)
+                return configstore.load(f)
         except IOError:
             if self.config_file_staging.exists():
                 # The VM has been freshly created. Set up a boilerplate
@@ -440,16 +537,82 @@ class Agent(object):
         # should be fine expecting a TextIO here as json load also expects
         # text input. It might be necessary at some point to explicitly
         # expect BinaryIO input and then enforce UTF-8 at this point.
-        events = json.load(input)
-        if not events:
+        from .consulevents import GenerationIndex, iter_events
+
+        index = GenerationIndex(cls.prefix / "run/fc-qemu.consul-generations")
+        try:
+            cls._handle_consul_events(iter_events(input), index)
+        finally:
+            index.save()
+            index.close()
+
+    @classmethod
+    def _handle_consul_events(cls, events, index):
+        # Unchanged events are discarded while reading the payload so we
+        # neither keep nor decode them.
+        from .consulevents import AdaptiveRateLimiter, EventQueue
+
+        count = 0
+        pending = []
+        for event in events:
+            count += 1
+            if not index.is_settled(event):
+                pending.append((event, time.monotonic()))
+        if not count:
             return
-        log.info("start-consul-events", count=len(events))
-        pool = ThreadPool(sysconfig.agent.get("consul_event_threads", 3))
-        for event in sorted(events, key=lambda e: e.get("Key")):
-            pool.apply_async(_handle_consul_event, (event,))
-            time.sleep(0.05)
-        pool.close()
-        pool.join()
+        log.info("start-consul-events", count=count)
+        if count > len(pending):
+            log.debug("skip-settled-consul-events", count=count - len(pending))
+        snapshots, others = [], []
+        for event, received in sorted(pending, key=lambda e: e[0].get("Key")):
+            if event.get("Key", "").startswith("snapshot/"):
+                snapshots.append((event, received))
+            else:
+                others.append((event, received))
+        # Snapshot events arrive for all VMs at once. They get their own
+        # pool so that VMs are frozen and snapshotted in parallel and don't
+        # hold up other events.
+        snapshot_pool = ThreadPool(
+            max(
+                1,
+                min(
+                    len(snapshots),
+                    sysconfig.agent.get("snapshot_parallelism", 10),
+                ),
+            )
+        )
+        for event, received in snapshots:
+            snapshot_pool.apply_async(
+                _handle_consul_event, (event, index, received)
+            )
+        snapshot_pool.close()
+
+        # Other events go through a queue that coalesces updates for the
+        # same VM. Starting `ensure` is rate limited instead of every event.
+        queue = EventQueue(sysconfig.agent.get("consul_event_queue_size", 1000))
+        handler = ConsulEventHandler(
+            index,
+            AdaptiveRateLimiter(
+                sysconfig.agent.get("consul_ensure_rate", 20),
+                max_rate=sysconfig.agent.get("consul_ensure_rate_max", 100),
+            ),
+        )
+        workers = [
+            threading.Thread(
+                target=_consul_event_worker, args=(queue, handler)
+            )
+            for _ in range(sysconfig.agent.get("consul_event_threads", 3))
+        ]
+        for worker in workers:
+            worker.start()
+        for event, received in others:
+            queue.put(event, received)
+        queue.close()
+        for worker in workers:
+            worker.join()
+        if queue.coalesced:
+            log.debug("coalesced-consul-events", count=queue.coalesced)
+        snapshot_pool.join()
         log.info("finish-consul-events")
 
     @classmethod
@@ -464,6 +627,9 @@ class Agent(object):
 
     @classmethod
     def report_supported_cpu_models(cls):
+        from . import directory
+        from .hazmat.cpuscan import scan_cpus
+
         variations = []
         for variation in scan_cpus():
             log.info(
@@ -566,6 +732,8 @@ class Agent(object):
             )
             sys.exit(MAINTENANCE_TEMPFAIL)
 
+        from . import directory
+
         d = directory.connect()
         host = socket.gethostname()
         for attempt in range(3):
@@ -668,6 +836,8 @@ class Agent(object):
             return
 
         if sys.stdout.isatty():
+            import colorama
+
             print(
                 colorama.Fore.RED,
                 "The following VMs will be shut down: ",
@@ -706,6 +876,221 @@ class Agent(object):
         pool.join()
         log.info("shutdown-all", result="finished")
 
+    @classmethod
+    def snapshot_all(cls, snapshot, keep=7, parallelism=None):
+        """Take snapshots of all running VMs on this host.
+
+        VMs are frozen, snapshotted and thawed in parallel. Every VM gets
+        its own deadline for freezing (`freeze-timeout`).
+
+        """
+        parallelism = parallelism or sysconfig.agent["snapshot_parallelism"]
+        vms = [
+            vm for vm in cls._vm_agents_for_host() if vm.qemu.process_exists()
+        ]
+        log.info("snapshot-all", count=len(vms), parallelism=parallelism)
+        if not vms:
+            return 0
+
+        failed = []
+
+        def snapshot_vm(vm):
+            try:
+                with vm:
+                    vm.snapshot(
+                        snapshot,
+                        keep=keep,
+                        freeze_timeout=vm.snapshot_freeze_timeout,
+                    )
+            except Exception as e:
+                failed.append(vm.name)
+                vm.log.error("snapshot-failed", reason=str(e))
+
+        pool = ThreadPool(min(parallelism, len(vms)))
+        pool.map(snapshot_vm, vms)
+        pool.close()
+        pool.join()
+
+        frozen = [vm.frozen_time for vm in vms if vm.frozen_time is not None]
+        log.info(
+            "snapshot-all",
+            result="finished",
+            snapshots=len(vms) - len(failed),
+            failed=",".join(sorted(failed)),
+            max_frozen="{:.1f}s".format(max(frozen, default=0)),
+            total_frozen="{:.1f}s".format(sum(frozen)),
+        )
+        return 1 if failed else 0
+
+    @classmethod
+    def snapshot_gc(cls, dry_run=False, parallelism=None):
+        """Remove expired snapshots of the VMs on this host.
+
+        Snapshots taken with `keep` carry their last day in the name
+        ("-keep-until-YYYYMMDD"). VMs are handled in parallel, removals are
+        spread out to at most `gc-rate` per second across all VMs.
+
+        """
+        parallelism = parallelism or sysconfig.agent["snapshot_parallelism"]
+        rate_limit = util.RateLimit(sysconfig.agent["snapshot_gc_rate"])
+        today = util.today()
+        vms = list(cls._vm_agents_for_host())
+        log.info(
+            "snapshot-gc", count=len(vms), dry_run=dry_run, today=str(today)
+        )
+        if not vms:
+            return 0
+
+        expired = []
+        removed = []
+        failed_snapshots = []
+        failed_vms = []
+
+        def remove(vm, snapshot):
+            rate_limit.wait()
+            try:
+                snapshot.remove()
+            except Exception as e:
+                failed_snapshots.append(snapshot.fullname)
+                vm.log.error(
+                    "snapshot-gc-failed",
+                    snapshot=snapshot.fullname,
+                    reason=str(e),
+                )
+            else:
+                removed.append(snapshot.fullname)
+
+        def collect_garbage(vm):
+            try:
+                with vm:
+                    for volume in list(vm.ceph.opened_volumes):
+                        for snapshot in volume.snapshots:
+                            until = snapshot.keep_until
+                            if until is None or until >= today:
+                                continue
+                            expired.append(snapshot.fullname)
+                            vm.log.info(
+                                "snapshot-expired",
+                                snapshot=snapshot.fullname,
+                                keep_until=str(until),
+                                action="report" if dry_run else "remove",
+                            )
+                            if not dry_run:
+                                remove(vm, snapshot)
+            except Exception as e:
+                failed_vms.append(vm.name)
+                vm.log.error("snapshot-gc-failed", reason=str(e))
+
+        pool = ThreadPool(min(parallelism, len(vms)))
+        pool.map(collect_garbage, vms)
+        pool.close()
+        pool.join()
+
+        log.info(
+            "snapshot-gc",
+            result="finished",
+            expired=len(expired),
+            removed=len(removed),
+            failed_snapshots=len(failed_snapshots),
+            failed_vms=len(failed_vms),
+        )
+        return 1 if failed_snapshots or failed_vms else 0
+
+    @classmethod
+    def _configured_vm_names(cls):
+        names = set()
+        for candidate in (cls.prefix / "etc/qemu/vm").glob("*.cfg"):
+            names.add(candidate.name[: -len(".cfg")])
+        # Freshly created VMs only have a staged config.
+        for candidate in (cls.prefix / "etc/qemu/vm").glob(".*.cfg.staging"):
+            names.add(candidate.name[1 : -len(".cfg.staging")])
+        return sorted(names)
+
+    @classmethod
+    def ensure_all(cls, parallelism=None):
+        """Ensure the proper status of all VMs configured on this host.
+
+        Does the same as `ensure` for every VM, but in one process: the
+        Ceph image index (listed again after `image-index-ttl`) and the
+        VRF route dumps are shared between the VMs, the consul client
+        between the VMs handled by the same thread. VMs that are locked by
+        another agent are skipped, that agent will pick up any changes.
+
+        """
+        parallelism = parallelism or sysconfig.agent["ensure_all_parallelism"]
+        vms = []
+        for name in cls._configured_vm_names():
+            try:
+                vms.append(Agent(name))
+            except Exception:
+                log.exception("load-agent", machine=name, exc_info=True)
+        log.info("ensure-all", count=len(vms), parallelism=parallelism)
+        if not vms:
+            return 0
+
+        image_index = ImageIndex(
+            None, ttl=sysconfig.agent["ensure_all_image_index_ttl"]
+        )
+        host_routes = RouteDumps()
+        for vm in vms:
+            vm.ceph_attach_on_enter = False
+            vm.image_index = image_index
+            vm.host_routes = host_routes
+
+        # The consul client keeps a requests session which must not be
+        # used by several threads at once.
+        clients = threading.local()
+        results = {}
+
+        def ensure_vm(vm):
+            started = time.monotonic()
+            if not hasattr(clients, "consul"):
+                clients.consul = vm.consul
+            vm.consul = clients.consul
+            try:
+                with vm:
+                    exitcode = vm.ensure()
+            except Exception:
+                result = "failed"
+                vm.log.exception("ensure-failed", exc_info=True)
+            else:
+                if exitcode == os.EX_TEMPFAIL:
+                    result = "locked"
+                elif exitcode:
+                    result = "failed"
+                    vm.log.error("ensure-failed", exitcode=exitcode)
+                else:
+                    result = "ok"
+            results[vm.name] = (result, time.monotonic() - started)
+
+        started = time.monotonic()
+        pool = ThreadPool(min(parallelism, len(vms)))
+        pool.map(ensure_vm, vms)
+        pool.close()
+        pool.join()
+        duration = time.monotonic() - started
+
+        # Slowest first.
+        for name, (result, seconds) in sorted(
+            results.items(), key=lambda item: (-item[1][1], item[0])
+        ):
+            log.info(
+                "ensure-all-vm",
+                machine=name,
+                result=result,
+                duration="{:.2f}s".format(seconds),
+            )
+        outcomes = collections.Counter(r for r, _ in results.values())
+        log.info(
+            "ensure-all",
+            result="finished",
+            ok=outcomes["ok"],
+            locked=outcomes["locked"],
+            failed=outcomes["failed"],
+            duration="{:.1f}s".format(duration),
+        )
+        return 1 if outcomes["failed"] else 0
+
     @classmethod
     def check(cls):
         """Perform a health check of this host from a Qemu perspective.
@@ -790,6 +1175,49 @@ class Agent(object):
 
         return result
 
+    @classmethod
+    def ceph_broker(cls):
+        """Serve Ceph operations for all fc-qemu processes on this host."""
+        from .hazmat.cephbroker import serve
+
+        serve(
+            sysconfig.ceph["CEPH_BROKER_SOCKET"],
+            sysconfig.ceph["CEPH_CONF"],
+            "client." + sysconfig.ceph["CEPH_CLIENT"],
+            log,
+        )
+
+    @classmethod
+    def qmp_multiplexer(cls):
+        """Share the monitor connections of all VMs on this host."""
+        from .hazmat.qmpmux import serve
+
+        serve(
+            sysconfig.qemu["qmp_multiplexer_socket"],
+            Qemu.prefix / "run",
+            sysconfig.qemu["qmp_cache_ttl"],
+            log,
+        )
+
+    @classmethod
+    def agent_daemon(cls, socket_path):
+        """Run the commands of all fc-qemu clients on this host.
+
+        Workers inherit the imported modules and the system config from
+        the daemon. The config is reloaded before forking a worker if
+        fc-qemu.conf changed.
+
+        """
+        from .daemon import serve
+        from .main import run_in_daemon
+
+        def refresh_system_config():
+            if sysconfig.changed():
+                log.info("agent-daemon-reload-system-config")
+                sysconfig.load_system_config()
+
+        serve(socket_path, run_in_daemon, log, prepare=refresh_system_config)
+
     def stage_new_config(self):
         """Save the current config on the agent into a staging config file.
 
@@ -811,38 +1239,32 @@ class Agent(object):
         try:
             update_staging_config = False
             # Verify generation of config to protect against lost updates.
-            with self.config_file_staging.open("r") as current_staging:
-                try:
-                    current_staging_config = yaml.safe_load(current_staging)
-                    current_staging_generation = current_staging_config[
-                        "consul-generation"
-                    ]
-                except Exception:
-                    self.log.debug("inconsistent-staging-config")
-                    # Inconsistent staging configs should be updated
-                    update_staging_config = True
-                else:
-                    # Newer staging configs should be updated
-                    update_staging_config = (
-                        self.enc["consul-generation"]
-                        > current_staging_generation
-                    )
+            try:
+                current_staging_generation = configstore.read_generation(
+                    self.config_file_staging
+                )
+            except Exception:
+                self.log.debug("inconsistent-staging-config")
+                # Inconsistent staging configs should be updated
+                update_staging_config = True
+            else:
+                # Newer staging configs should be updated
+                update_staging_config = (
+                    self.enc["consul-generation"] > current_staging_generation
+                )
 
             if update_staging_config:
                 self.log.debug("save-staging-config")
                 # Update the file in place to avoid lock breaking.
-                with self.config_file_staging.open("w") as new_staging:
-                    yaml.safe_dump(self.enc, new_staging)
+                configstore.write(self.config_file_staging, self.enc)
                 self.config_file_staging.chmod(0o644)
 
             # Do we need to activate this config?
             activate_staging_config = False
             try:
-                with self.config_file.open("r") as current_active:
-                    current_active_config = yaml.safe_load(current_active)
-                current_active_generation = current_active_config[
-                    "consul-generation"
-                ]
+                current_active_generation = configstore.read_generation(
+                    self.config_file
+                )
             except Exception:
                 self.log.debug("inconsistent-active-config")
                 # Inconsistent staging configs should be updated
@@ -883,46 +1305,47 @@ class Agent(object):
         )
         try:
             # Verify generation of config to protect against lost updates.
-            with self.config_file_staging.open("r") as current_staging:
-                try:
-                    current_staging_config = yaml.safe_load(current_staging)
-                    staging_generation = current_staging_config[
-                        "consul-generation"
-                    ]
-                except Exception:
-                    self.log.debug(
-                        "update-check", result="inconsistent", action="purge"
-                    )
-                    self.config_file_staging.unlink(missing_ok=True)
-                    return False
-                else:
-                    if staging_generation <= self.consul_generation:
-                        # Stop right here, do not write a new config if the
-                        # existing one is newer (or as new) already.
-                        self.log.debug(
-                            "update-check",
-                            result="stale-update",
-                            action="ignore",
-                            update=staging_generation,
-                            current=self.consul_generation,
-                        )
-                        # The old staging file needs to stay around so that
-                        # the consul writer knows whether to launch an ensure
-                        # agent or not.
-                        return False
+            try:
+                staging_generation = configstore.read_generation(
+                    self.config_file_staging
+                )
+            except Exception:
+                self.log.debug(
+                    "update-check", result="inconsistent", action="purge"
+                )
+                self.config_file_staging.unlink(missing_ok=True)
+                configstore.remove_sidecar(self.config_file_staging)
+                return False
+            if staging_generation <= self.consul_generation:
+                # Stop right here, do not write a new config if the
+                # existing one is newer (or as new) already.
                 self.log.debug(
                     "update-check",
-                    result="update-available",
-                    action="update",
+                    result="stale-update",
+                    action="ignore",
                     update=staging_generation,
                     current=self.consul_generation,
                 )
+                # The old staging file needs to stay around so that
+                # the consul writer knows whether to launch an ensure
+                # agent or not.
+                return False
+            self.log.debug(
+                "update-check",
+                result="update-available",
+                action="update",
+                update=staging_generation,
+                current=self.consul_generation,
+            )
 
             # The config seems consistent and newer, lets update.
             # We can replace the config file because that one is protected
             # by the global VM lock.
             shutil.copy2(self.config_file_staging, self.config_file)
             self.enc = self._load_enc()
+            configstore.write_sidecar(
+                self.config_file, self.enc["consul-generation"]
+            )
             return True
         finally:
             fcntl.flock(staging_lock, fcntl.LOCK_UN)
@@ -947,40 +1370,38 @@ class Agent(object):
         )
         try:
             # Verify generation of config to protect against lost updates.
-            with self.config_file_staging.open("r") as current_staging:
-                try:
-                    current_staging_config = yaml.safe_load(current_staging)
-                    staging_generation = current_staging_config[
-                        "consul-generation"
-                    ]
-                except Exception:
-                    self.log.debug(
-                        "update-check", result="inconsistent", action="purge"
-                    )
-                    self.config_file_staging.unlink(missing_ok=True)
-                    return False
-                else:
-                    if staging_generation <= self.consul_generation:
-                        # Stop right here, do not write a new config if the
-                        # existing one is newer (or as new) already.
-                        self.log.debug(
-                            "update-check",
-                            result="stale-update",
-                            action="ignore",
-                            update=staging_generation,
-                            current=self.consul_generation,
-                        )
-                        # The old staging file needs to stay around so that
-                        # the consul writer knows whether to launch an ensure
-                        # agent or not.
-                        return False
+            try:
+                staging_generation = configstore.read_generation(
+                    self.config_file_staging
+                )
+            except Exception:
+                self.log.debug(
+                    "update-check", result="inconsistent", action="purge"
+                )
+                self.config_file_staging.unlink(missing_ok=True)
+                configstore.remove_sidecar(self.config_file_staging)
+                return False
+            if staging_generation <= self.consul_generation:
+                # Stop right here, do not write a new config if the
+                # existing one is newer (or as new) already.
                 self.log.debug(
                     "update-check",
-                    result="update-available",
-                    action="update",
+                    result="stale-update",
+                    action="ignore",
                     update=staging_generation,
                     current=self.consul_generation,
                 )
+                # The old staging file needs to stay around so that
+                # the consul writer knows whether to launch an ensure
+                # agent or not.
+                return False
+            self.log.debug(
+                "update-check",
+                result="update-available",
+                action="update",
+                update=staging_generation,
+                current=self.consul_generation,
+            )
             return True
         finally:
             fcntl.flock(staging_lock, fcntl.LOCK_UN)
@@ -1009,6 +1430,10 @@ class Agent(object):
         self.qemu = Qemu(self.cfg)
         self.ceph = Ceph(self.cfg, self.enc)
         self.ceph.attach_on_enter = self.ceph_attach_on_enter
+        if self.image_index is not None:
+            self.ceph.image_index = ImageIndex(
+                self.ceph, share=self.image_index
+            )
         self.contexts = [self.qemu, self.ceph]
         for attr in ["migration_ctl_address"]:
             setattr(self, attr, getattr(self, attr).format(**self.cfg))
@@ -1215,9 +1640,13 @@ class Agent(object):
             # perform this when we haven't recently booted the machine to
             # reduce the time we're unnecessarily waiting for timeouts.
             self.ensure_thawed()
-            self.mark_qemu_binary_generation()
-            self.mark_qemu_guest_properties()
-            self.update_root_ssh_keys_cloudinit()
+            # Queue all writes so they share a single round trip to the
+            # guest agent. Files that didn't change are not written again.
+            session = self.qemu.guest_session(cached=True)
+            self.mark_qemu_binary_generation(session)
+            self.mark_qemu_guest_properties(session)
+            self.update_root_ssh_keys_cloudinit(session)
+            session.run()
 
     def _destroy(self, kill_supervisor=False):
         timeout = TimeOut(15, interval=1, raise_on_timeout=False)
@@ -1258,7 +1687,7 @@ class Agent(object):
         except Exception as e:
             self.log.error("ensure-thawed-failed", reason=str(e))
 
-    def mark_qemu_guest_properties(self):
+    def mark_qemu_guest_properties(self, session):
         props = {
             "binary_generation": self.binary_generation,
             "cpu_model": self.cfg["cpu_model"],
@@ -1268,42 +1697,52 @@ class Agent(object):
             "mark-qemu-guest-properties",
             properties=props,
         )
-        try:
-            self.qemu.write_file(
-                "/run/qemu-guest-properties-current",
-                (json.dumps(props)).encode("utf-8"),
-            )
-        except Exception as e:
-            self.log.error("mark-qemu-guest-properties", reason=str(e))
+        session.write_file(
+            "/run/qemu-guest-properties-current",
+            (json.dumps(props)).encode("utf-8"),
+            on_error=lambda e: self.log.error(
+                "mark-qemu-guest-properties", reason=str(e)
+            ),
+        )
 
-    def mark_qemu_binary_generation(self):
+    def mark_qemu_binary_generation(self, session):
         self.log.info(
             "mark-qemu-binary-generation", generation=self.binary_generation
         )
-        try:
-            self.qemu.write_file(
-                "/run/qemu-binary-generation-current",
-                (str(self.binary_generation) + "\n").encode("ascii"),
-            )
-        except Exception as e:
-            self.log.error("mark-qemu-binary-generation", reason=str(e))
+        session.write_file(
+            "/run/qemu-binary-generation-current",
+            (str(self.binary_generation) + "\n").encode("ascii"),
+            on_error=lambda e: self.log.error(
+                "mark-qemu-binary-generation", reason=str(e)
+            ),
+        )
 
-    def update_root_ssh_keys_cloudinit(self):
+    def update_root_ssh_keys_cloudinit(self, session):
         if self.cfg["environment_class_type"] != "cloudinit":
             return
         self.log.info("update-root-ssh-keys-cloudinit")
+
+        def on_error(e):
+            self.log.error("update-root-ssh-keys-cloudinit", reason=str(e))
+
         try:
             users = self._load_users()
             to_write_text = util.generate_cloudinit_ssh_keyfile(
                 users, self.cfg["resource_group"]
             )
-            self.qemu.write_file(
-                "/root/.ssh/authorized_keys_fc",
-                to_write_text.encode("utf-8"),
-            )
-            self.qemu.exec("chmod", ["0600", "/root/.ssh/authorized_keys_fc"])
         except Exception as e:
-            self.log.error("update-root-ssh-keys-cloudinit", reason=str(e))
+            on_error(e)
+            return
+        written = session.write_file(
+            "/root/.ssh/authorized_keys_fc",
+            to_write_text.encode("utf-8"),
+        )
+        session.exec(
+            "chmod",
+            ["0600", "/root/.ssh/authorized_keys_fc"],
+            after=written,
+            on_error=on_error,
+        )
 
     def ensure_online_disk_size(self):
         """Trigger block resize action for the root disk."""
@@ -1399,6 +1838,7 @@ class Agent(object):
                 for addr in addrs
             }
             current_routes = {}
+            add = remove = set()
 
             self.log.info(
                 "ensure-routes",
@@ -1408,18 +1848,20 @@ class Agent(object):
             )
 
             try:
-                current_v4 = iproute2_json(
-                    self.log,
-                    ["-4", "route", "show", "vrf", vrfname, "dev", ifname],
-                )
-                current_v6 = iproute2_json(
-                    self.log,
-                    ["-6", "route", "show", "vrf", vrfname, "dev", ifname],
-                )
+                if self.host_routes is not None:
+                    current = self.host_routes.routes(self.log, vrfname, ifname)
+                else:
+                    current = iproute2_json(
+                        self.log,
+                        ["-4", "route", "show", "vrf", vrfname, "dev", ifname],
+                    ) + iproute2_json(
+                        self.log,
+                        ["-6", "route", "show", "vrf", vrfname, "dev", ifname],
+                    )
 
                 current_routes = {
                     ip_interface(x["dst"])
-                    for x in (current_v4 + current_v6)
+                    for x in current
                     # ignore routes managed by the kernel
                     if "protocol" not in x or x["protocol"] != "kernel"
                 }
@@ -1491,6 +1933,9 @@ class Agent(object):
                     vrf=vrfname,
                     exc_info=True,
                 )
+            finally:
+                if (add or remove) and self.host_routes is not None:
+                    self.host_routes.invalidate(vrfname)
 
     def ensure_watchdog(self, action="none"):
         """Ensure watchdog settings."""
@@ -1504,6 +1949,8 @@ class Agent(object):
 
     def consul_register(self):
         """Register running VM with Consul."""
+        import consulate.models.agent
+
         self.log.debug("consul-register")
         self.consul.agent.service.register(
             self.svc_name,
@@ -1523,6 +1970,8 @@ class Agent(object):
 
     def consul_deregister(self):
         """De-register non-running VM with Consul."""
+        import requests
+
         try:
             if self.svc_name not in self.consul.agent.services():
                 return
@@ -1549,7 +1998,7 @@ class Agent(object):
         # the lock is never dangerous. Lets go with that.
 
     @contextlib.contextmanager
-    def frozen_vm(self):
+    def frozen_vm(self, freeze_timeout=None):
         """Ensure a VM has a non-changing filesystem, that is clean enough
         to be mounted with a straight-forward journal replay.
 
@@ -1566,8 +2015,9 @@ class Agent(object):
         try:
             if self.qemu.is_running():
                 self.log.info("freeze", volume="root")
+                started = time.monotonic()
                 try:
-                    self.qemu.freeze()
+                    self.qemu.freeze(freeze_timeout)
                     frozen = True
                 except Exception as e:
                     self.log.error(
@@ -1589,12 +2039,18 @@ class Agent(object):
                 # other measures in place (e.g. during scrubbing) that will
                 # try to unfreeze later.
                 self.ensure_thawed()
+                # Counted from the freeze request as the guest starts
+                # blocking writes while the freeze is still in progress.
+                self.frozen_time = time.monotonic() - started
+                self.log.info(
+                    "frozen-time", seconds="{:.1f}".format(self.frozen_time)
+                )
             if has_exception:
                 raise
 
     @locked()
     @running(True)
-    def snapshot(self, snapshot, keep=0):
+    def snapshot(self, snapshot, keep=0, freeze_timeout=None):
         """Guarantees a _consistent_ snapshot to be created.
 
         If we can't properly freeze the VM then whoever needs a (consistent)
@@ -1611,7 +2067,7 @@ class Agent(object):
             self.log.info("snapshot-exists", snapshot=snapshot)
             return
         self.log.info("snapshot-create", name=snapshot)
-        with self.frozen_vm() as frozen:
+        with self.frozen_vm(freeze_timeout) as frozen:
             if frozen:
                 self.ceph.volumes["root"].snapshots.create(snapshot)
             else:
@@ -1622,12 +2078,22 @@ class Agent(object):
     # QMP socket and that only supports talking to one person at a time.
     # Alternatively we'd had to connect/disconnect and do weird things
     # for every single command ...
-    @locked()
     def status(self) -> int:
         """Determine status of the VM.
 
         Return value is a process exit code (0 = online, 1 = offline, 255 = error)
         """
+        if self.qemu.qmp_multiplexed:
+            # The multiplexer shares the monitor between processes, so we
+            # don't need to wait for others to release the VM.
+            return self._status()
+        return self._locked_status()
+
+    @locked()
+    def _locked_status(self) -> int:
+        return self._status()
+
+    def _status(self) -> int:
         exit_code = 255
         try:
             if self.qemu.is_running():
@@ -1745,6 +2211,8 @@ class Agent(object):
     @running(False)
     def inmigrate(self):
         self.log.info("inmigrate")
+        from .incoming import IncomingServer
+
         server = IncomingServer(self)
         exitcode = server.run()
         if not exitcode:
@@ -1758,6 +2226,8 @@ class Agent(object):
         self.log.info("outmigrate")
         # re-register in case services got lost during Consul restart
         self.consul_register()
+        from .outgoing import Outgoing
+
         client = Outgoing(self)
         exitcode = client()
         if not exitcode:
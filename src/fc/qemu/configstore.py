@@ -0,0 +1,99 @@
+"""Reading and writing VM configs (ENC data) as YAML.
+
+Uses libyaml through PyYAML's C loader and dumper if available.
+
+Several places only need to know the consul generation of a config, some
+of them repeatedly while waiting for something. Whenever we write a config
+(or had to parse one) we keep a small sidecar file next to it with the
+generation and the inode, size and modification time of the config. As
+long as those still match, the generation is read from the sidecar without
+parsing the YAML.
+
+"""
+
+import contextlib
+import os
+import struct
+from pathlib import Path
+
+import yaml
+
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# consul generation, config inode, mtime (ns) and size
+SIDECAR = struct.Struct("<qQqq")
+
+
+def load(stream):
+    return yaml.load(stream, Loader=Loader)
+
+
+def dump(data, stream):
+    yaml.dump(data, stream, Dumper=Dumper, default_flow_style=False)
+
+
+def sidecar_path(path):
+    path = Path(path)
+    return path.with_name("." + path.name.lstrip(".") + ".generation")
+
+
+def _signature(path):
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def write_sidecar(path, generation):
+    """Remember the generation of the config at `path` as it is now."""
+    sidecar = sidecar_path(path)
+    tmp = sidecar.with_name(sidecar.name + ".tmp")
+    try:
+        data = SIDECAR.pack(generation, *_signature(path))
+        tmp.write_bytes(data)
+        os.replace(tmp, sidecar)
+    except (OSError, struct.error):
+        # The sidecar is only an optimization.
+        with contextlib.suppress(OSError):
+            tmp.unlink()
+
+
+def remove_sidecar(path):
+    with contextlib.suppress(OSError):
+        sidecar_path(path).unlink()
+
+
+def read_generation(path):
+    """Return the consul generation of the config at `path`.
+
+    Raises like parsing the config would if it has no generation.
+
+    """
+    try:
+        generation, *signature = SIDECAR.unpack(
+            sidecar_path(path).read_bytes()
+        )
+    except (OSError, struct.error):
+        pass
+    else:
+        if tuple(signature) == _signature(path):
+            return generation
+    with open(path) as f:
+        generation = load(f)["consul-generation"]
+    if isinstance(generation, int):
+        write_sidecar(path, generation)
+    return generation
+
+
+def write(path, data):
+    """Write a config in place and remember its generation.
+
+    Writing in place keeps locks on the file intact.
+
+    """
+    with open(path, "w") as f:
+        dump(data, f)
+    generation = data.get("consul-generation")
+    if isinstance(generation, int):
+        write_sidecar(path, generation)
+    else:
+        remove_sidecar(path)
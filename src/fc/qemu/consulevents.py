@@ -0,0 +1,373 @@
+"""Incremental parsing and pre-filtering of consul watch payloads.
+
+Consul calls `fc-qemu handle-consul-event` with the complete `node/`
+prefix whenever any key in it changes. Most of those events are either
+unchanged since the last call or for VMs that never run on this host.
+
+`iter_events` reads the payload one event at a time and the
+`GenerationIndex` remembers the last generation that was settled for
+each VM, so those events can be discarded without decoding their value
+or constructing an agent.
+
+The remaining events are handed to workers through an `EventQueue`
+that coalesces events for the same key, and `ensure` runs are started at
+a rate that an `AdaptiveRateLimiter` adjusts to the host's load.
+
+"""
+
+import collections
+import contextlib
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# VM name (NUL-padded) and consul generation.
+RECORD = struct.Struct("<64sQ")
+
+WHITESPACE = " \t\r\n"
+
+
+class _Buffer:
+    """Read a text stream in chunks, dropping what has been consumed."""
+
+    def __init__(self, input, chunk_size):
+        self.input = input
+        self.chunk_size = chunk_size
+        self.data = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.input.read(self.chunk_size)
+        self.data = self.data[self.pos :] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return not self.eof
+
+    def peek(self):
+        """The next non-whitespace character or "" at the end."""
+        while True:
+            while (
+                self.pos < len(self.data) and self.data[self.pos] in WHITESPACE
+            ):
+                self.pos += 1
+            if self.pos < len(self.data):
+                return self.data[self.pos]
+            if not self.fill():
+                return ""
+
+    def decode(self, decoder):
+        while True:
+            try:
+                value, self.pos = decoder.raw_decode(self.data, self.pos)
+                return value
+            except json.JSONDecodeError:
+                # The value may continue in the next chunk.
+                if not self.fill():
+                    raise
+
+
+def iter_events(input, chunk_size=65536):
+    """Yield the elements of a JSON array from a text stream one by one.
+
+    An empty payload (nothing, `null` or `[]`) yields nothing.
+
+    """
+    decoder = json.JSONDecoder()
+    buf = _Buffer(input, chunk_size)
+    char = buf.peek()
+    if char != "[":
+        if char and buf.decode(decoder):
+            raise ValueError("consul payload is not a list")
+        return
+    buf.pos += 1
+    if buf.peek() == "]":
+        buf.pos += 1
+    else:
+        while True:
+            if not buf.peek():
+                raise ValueError("incomplete consul payload")
+            yield buf.decode(decoder)
+            char = buf.peek()
+            if not char:
+                raise ValueError("incomplete consul payload")
+            buf.pos += 1
+            if char == "]":
+                break
+            if char != ",":
+                raise ValueError(f"unexpected {char!r} in consul payload")
+    if buf.peek():
+        raise ValueError("unexpected data after consul payload")
+
+
+def vm_name(event):
+    """The VM name of a `node/` event or None for other events."""
+    key = event.get("Key") or ""
+    if not key.startswith("node/"):
+        return None
+    return key[len("node/") :]
+
+
+class GenerationIndex:
+    """Host-wide index of the last settled consul generation per VM.
+
+    An event is settled if it didn't need an `ensure` run: it is for a
+    physical machine, for a VM that doesn't concern this host or its config
+    was unchanged. Events that caused an `ensure` are not recorded, so a
+    failed run will be retried by the next payload.
+
+    The file holds fixed-size records sorted by name. It is memory-mapped
+    and searched in place, updates are kept in memory until `save()`
+    merges them into the file.
+
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self._updates = {}
+        self._updates_lock = threading.Lock()
+        self._map = None
+        self._count = 0
+        self._open()
+
+    def _open(self):
+        try:
+            f = self.path.open("rb")
+        except FileNotFoundError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if not size or size % RECORD.size:
+                return
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._count = size // RECORD.size
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._count = 0
+
+    @staticmethod
+    def _key(name):
+        key = name.encode("utf-8")
+        if len(key) > RECORD.size - 8:
+            return None
+        return key.ljust(RECORD.size - 8, b"\0")
+
+    def _lookup(self, key):
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            candidate, generation = RECORD.unpack_from(
+                self._map, middle * RECORD.size
+            )
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return generation
+        return None
+
+    def get(self, name):
+        key = self._key(name)
+        if key is None:
+            return None
+        with self._updates_lock:
+            if key in self._updates:
+                return self._updates[key]
+        return self._lookup(key)
+
+    def is_settled(self, event):
+        """Whether the event's generation has already been settled."""
+        name = vm_name(event)
+        if name is None:
+            return False
+        generation = self.get(name)
+        if generation is None:
+            return False
+        modify_index = event.get("ModifyIndex")
+        if not isinstance(modify_index, int):
+            return False
+        return modify_index <= generation
+
+    def settle(self, event):
+        """Remember that the event's generation has been settled."""
+        name = vm_name(event)
+        modify_index = event.get("ModifyIndex")
+        if name is None or not isinstance(modify_index, int):
+            return
+        key = self._key(name)
+        if key is None:
+            return
+        with self._updates_lock:
+            known = self._updates.get(key)
+            if known is None:
+                known = self._lookup(key) or 0
+            self._updates[key] = max(known, modify_index)
+
+    def _read_all(self):
+        records = {}
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return records
+        if len(data) % RECORD.size:
+            return records
+        for key, generation in RECORD.iter_unpack(data):
+            records[key] = generation
+        return records
+
+    def save(self):
+        """Merge our updates into the index file."""
+        with self._updates_lock:
+            updates = self._updates
+            self._updates = {}
+        if not updates:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a+") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Other processes may have saved in the meantime.
+            records = self._read_all()
+            for key, generation in updates.items():
+                records[key] = max(records.get(key, 0), generation)
+            fd, tmp = tempfile.mkstemp(
+                dir=self.path.parent, prefix=f".{self.path.name}."
+            )
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for key in sorted(records):
+                        f.write(RECORD.pack(key, records[key]))
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, self.path)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(tmp)
+                raise
+        self.close()
+        self._open()
+
+
+class EventQueue:
+    """Bounded queue that keeps only the latest event per key.
+
+    An event replaces a queued event with the same key if its generation
+    is at least as new. It keeps the receipt time of the replaced event so
+    the reported latency covers the whole burst. Events for a key that a
+    worker is handling wait until it is done, so a VM is never handled by
+    two workers at once.
+
+    `put()` blocks while `maxsize` events are queued.
+
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.pending = collections.OrderedDict()
+        self.active = set()
+        self.closed = False
+        self.coalesced = 0
+        self._cond = threading.Condition()
+
+    def put(self, event, received=None):
+        if received is None:
+            received = time.monotonic()
+        key = event.get("Key")
+        with self._cond:
+            if key in self.pending:
+                queued, queued_received = self.pending[key]
+                if event.get("ModifyIndex", 0) >= queued.get("ModifyIndex", 0):
+                    queued = event
+                self.pending[key] = (queued, min(received, queued_received))
+                self.coalesced += 1
+                return
+            while len(self.pending) >= self.maxsize:
+                self._cond.wait()
+            self.pending[key] = (event, received)
+            self._cond.notify_all()
+
+    def get(self):
+        """Return the next (key, event, received) or None when finished."""
+        with self._cond:
+            while True:
+                for key in self.pending:
+                    if key in self.active:
+                        continue
+                    event, received = self.pending.pop(key)
+                    self.active.add(key)
+                    self._cond.notify_all()
+                    return key, event, received
+                if self.closed and not self.pending:
+                    return None
+                self._cond.wait()
+
+    def done(self, key):
+        with self._cond:
+            self.active.discard(key)
+            self._cond.notify_all()
+
+    def close(self):
+        """No more events will be put, let idle workers finish."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class AdaptiveRateLimiter:
+    """Space out the start of `ensure` runs.
+
+    Starts at `rate` runs per second. Before each start the rate is
+    adjusted: it is halved if the load per CPU exceeds `max_load` or the
+    last run failed to start and otherwise grows by `increase`, within
+    `min_rate` and `max_rate`.
+
+    """
+
+    def __init__(
+        self,
+        rate,
+        min_rate=1,
+        max_rate=100,
+        increase=1,
+        max_load=1.0,
+        load=os.getloadavg,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max(rate, max_rate)
+        self.increase = increase
+        self.max_load = max_load
+        self.load = load
+        self.cpus = os.cpu_count() or 1
+        self.next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _decrease(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def wait(self):
+        with self._lock:
+            if self.load()[0] / self.cpus > self.max_load:
+                self._decrease()
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + 1 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def failed(self):
+        with self._lock:
+            self._decrease()
@@ -0,0 +1,320 @@
+"""Long-running fc-qemu agent daemon and its client.
+
+Every fc-qemu invocation would otherwise pay for starting Python, importing
+all of fc.qemu and its dependencies and reading the system config. The
+daemon does this once and then forks a worker for every command a client
+forwards over a unix socket.
+
+The client passes its stdin, stdout and stderr along with the request, so
+the worker writes log output directly to the client's terminal (or log
+file) and the client exits with the worker's exit code. Workers are
+separate processes: they can't corrupt the daemon's state, and locks,
+`sys.exit()` and `os.exec*()` behave just as in a standalone fc-qemu.
+
+This module is imported by the client before deciding where to run a
+command and must only depend on the standard library.
+
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import traceback
+from pathlib import Path
+
+SOCKET = "/run/fc-qemu.agent.sock"
+
+# Overrides the socket path for the client and the daemon.
+SOCKET_ENV = "FC_QEMU_AGENT_SOCKET"
+
+# Subcommands that are long-running services of their own. They are never
+# forwarded to the daemon.
+LOCAL_ONLY = {"agent_daemon", "ceph_broker", "qmp_multiplexer"}
+
+# Clients send their request right after connecting. Don't let a broken
+# client block the daemon for longer than this (seconds).
+REQUEST_TIMEOUT = 5
+
+MAX_REQUEST_SIZE = 1024 * 1024
+
+
+def socket_path():
+    return os.environ.get(SOCKET_ENV, SOCKET)
+
+
+def exitcode_from_status(status):
+    exitcode = os.waitstatus_to_exitcode(status)
+    if exitcode < 0:
+        # Killed by a signal: use the shell's convention.
+        exitcode = 128 - exitcode
+    return exitcode
+
+
+def forward(args, argv, path=None):
+    """Run a parsed command line in the daemon.
+
+    Returns the command's exit code or None if the daemon can't be reached
+    and the command should be run locally.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path or socket_path()))
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        request = dict(
+            args=vars(args), argv=argv, cwd=os.getcwd(), env=dict(os.environ)
+        )
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            socket.send_fds(
+                sock,
+                [json.dumps(request).encode("utf-8") + b"\n"],
+                [0, 1, 2],
+            )
+        except OSError:
+            # The daemon is going away or one of our standard file
+            # descriptors is closed. Nothing has been started, yet.
+            return None
+        # Closing the connection (e.g. on KeyboardInterrupt) terminates
+        # the worker.
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        # The daemon died while running our command.
+        return os.EX_UNAVAILABLE
+    return json.loads(line)["exitcode"]
+
+
+def receive_request(conn):
+    """Read a request and the client's standard file descriptors."""
+    data = b""
+    fds = []
+    try:
+        while not data.endswith(b"\n"):
+            chunk, new_fds, _, _ = socket.recv_fds(conn, 65536, 3)
+            fds.extend(new_fds)
+            if not chunk:
+                raise ValueError("connection closed")
+            data += chunk
+            if len(data) > MAX_REQUEST_SIZE:
+                raise ValueError("request too large")
+        if len(fds) != 3:
+            raise ValueError(f"expected 3 file descriptors, got {len(fds)}")
+        return json.loads(data), fds
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+class Worker:
+    def __init__(self, pid, conn, pidfd):
+        self.pid = pid
+        self.conn = conn
+        self.pidfd = pidfd
+
+
+class AgentDaemon:
+    """Fork a worker for every request and report its exit code.
+
+    `run` is called in the worker with the client's parsed arguments and
+    returns the exit code. `prepare` is called in the daemon before each
+    fork and allows refreshing state the workers inherit.
+
+    """
+
+    def __init__(self, path, run, log, prepare=None):
+        self.path = Path(path)
+        self.run = run
+        self.prepare = prepare
+        self.log = log.bind(subsystem="agent-daemon")
+        self.workers = {}
+        self.stopping = False
+
+        with contextlib.suppress(FileNotFoundError):
+            self.path.unlink()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Nobody else may connect, not even before we could chmod.
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(str(self.path))
+        finally:
+            os.umask(umask)
+        self.path.chmod(0o600)
+        self.sock.listen(64)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, self.accept)
+
+    def serve_forever(self):
+        while not self.stopping or self.workers:
+            # Wake up regularly to notice that we have been stopped.
+            for key, _ in self.selector.select(timeout=1):
+                key.data()
+
+    def stop(self, *args):
+        """Stop accepting requests, running workers may finish."""
+        if self.stopping:
+            return
+        self.stopping = True
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        with contextlib.suppress(FileNotFoundError):
+            self.path.unlink()
+        self.log.info("agent-daemon-stopping", workers=len(self.workers))
+
+    def close(self):
+        self.stop()
+        for worker in list(self.workers.values()):
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(worker.pid, signal.SIGTERM)
+            os.waitpid(worker.pid, 0)
+            self._forget(worker)
+        self.selector.close()
+
+    def accept(self):
+        if self.stopping:
+            return
+        conn, _ = self.sock.accept()
+        conn.settimeout(REQUEST_TIMEOUT)
+        try:
+            request, fds = receive_request(conn)
+        except (OSError, ValueError) as e:
+            self.log.warning("agent-daemon-invalid-request", reason=str(e))
+            conn.close()
+            return
+        try:
+            if self.prepare is not None:
+                self.prepare()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                self._work(conn, request, fds)
+        except Exception:
+            self.log.exception("agent-daemon-fork-failed", exc_info=True)
+            conn.close()
+            return
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        worker = Worker(pid, conn, os.pidfd_open(pid))
+        self.workers[pid] = worker
+        self.selector.register(
+            worker.pidfd,
+            selectors.EVENT_READ,
+            functools.partial(self.reap, worker),
+        )
+        self.selector.register(
+            conn,
+            selectors.EVENT_READ,
+            functools.partial(self.disconnected, worker),
+        )
+        self.log.debug(
+            "agent-daemon-started-worker", pid=pid, argv=request["argv"]
+        )
+
+    def reap(self, worker):
+        _, status = os.waitpid(worker.pid, 0)
+        exitcode = exitcode_from_status(status)
+        self.log.debug(
+            "agent-daemon-worker-finished", pid=worker.pid, exitcode=exitcode
+        )
+        if worker.conn is not None:
+            with contextlib.suppress(OSError):
+                worker.conn.sendall(
+                    json.dumps({"exitcode": exitcode}).encode("utf-8") + b"\n"
+                )
+        self._forget(worker)
+
+    def disconnected(self, worker):
+        # Clients don't send anything after the request, so this is EOF.
+        self.log.debug("agent-daemon-client-gone", pid=worker.pid)
+        self.selector.unregister(worker.conn)
+        worker.conn.close()
+        worker.conn = None
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(worker.pid, signal.SIGTERM)
+
+    def _forget(self, worker):
+        del self.workers[worker.pid]
+        with contextlib.suppress(KeyError, ValueError):
+            self.selector.unregister(worker.pidfd)
+        os.close(worker.pidfd)
+        if worker.conn is not None:
+            with contextlib.suppress(KeyError, ValueError):
+                self.selector.unregister(worker.conn)
+            worker.conn.close()
+            worker.conn = None
+
+    def _work(self, conn, request, fds):
+        """Run a request in the forked worker. Never returns."""
+        exitcode = os.EX_SOFTWARE
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            self.selector.close()
+            self.sock.close()
+            for worker in self.workers.values():
+                os.close(worker.pidfd)
+                if worker.conn is not None:
+                    worker.conn.close()
+            conn.close()
+
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+            for fd in fds:
+                if fd > 2:
+                    os.close(fd)
+            for stream in [sys.stdout, sys.stderr]:
+                stream.reconfigure(line_buffering=stream.isatty())
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            sys.argv = request["argv"]
+
+            exitcode = self.run(argparse.Namespace(**request["args"]))
+        except SystemExit as e:
+            if e.code is None:
+                exitcode = os.EX_OK
+            elif isinstance(e.code, int):
+                exitcode = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                exitcode = 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            with contextlib.suppress(Exception):
+                sys.stdout.flush()
+                sys.stderr.flush()
+            os._exit(exitcode)
+
+
+def serve(path, run, log, prepare=None):
+    """Run the agent daemon until it is told to stop.
+
+    SIGTERM and SIGINT stop accepting requests but let running commands
+    finish.
+
+    """
+    daemon = AgentDaemon(path, run, log, prepare)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    log.info("agent-daemon-start", socket=str(path))
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.close()
+        log.info("agent-daemon-stop")
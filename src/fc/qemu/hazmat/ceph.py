@@ -7,13 +7,16 @@ import hashlib
 import ipaddress
 import json
 import os
-import xmlrpc.client
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Optional
 
 import yaml
 
-import fc.qemu.directory
 import fc.qemu.hazmat.libceph as libceph
 from fc.qemu.util import (
     conditional_update,
@@ -24,6 +27,7 @@ from fc.qemu.util import (
 from ..sysconfig import sysconfig
 from ..timeout import TimeoutError
 from ..util import cmd, log, parse_export_format
+from . import diskimage
 from .volume import Volume
 
 # These values need to be kept in sync with the KVM role in fc-nixos
@@ -35,42 +39,71 @@ ROUTED_VIRTUAL_NAMESERVER_V4 = "169.254.83.168"
 
 ENC_SEED_PARAMETERS = ["cpu_model", "rbd_pool"]
 
+# Pre-formatted tmp file systems, see `TmpSpec.apply_template()`.
+TMP_TEMPLATE_PREFIX = "fc-qemu-template.tmp."
+TMP_TEMPLATE_SNAPSHOT = "template"
+# Marks when a template build started ("building-<unix time>").
+TMP_TEMPLATE_BUILDING = "building-"
+# Incomplete templates older than this (seconds) were abandoned.
+TMP_TEMPLATE_BUILD_TIMEOUT = 3600
+# A new template gets locked and marked as building within this many
+# seconds after it has been created.
+TMP_TEMPLATE_CREATE_GRACE = 10
+# Increase when changing how tmp volumes are formatted.
+TMP_TEMPLATE_VERSION = 1
+
+
+def enc_seed_files(spec, enc, generation, compatibility_mode=False):
+    """Return the fc-data files to seed into a guest (path -> content)."""
+    files = {"fc-data/enc.json": json.dumps(enc) + "\n"}
+    # Seed boot-time VM properties which require a reboot to
+    # change. While some of these properties are copied from
+    # the ENC data, a separate file allows properties which
+    # are not exposed to guests through ENC to be added in the
+    # future.
+    properties = {}
+    properties["binary_generation"] = generation
+    for key in ENC_SEED_PARAMETERS:
+        if key in enc["parameters"]:
+            properties[key] = enc["parameters"][key]
+    spec.log.debug("guest-properties", properties=properties)
+    files["fc-data/qemu-guest-properties-booted"] = json.dumps(properties)
+
+    if compatibility_mode:
+        # For backwards compatibility with old fc-agent versions,
+        # write the Qemu binary generation into a separate file.
+        spec.log.debug("binary-generation", generation=generation)
+        files["fc-data/qemu-binary-generation-booted"] = str(generation) + "\n"
+    return files
+
+
+def write_seed_files(target, files):
+    for path, content in files.items():
+        path = target / path
+        if not path.parent.exists():
+            path.parent.mkdir()
+            path.parent.chmod(0o750)
+        path.touch(0o640 if path.name == "enc.json" else 0o666)
+        with path.open("w") as f:
+            f.write(content)
+
 
 def seed_enc(spec, enc, generation, compatibility_mode=False):
     spec.log.info("seed-fc")
     with spec.volume.mounted() as target:
         if compatibility_mode:
             target.chmod(0o1777)
-        fc_data = target / "fc-data"
-        fc_data.mkdir()
-        fc_data.chmod(0o750)
-        enc_json = fc_data / "enc.json"
-        enc_json.touch(0o640)
-        with enc_json.open("w") as f:
-            json.dump(enc, f)
-            f.write("\n")
-        # Seed boot-time VM properties which require a reboot to
-        # change. While some of these properties are copied from
-        # the ENC data, a separate file allows properties which
-        # are not exposed to guests through ENC to be added in the
-        # future.
-        properties = {}
-        properties["binary_generation"] = generation
-        for key in ENC_SEED_PARAMETERS:
-            if key in enc["parameters"]:
-                properties[key] = enc["parameters"][key]
-        spec.log.debug("guest-properties", properties=properties)
-        guest_properties = fc_data / "qemu-guest-properties-booted"
-        with guest_properties.open("w") as f:
-            json.dump(properties, f)
+        write_seed_files(
+            target, enc_seed_files(spec, enc, generation, compatibility_mode)
+        )
 
-        if compatibility_mode:
-            # For backwards compatibility with old fc-agent versions,
-            # write the Qemu binary generation into a separate file.
-            spec.log.debug("binary-generation", generation=generation)
-            generation_marker = fc_data / "qemu-binary-generation-booted"
-            with generation_marker.open("w") as f:
-                f.write(str(generation) + "\n")
+
+def tmp_template_name(size, mkfs_options):
+    """Name of the tmp template for a volume size and mkfs options."""
+    digest = hashlib.sha256(
+        f"{TMP_TEMPLATE_VERSION} {mkfs_options}".encode("utf-8")
+    ).hexdigest()
+    return f"{TMP_TEMPLATE_PREFIX}{size}.{digest[:12]}"
 
 
 def valid_rbd_pool_name(name):
@@ -83,6 +116,109 @@ def valid_rbd_pool_name(name):
     return False
 
 
+class ImageIndex:
+    """Know which images exist in which pools.
+
+    Each pool is listed at most once per Ceph session, so looking up where
+    the images of all specs live doesn't cost an `rbd info` per spec and
+    pool. Our own operations that create, remove, or move images must
+    invalidate the affected pools explicitly.
+
+    An index can `share` what another index knows, e.g. when handling
+    several VMs on the same host in one process. Shared indexes are not
+    reset when a Ceph session starts. As other hosts change images, too,
+    such an index should have a `ttl` (seconds) after which pools are
+    listed again.
+
+    """
+
+    def __init__(self, ceph, share=None, ttl=None):
+        self.ceph = ceph
+        self.shared = share is not None
+        if share is not None:
+            self._pools = share._pools
+            self._lock = share._lock
+            self.ttl = share.ttl
+        else:
+            self._pools = {}
+            self._lock = threading.Lock()
+            self.ttl = ttl
+
+    def _current(self, pool):
+        listed, images = self._pools.get(pool, (None, None))
+        if listed is None:
+            return None
+        if self.ttl is not None and time.monotonic() - listed > self.ttl:
+            return None
+        return images
+
+    def images(self, pool):
+        with self._lock:
+            images = self._current(pool)
+        if images is not None:
+            return images
+        # List without holding the lock so that pools can be listed
+        # concurrently.
+        listed = time.monotonic()
+        images = {
+            image
+            for image in self.ceph.rbd.list(self.ceph.ioctx(pool))
+            # Ignore snapshots (our test mocks list them).
+            if "@" not in image
+        }
+        with self._lock:
+            current = self._current(pool)
+            if current is not None:
+                return current
+            self._pools[pool] = (listed, images)
+            return images
+
+    def exists(self, pool, name):
+        return name in self.images(pool)
+
+    def pools_for(self, name):
+        return [pool for pool in self.ceph.ioctxs if self.exists(pool, name)]
+
+    def invalidate(self, pool=None):
+        with self._lock:
+            if pool is None:
+                self._pools.clear()
+            else:
+                self._pools.pop(pool, None)
+
+
+class BufferedLog:
+    """Record log calls to replay them later.
+
+    Used to keep the log output of concurrent per-volume operations in a
+    deterministic order.
+
+    """
+
+    def __init__(self, log, records=None):
+        self.log = log
+        self.records = [] if records is None else records
+
+    def bind(self, **kw):
+        return BufferedLog(self.log.bind(**kw), self.records)
+
+    def __getattr__(self, method):
+        def record(event=None, **kw):
+            if kw.get("exc_info") is True or (
+                method == "exception" and "exc_info" not in kw
+            ):
+                # The exception is gone by the time we replay.
+                kw["exc_info"] = sys.exc_info()
+            self.records.append((self.log, method, event, kw))
+
+        return record
+
+    def replay(self):
+        for log, method, event, kw in self.records:
+            getattr(log, method)(event, **kw)
+        self.records.clear()
+
+
 # This is an additional abstraction layer on top of generic Ceph volume
 # handling. When introducing the ability to migrate root volumes we had to
 # start differentiating between the abstract concept of "I need a
@@ -143,15 +279,7 @@ class VolumeSpecification:
         return self.ceph.volumes.get(self.suffix)
 
     def exists_in_pools(self):
-        result = []
-
-        for pool, ioctx in self.ceph.ioctxs.items():
-            try:
-                libceph.Image(ioctx, self.name)
-            except libceph.ImageNotFound:
-                continue
-            result.append(pool)
-        return result
+        return self.ceph.image_index.pools_for(self.name)
 
     def exists_in_desired_pool(self):
         """Check whether the image exists in the desired pool.
@@ -165,12 +293,7 @@ class VolumeSpecification:
         also exists in other pools.
 
         """
-        ioctx = self.ceph.ioctxs[self.desired_pool]
-        try:
-            libceph.Image(ioctx, self.name)
-        except libceph.ImageNotFound:
-            return False
-        return True
+        return self.ceph.image_index.exists(self.desired_pool, self.name)
 
     def exists_in_pool(self):
         """Show which pool the image currently exists in, independent
@@ -257,6 +380,8 @@ class RootSpec(VolumeSpecification):
                 f"rbd migration prepare {current_pool}/{self.name} "
                 f"{self.desired_pool}/{self.name}"
             )
+            self.ceph.image_index.invalidate(current_pool)
+            self.ceph.image_index.invalidate(self.desired_pool)
             # Ensure we now expose the correct volume.
             self.ceph.get_volume(self)
 
@@ -272,7 +397,10 @@ class RootSpec(VolumeSpecification):
         # We rely on the image being created in the CREATE_VM script as this
         # will perform necessary cloning (or other) operations from whatever
         # source it considers best.
-        self.cmd(self.ceph.CREATE_VM.format(**self.ceph.cfg))
+        # The command line is configured by the administrator and may rely
+        # on shell features.
+        self.cmd(self.ceph.CREATE_VM.format(**self.ceph.cfg), shell=True)
+        self.ceph.image_index.invalidate(self.desired_pool)
         self.ceph.get_volume(self)
         self.regen_xfs_uuid()
 
@@ -295,6 +423,7 @@ class RootSpec(VolumeSpecification):
             self.cmd(
                 f"rbd --no-progress migration commit {self.volume.fullname}",
             )
+            self.ceph.image_index.invalidate()
             return
         # Indicate that there is a migration pending.
         return migration
@@ -365,8 +494,15 @@ class TmpSpec(VolumeSpecification):
 
     def start(self):
         self.log.info("start-tmp")
+        from_template = self.ceph.TMP_TEMPLATE_CACHE and self.apply_template()
         with self.volume.mapped():
-            self.mkfs()
+            if from_template:
+                # Copies must not share the file system UUID, otherwise
+                # they can't be mounted at the same time.
+                self.volume.wait_for_part1dev()
+                self.cmd(f"xfs_admin -U generate {self.volume.part1dev}")
+            else:
+                self.mkfs()
             # XXX remove when all machines can read from cidata
             seed_enc(
                 self,
@@ -375,21 +511,155 @@ class TmpSpec(VolumeSpecification):
                 compatibility_mode=True,
             )
 
-    def mkfs(self):
-        self.log.debug("create-fs")
-        device = self.volume.device
+    def mkfs(self, volume=None):
+        volume = volume or self.volume
+        volume.log.debug("create-fs")
+        device = volume.device
         assert device, f"volume must be mapped first: {device}"
-        self.cmd(f'sgdisk -o "{device}"')
-        self.cmd(
+        volume.cmd(f'sgdisk -o "{device}"')
+        volume.cmd(
             f'sgdisk -a 8192 -n 1:8192:0 -c "1:{self.suffix}" '
             f'-t 1:8300 "{device}"'
         )
         # XXX remove when all machines can read from cidata
-        self.volume.wait_for_part1dev()
+        volume.wait_for_part1dev()
         options = getattr(self.ceph, "MKFS_XFS")
-        self.cmd(
-            f'mkfs.xfs {options} -L "{self.suffix}" {self.volume.part1dev}'
-        )
+        volume.cmd(f'mkfs.xfs {options} -L "{self.suffix}" {volume.part1dev}')
+
+    def apply_template(self):
+        """Copy the pre-formatted file system of the matching template.
+
+        The template is built if it doesn't exist yet. Returns whether the
+        volume has been formatted.
+
+        """
+        try:
+            template = self.template()
+            if template is None:
+                return False
+            self.log.info("apply-template", template=template.fullname)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = Path(tmpdir) / "template.diff"
+                template.rbdimage.export_diff(path)
+                diff = diskimage.overwrite_diff(path.read_bytes())
+            self.volume.rbdimage.import_diff(diff)
+        except Exception:
+            self.log.warning(
+                "apply-template-failed", action="mkfs", exc_info=True
+            )
+            return False
+        return True
+
+    def template(self):
+        """Return the snapshot of the template for this volume.
+
+        Returns None if the template is incomplete, e.g. because it is
+        being built by another host. Templates whose build was abandoned
+        are removed and built again.
+
+        """
+        pool = self.volume.ioctx.name
+        name = tmp_template_name(self.volume.size, self.ceph.MKFS_XFS)
+        if not self.ceph.image_index.exists(pool, name):
+            self.build_template(pool, name)
+        template = Volume(self.ceph, self.ceph.ioctx(pool), name)
+        try:
+            return template.snapshots[TMP_TEMPLATE_SNAPSHOT]
+        except KeyError:
+            pass
+        if self.template_abandoned(template):
+            template.log.info("template-abandoned", action="rebuild")
+            self.remove_template(template)
+            self.build_template(pool, name)
+            template = Volume(self.ceph, self.ceph.ioctx(pool), name)
+            try:
+                return template.snapshots[TMP_TEMPLATE_SNAPSHOT]
+            except KeyError:
+                pass
+        template.log.info("template-incomplete", action="mkfs")
+        return None
+
+    def template_abandoned(self, template):
+        # The builder can only mark the build after creating the image.
+        # Give it a moment before we call a template without a mark
+        # abandoned.
+        deadline = time.monotonic() + TMP_TEMPLATE_CREATE_GRACE
+        while (started := self.template_build_started(template)) is None:
+            if time.monotonic() > deadline:
+                return True
+            time.sleep(0.5)
+            template.snapshots.invalidate()
+        return time.time() - started > TMP_TEMPLATE_BUILD_TIMEOUT
+
+    def template_build_started(self, template):
+        """Return when the build of the template started or None."""
+        for snapshot in template.snapshots:
+            if not snapshot.snapname.startswith(TMP_TEMPLATE_BUILDING):
+                continue
+            try:
+                return int(snapshot.snapname[len(TMP_TEMPLATE_BUILDING) :])
+            except ValueError:
+                continue
+
+    def build_template(self, pool, name):
+        ioctx = self.ceph.ioctx(pool)
+        try:
+            self.ceph.rbd.create(ioctx, name, self.volume.size)
+        except libceph.ImageExists:
+            return
+        self.ceph.image_index.invalidate(pool)
+        template = Volume(self.ceph, ioctx, name)
+        template.log.info("build-template")
+        template.lock()
+        try:
+            building = f"{TMP_TEMPLATE_BUILDING}{int(time.time())}"
+            template.snapshots.create(building)
+            with template.mapped():
+                self.mkfs(template)
+            template.snapshots.create(TMP_TEMPLATE_SNAPSHOT)
+            template.snapshots[building].remove()
+        except Exception:
+            # Don't leave an incomplete template behind that keeps
+            # everyone else from using the cache.
+            template.log.warning(
+                "build-template-failed", action="remove", exc_info=True
+            )
+            try:
+                self.remove_template(template)
+            except Exception:
+                template.log.warning(
+                    "remove-template-failed", exc_info=True
+                )
+            raise
+        finally:
+            template.unlock()
+            template.close()
+        self.remove_outdated_templates(pool, name)
+
+    def remove_template(self, template):
+        template.unlock(force=True)
+        template.snapshots.purge()
+        template.close()
+        self.ceph.remove_volume(template.name, template.ioctx.name)
+
+    def remove_outdated_templates(self, pool, current):
+        """Remove templates that were built with different options."""
+        digest = current.rsplit(".", 1)[1]
+        for name in self.ceph.image_index.images(pool):
+            if not name.startswith(TMP_TEMPLATE_PREFIX):
+                continue
+            if name.endswith(f".{digest}"):
+                continue
+            template = Volume(self.ceph, self.ceph.ioctx(pool), name)
+            template.log.info("remove-outdated-template")
+            try:
+                template.snapshots.purge()
+                self.ceph.remove_volume(name, pool)
+            except Exception:
+                # Still in use, try again next time.
+                template.log.warning(
+                    "remove-outdated-template-failed", exc_info=True
+                )
 
 
 class CloudInitSpec(VolumeSpecification):
@@ -405,9 +675,28 @@ class CloudInitSpec(VolumeSpecification):
 
     def start(self):
         self.log.info("start-cloud-init")
-        with self.volume.mapped():
-            self.mkfs()
-            self.seed(self.ceph.enc, self.ceph.cfg["binary_generation"])
+        files = self.seed_files(
+            self.ceph.enc, self.ceph.cfg["binary_generation"]
+        )
+        try:
+            image = diskimage.partitioned_fat_image(
+                self.volume.size,
+                self.suffix,
+                {
+                    path: content.encode("utf-8")
+                    for path, content in files.items()
+                },
+            )
+        except ValueError as e:
+            # Unusual volume sizes are left to the real tools.
+            self.log.warning("build-image-failed", reason=str(e), action="mkfs")
+            with self.volume.mapped():
+                self.mkfs()
+                with self.volume.mounted() as target:
+                    write_seed_files(target, files)
+            return
+        self.log.debug("write-image")
+        self.volume.rbdimage.import_diff(diskimage.encode_diff(image))
 
     def mkfs(self):
         self.log.debug("create-fs")
@@ -422,12 +711,15 @@ class CloudInitSpec(VolumeSpecification):
             f'mkfs.vfat {options} -n "{self.suffix}" {self.volume.part1dev}'
         )
 
-    def seed(self, enc, generation):
-        seed_enc(self, enc, generation)
+    def seed_files(self, enc, generation):
+        """Return all files to seed into the volume (path -> content)."""
+        self.log.info("seed-fc")
+        files = enc_seed_files(self, enc, generation)
         if enc["parameters"]["environment_class_type"] == "cloudinit":
-            self.seed_cloud_init(enc)
+            files.update(self.cloud_init_files(enc))
+        return files
 
-    def seed_cloud_init(self, enc):
+    def cloud_init_files(self, enc):
         self.log.info("seed-cloud-init")
         managed_files = [
             {
@@ -440,7 +732,11 @@ class CloudInitSpec(VolumeSpecification):
         rg = enc["parameters"]["resource_group"]
         users_file = Path(f"/etc/qemu/users/{rg}.json")
         if not users_file.exists():
-            directory = fc.qemu.directory.connect(ring="max")
+            import xmlrpc.client
+
+            from fc.qemu import directory as fc_directory
+
+            directory = fc_directory.connect(ring="max")
             try:
                 users = directory.list_users(rg)
                 Path("/etc/qemu/users").mkdir(exist_ok=True)
@@ -470,96 +766,84 @@ class CloudInitSpec(VolumeSpecification):
             }
         )
 
-        with self.volume.mounted() as target:
-            metadata = target / "meta-data"
-            metadata.touch()
-            with metadata.open("w") as f:
-                yaml.safe_dump({"instance-id": enc["name"]}, f)
-            userdata = target / "user-data"
-            userdata.touch()
-            with userdata.open("w") as f:
-                f.write("#cloud-config\n")
-                yaml.safe_dump(
-                    {
-                        "allow_public_ssh_keys": True,
-                        "ssh_pwauth": False,
-                        "disable_root": False,
-                        "package_update": True,
-                        "package_upgrade": True,
-                        "packages": ["qemu-guest-agent"],
-                        "hostname": enc["name"],
-                        "updates": {
-                            "network": {
-                                "when": ["boot-new-instance", "boot"],
-                            },
-                        },
-                        # don't create ubuntu user, but only root
-                        "users": [{"name": "root"}],
-                        "write_files": managed_files,
-                        "runcmd": [
-                            "systemctl enable --now qemu-guest-agent",
-                            "systemctl restart ssh",
-                        ],
+        files = {}
+        files["meta-data"] = yaml.safe_dump({"instance-id": enc["name"]})
+        files["user-data"] = "#cloud-config\n" + yaml.safe_dump(
+            {
+                "allow_public_ssh_keys": True,
+                "ssh_pwauth": False,
+                "disable_root": False,
+                "package_update": True,
+                "package_upgrade": True,
+                "packages": ["qemu-guest-agent"],
+                "hostname": enc["name"],
+                "updates": {
+                    "network": {
+                        "when": ["boot-new-instance", "boot"],
                     },
-                    f,
+                },
+                # don't create ubuntu user, but only root
+                "users": [{"name": "root"}],
+                "write_files": managed_files,
+                "runcmd": [
+                    "systemctl enable --now qemu-guest-agent",
+                    "systemctl restart ssh",
+                ],
+            },
+        )
+        networkconfig = {"version": 1, "config": []}
+        for ifacename, ifaceconfig in enc["parameters"]["interfaces"].items():
+            cfg = {
+                "type": "physical",
+                "name": "eth" + ifacename,
+                "mac_address": ifaceconfig["mac"],
+                "accept-ra": False,
+                "subnets": [],
+            }
+            for net, netconfig in ifaceconfig["networks"].items():
+                if not netconfig:
+                    continue
+                ip_network = ipaddress.ip_network(net)
+                type_ = "static" if ip_network.version == 4 else "static6"
+                prefixlen = (
+                    ip_network.max_prefixlen
+                    if ifaceconfig["routed"]
+                    else ip_network.prefixlen
                 )
-            networkconfig_path = target / "network-config"
-            networkconfig_path.touch()
-            networkconfig = {"version": 1, "config": []}
-            for ifacename, ifaceconfig in enc["parameters"][
-                "interfaces"
-            ].items():
-                cfg = {
-                    "type": "physical",
-                    "name": "eth" + ifacename,
-                    "mac_address": ifaceconfig["mac"],
-                    "accept-ra": False,
-                    "subnets": [],
-                }
-                for net, netconfig in ifaceconfig["networks"].items():
-                    if not netconfig:
+                match (ifaceconfig["routed"], ip_network.version):
+                    case (False, 4):
+                        gateway = ifaceconfig["gateways"][net]
+                        nameservers = ["9.9.9.9", "8.8.8.8"]
+                    case (False, 6):
+                        gateway = ifaceconfig["gateways"][net]
+                        nameservers = [
+                            "2620:fe::fe",
+                            "2001:4860:4860::8888",
+                        ]
+                    case (True, 4):
+                        gateway = ROUTED_VIRTUAL_GATEWAY_V4
+                        nameservers = [ROUTED_VIRTUAL_NAMESERVER_V4]
+                    case (True, 6):
+                        gateway = ROUTED_VIRTUAL_GATEWAY_V6
+                        nameservers = (
+                            [str(ip_network[1])]
+                            if ip_network.num_addresses >= 4
+                            else []
+                        )
+                    case _:
                         continue
-                    ip_network = ipaddress.ip_network(net)
-                    type_ = "static" if ip_network.version == 4 else "static6"
-                    prefixlen = (
-                        ip_network.max_prefixlen
-                        if ifaceconfig["routed"]
-                        else ip_network.prefixlen
+                for address in netconfig:
+                    cfg["subnets"].append(
+                        {
+                            "type": type_,
+                            "address": f"{address}/{prefixlen}",
+                            "gateway": gateway,
+                            "dns_nameservers": nameservers,
+                        }
                     )
-                    match (ifaceconfig["routed"], ip_network.version):
-                        case (False, 4):
-                            gateway = ifaceconfig["gateways"][net]
-                            nameservers = ["9.9.9.9", "8.8.8.8"]
-                        case (False, 6):
-                            gateway = ifaceconfig["gateways"][net]
-                            nameservers = [
-                                "2620:fe::fe",
-                                "2001:4860:4860::8888",
-                            ]
-                        case (True, 4):
-                            gateway = ROUTED_VIRTUAL_GATEWAY_V4
-                            nameservers = [ROUTED_VIRTUAL_NAMESERVER_V4]
-                        case (True, 6):
-                            gateway = ROUTED_VIRTUAL_GATEWAY_V6
-                            nameservers = (
-                                [str(ip_network[1])]
-                                if ip_network.num_addresses >= 4
-                                else []
-                            )
-                        case _:
-                            continue
-                    for address in netconfig:
-                        cfg["subnets"].append(
-                            {
-                                "type": type_,
-                                "address": f"{address}/{prefixlen}",
-                                "gateway": gateway,
-                                "dns_nameservers": nameservers,
-                            }
-                        )
-                networkconfig["config"].append(cfg)
-            with networkconfig_path.open("w") as f:
-                yaml.safe_dump(networkconfig, f)
+            networkconfig["config"].append(cfg)
+        files["network-config"] = yaml.safe_dump(networkconfig)
+        return files
 
 
 class SwapSpec(VolumeSpecification):
@@ -575,8 +859,14 @@ class SwapSpec(VolumeSpecification):
 
     def start(self):
         self.log.info("start-swap")
-        with self.volume.mapped():
-            self.cmd(f'mkswap -f -L "{self.suffix}" {self.volume.device}')
+        # Writing the signature directly avoids mapping the volume just to
+        # run mkswap on it.
+        image = diskimage.SparseImage(self.volume.size)
+        image.write(0, diskimage.swap_header(image.size, self.suffix))
+        self.log.debug("write-image")
+        self.volume.rbdimage.import_diff(
+            diskimage.encode_diff(image, discard=False)
+        )
 
 
 class Ceph(object):
@@ -585,6 +875,14 @@ class Ceph(object):
     # support testing.
 
     CREATE_VM = None
+    CEPH_BACKEND = "auto"
+    CEPH_BROKER_SOCKET = ""
+    CEPH_POOL_CACHE = ""
+    CEPH_POOL_CACHE_TTL = 300
+    TMP_TEMPLATE_CACHE = False
+
+    # Upper bound for per-volume operations running concurrently.
+    VOLUME_WORKERS = 4
 
     # Those are two different representations of the disks/volumes we manage.
     # The can be treated from client code as well-known structures, so that
@@ -614,6 +912,9 @@ class Ceph(object):
         self.rados = None
         self.ioctxs: Dict[str, libceph.Ioctx] = {}
         self.rbd = libceph.RBD()
+        self.image_index = ImageIndex(self)
+        # Lock status of our volumes by full name, see `Volume.lock_status`.
+        self.lock_statuses = {}
 
         self.specs = {}
         self.volumes = {}
@@ -627,8 +928,15 @@ class Ceph(object):
             conffile=self.CEPH_CONF,
             name="client." + self.CEPH_CLIENT,
             log=self.log,
+            backend=self.CEPH_BACKEND,
+            broker_socket=self.CEPH_BROKER_SOCKET,
+            pool_cache=self.CEPH_POOL_CACHE,
+            pool_cache_ttl=self.CEPH_POOL_CACHE_TTL,
         )
 
+        if not self.image_index.shared:
+            self.image_index.invalidate()
+        self.lock_statuses.clear()
         RootSpec(self)
         SwapSpec(self)
         TmpSpec(self)
@@ -644,19 +952,77 @@ class Ceph(object):
         for ioctx in self.ioctxs.values():
             ioctx.close()
         self.ioctxs.clear()
+        self.lock_statuses.clear()
         self.attached = False
 
     def attach_volumes(self):
         if self.attached:
             return
+        self._open_pools()
+        # List all pools concurrently before looking for our images.
+        self._raise_first_error(
+            self._for_each(self.ioctxs, self.image_index.images)
+        )
+        for spec in self.specs.values():
+            self.get_volume(spec)
+        self.attached = True
+
+    def _open_pools(self):
         # Keep open ioctx handles to all relevant pools.
         for pool_name in self.rados.list_pools():
             if not valid_rbd_pool_name(pool_name):
                 continue
             self.ioctxs[pool_name] = self.rados.open_ioctx(pool_name)
-        for spec in self.specs.values():
-            self.get_volume(spec)
-        self.attached = True
+
+    def ioctx(self, pool):
+        """Return the handle of a pool.
+
+        The list of pools is cached across processes. Re-read it if the
+        pool is unknown, e.g. if it has been created recently.
+
+        """
+        if pool not in self.ioctxs:
+            self.log.debug("unknown-pool", pool=pool, action="refresh")
+            self.rados.invalidate_pools()
+            self._open_pools()
+        return self.ioctxs[pool]
+
+    def _for_each(self, items, operation):
+        """Run `operation` for all items concurrently.
+
+        The log output of volumes is replayed in the order of the items
+        once all operations finished.
+
+        Returns a list of `(item, result, exception)`.
+
+        """
+        items = list(items)
+        buffers = {}
+        for item in items:
+            if isinstance(item, Volume):
+                buffers[id(item)] = item.log
+                item.log = BufferedLog(item.log)
+
+        def run(item):
+            try:
+                return item, operation(item), None
+            except Exception as e:
+                return item, None, e
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.VOLUME_WORKERS) as pool:
+                results = list(pool.map(run, items))
+        finally:
+            for item in items:
+                if id(item) in buffers:
+                    buffered, item.log = item.log, buffers[id(item)]
+                    buffered.replay()
+        return results
+
+    def _raise_first_error(self, results):
+        errors = [e for _, _, e in results if e is not None]
+        if errors:
+            raise errors[0]
 
     def start(self):
         """Perform Ceph-related tasks before starting a VM."""
@@ -691,17 +1057,14 @@ class Ceph(object):
             spec.ensure()
 
     def ensure_volume_presence(self, name, pool, size):
-        for ioctx in self.ioctxs.values():
-            try:
-                libceph.Image(ioctx, name)
-            except libceph.ImageNotFound:
-                continue
-            else:
-                return
-        self.rbd.create(self.ioctxs[pool], name, size)
+        if self.image_index.pools_for(name):
+            return
+        self.rbd.create(self.ioctx(pool), name, size)
+        self.image_index.invalidate(pool)
 
     def remove_volume(self, name, pool):
-        self.rbd.remove(self.ioctxs[pool], name)
+        self.rbd.remove(self.ioctx(pool), name)
+        self.image_index.invalidate(pool)
 
     def get_volume(self, spec):
         """(Re-)Attach a volume object for a spec."""
@@ -717,7 +1080,7 @@ class Ceph(object):
         if not current_pool:
             return
         self.volumes[spec.suffix] = volume = Volume(
-            self, self.ioctxs[current_pool], spec.name
+            self, self.ioctx(current_pool), spec.name
         )
         return volume
 
@@ -732,12 +1095,28 @@ class Ceph(object):
 
     def status(self):
         # Report status for CLI usage
+        self.refresh_locks()
+        # Query the locks concurrently, the reports use the cached status.
+        self._raise_first_error(
+            self._for_each(self.opened_volumes, Volume.lock_status)
+        )
         for spec in self.specs.values():
             spec.status()
 
-    def locks(self):
+    def refresh_locks(self):
+        """Query the lock status of all volumes again on next use.
+
+        Lock status is cached per volume during a Ceph session. Call this
+        whenever other hosts may have changed locks within a session.
+
+        """
         for volume in self.opened_volumes:
-            status = volume.lock_status()
+            volume.refresh()
+
+    def locks(self):
+        results = self._for_each(self.opened_volumes, Volume.lock_status)
+        self._raise_first_error(results)
+        for volume, status, _ in results:
             if not status:
                 continue
             yield volume.name, status[1]
@@ -775,8 +1154,9 @@ class Ceph(object):
         return lock_owners.pop()
 
     def lock(self):
-        for volume in self.opened_volumes:
-            volume.lock()
+        self._raise_first_error(
+            self._for_each(self.opened_volumes, Volume.lock)
+        )
 
     def unlock(self):
         """Remove all of *our* volume locks.
@@ -786,21 +1166,26 @@ class Ceph(object):
 
         This leaves other hosts' locks in place.
         """
-        exception = False
-        for volume in self.opened_volumes:
+
+        def unlock(volume):
             try:
                 volume.unlock()
             except Exception:
                 volume.log.warning("unlock-failed", exc_info=True)
-                exception = True
-        if exception:
+                raise
+
+        results = self._for_each(self.opened_volumes, unlock)
+        if any(e is not None for _, _, e in results):
             raise RuntimeError(
                 "Failed to unlock all locks. See log for specific exceptions."
             )
 
     def force_unlock(self):
-        for volume in self.opened_volumes:
-            volume.unlock(force=True)
+        self._raise_first_error(
+            self._for_each(
+                self.opened_volumes, lambda volume: volume.unlock(force=True)
+            )
+        )
 
     def auth_cookie(self):
         """This is a cookie that can be used to validate that a party
@@ -808,6 +1193,8 @@ class Ceph(object):
 
         Used to authenticate migration requests.
         """
+        # Both sides need to see the actual (uncached) lock owners.
+        self.refresh_locks()
         c = hashlib.sha1()
         for key in ["root", "swap", "tmp"]:
             # This order needs to stay stable to support the auth cookie
@@ -0,0 +1,280 @@
+"""Host-local broker for Ceph operations.
+
+Every fc-qemu invocation is a short-lived process that would otherwise
+have to open its own monitor sessions. The broker is a long-running
+process that keeps a warm cluster connection (and pool handles) and
+serves the libceph backend operations over a unix socket.
+
+The protocol is line-based JSON: a request is an object with the
+operation name and its positional arguments, the response carries either
+the result or a description of the exception to re-raise on the client
+side.
+
+"""
+
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import threading
+from pathlib import Path
+
+from .libceph import CLIBackend, ImageBusy, ImageExists, ImageNotFound
+
+# Operations of the backend interface that may be called remotely.
+OPERATIONS = {
+    "list_pools",
+    "list_images",
+    "image_info",
+    "create",
+    "remove",
+    "resize",
+    "lock_add",
+    "lock_list",
+    "lock_remove",
+    "snap_list",
+    "snap_create",
+    "snap_remove",
+}
+
+# Operations that don't change anything. Only those are repeated by the
+# fallback if the broker goes away after receiving the request: it may
+# have executed it already.
+READ_ONLY_OPERATIONS = {
+    "list_pools",
+    "list_images",
+    "image_info",
+    "lock_list",
+    "snap_list",
+}
+
+EXCEPTIONS = {
+    "ImageNotFound": ImageNotFound,
+    "ImageBusy": ImageBusy,
+    "ImageExists": ImageExists,
+}
+
+
+class BrokerUnavailable(Exception):
+    pass
+
+
+class BrokerError(Exception):
+    """An unexpected exception on the broker side."""
+
+
+def encode_exception(e):
+    if isinstance(e, subprocess.CalledProcessError):
+        return {
+            "type": "CalledProcessError",
+            "returncode": e.returncode,
+            "cmd": e.cmd,
+            "output": e.output,
+        }
+    name = e.__class__.__name__
+    if name in EXCEPTIONS or isinstance(e, OSError):
+        return {"type": name, "args": list(e.args)}
+    return {"type": "BrokerError", "args": [repr(e)]}
+
+
+def decode_exception(error):
+    if error["type"] == "CalledProcessError":
+        return subprocess.CalledProcessError(
+            returncode=error["returncode"],
+            cmd=error["cmd"],
+            output=error["output"],
+        )
+    if error["type"] in EXCEPTIONS:
+        return EXCEPTIONS[error["type"]](*error["args"])
+    if error["type"] == "BrokerError":
+        return BrokerError(*error["args"])
+    return OSError(*error["args"])
+
+
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        self.server.connections.discard(self.connection)
+        super().finish()
+
+    def handle(self):
+        backend = self.server.backend
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request["op"]
+                if op not in OPERATIONS:
+                    raise ValueError(f"Unknown operation: {op}")
+                response = {"result": getattr(backend, op)(*request["args"])}
+            except Exception as e:
+                response = {"error": encode_exception(e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class BrokerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, backend, log):
+        self.path = Path(path)
+        self.backend = backend
+        self.log = log.bind(subsystem="ceph-broker")
+        self.connections = set()
+        with contextlib.suppress(FileNotFoundError):
+            self.path.unlink()
+        # Nobody else may connect, not even before we could chmod.
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(self.path), BrokerRequestHandler)
+        finally:
+            os.umask(umask)
+        self.path.chmod(0o600)
+
+    def server_close(self):
+        super().server_close()
+        # Let clients notice immediately so they can fall back.
+        for connection in list(self.connections):
+            with contextlib.suppress(OSError):
+                connection.shutdown(socket.SHUT_RDWR)
+        with contextlib.suppress(FileNotFoundError):
+            self.path.unlink()
+
+
+@contextlib.contextmanager
+def running_broker(path, backend, log):
+    """Run a broker in a background thread.
+
+    This serves as a local stand-in for the broker daemon.
+
+    """
+    server = BrokerServer(path, backend, log)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+class BrokerBackend:
+    """Backend that forwards all operations to the broker.
+
+    Connections are kept per thread. If the broker can not be reached the
+    operation is executed by the fallback backend instead. If the
+    connection breaks after sending a request, only read-only operations
+    are repeated by the fallback, others raise `BrokerUnavailable`.
+
+    """
+
+    kind = "broker"
+
+    def __init__(self, path, log, fallback):
+        self.path = str(path)
+        self.log = log
+        self._fallback = fallback
+        self._fallback_backend = None
+        self._local = threading.local()
+
+    @property
+    def fallback(self):
+        if self._fallback_backend is None:
+            self._fallback_backend = self._fallback()
+        return self._fallback_backend
+
+    def _closed_by_peer(self):
+        try:
+            data = self._local.sock.recv(
+                1, socket.MSG_PEEK | socket.MSG_DONTWAIT
+            )
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        # We never have unread data between requests.
+        return data == b""
+
+    def _connection(self):
+        if getattr(self._local, "file", None) is not None:
+            # The broker may have been restarted since the last request.
+            if self._closed_by_peer():
+                self._disconnect()
+        if getattr(self._local, "file", None) is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError as e:
+                sock.close()
+                raise BrokerUnavailable(str(e))
+            self._local.sock = sock
+            self._local.file = sock.makefile("rwb")
+        return self._local.file
+
+    def _disconnect(self):
+        if getattr(self._local, "file", None) is None:
+            return
+        with contextlib.suppress(OSError):
+            self._local.file.close()
+        self._local.sock.close()
+        self._local.file = self._local.sock = None
+
+    def _call(self, op, *args):
+        try:
+            conn = self._connection()
+        except BrokerUnavailable as e:
+            self.log.debug("ceph-broker-unavailable", op=op, reason=str(e))
+            return getattr(self.fallback, op)(*args)
+        try:
+            conn.write(
+                json.dumps({"op": op, "args": args}).encode("utf-8") + b"\n"
+            )
+            conn.flush()
+            line = conn.readline()
+            if not line:
+                raise BrokerUnavailable("connection closed")
+        except (BrokerUnavailable, OSError) as e:
+            self._disconnect()
+            if op not in READ_ONLY_OPERATIONS:
+                self.log.warning("ceph-broker-failed", op=op, reason=str(e))
+                raise BrokerUnavailable(f"{op}: {e}") from e
+            self.log.debug("ceph-broker-unavailable", op=op, reason=str(e))
+            return getattr(self.fallback, op)(*args)
+        response = json.loads(line)
+        if "error" in response:
+            raise decode_exception(response["error"])
+        return response["result"]
+
+    def __getattr__(self, op):
+        if op not in OPERATIONS:
+            raise AttributeError(op)
+        return lambda *args: self._call(op, *args)
+
+    def shutdown(self):
+        self._disconnect()
+
+
+def serve(path, conffile, name, log):
+    """Run the broker until interrupted."""
+    from .libceph import open_native_backend
+
+    backend = open_native_backend(conffile, name, log)
+    if backend is None:
+        # Relaying to the CLI keeps clients working without the shared
+        # libraries, although it doesn't save any monitor sessions.
+        backend = CLIBackend(conffile, name, log)
+    log.info("ceph-broker-start", socket=str(path), backend=backend.kind)
+    server = BrokerServer(path, backend, log)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        backend.shutdown()
+        log.info("ceph-broker-stop")
@@ -1,5 +1,4 @@
 import itertools
-import os
 import subprocess
 
 from fc.qemu.timeout import TimeOut, TimeoutError
@@ -7,8 +6,6 @@ from fc.qemu.util import log
 
 from .qemu import Qemu
 
-FNULL = open(os.devnull, "w")
-
 
 class Model(object):
 
@@ -161,8 +158,8 @@ def scan_cpus(host=None):
                 "-nodefaults",
             ],
             stdin=subprocess.PIPE,
-            stdout=FNULL,
-            stderr=FNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
             encoding="ascii",
             errors="replace",
         )
@@ -0,0 +1,145 @@
+"""Wait for device nodes to appear.
+
+Device nodes (and the symlinks pointing to them) show up asynchronously
+after `rbd map` or `partprobe`: udev has to process the kernel events
+first. Instead of polling for them we watch the directories involved
+with inotify and only check again when something changed in there.
+
+Directories that do not exist yet (e.g. `/dev/rbd/<pool>` for the first
+image mapped from a pool) are covered by watching their nearest existing
+parent and descending as soon as they get created.
+
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+from pathlib import Path
+
+from ..timeout import TimeoutError
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+WATCH_MASK = IN_ATTRIB | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# Upper bound for sleeping between checks. This protects us against
+# events we can not see, e.g. if a watched directory gets replaced.
+SAFETY_INTERVAL = 1
+
+# Interval for checking if inotify is not available.
+POLL_INTERVAL = 0.1
+
+_libc = None
+
+
+def libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+        )
+    return _libc
+
+
+def nearest_directory(path):
+    for parent in path.parents:
+        if parent.is_dir():
+            return parent
+
+
+class Inotify(object):
+    """Minimal inotify wrapper that only tells us *that* something changed."""
+
+    def __init__(self):
+        try:
+            self.fd = libc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise OSError(str(e))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+
+    def watch(self, paths):
+        """Watch the nearest existing directories of all paths.
+
+        Repeat until the set is stable so that directories created while
+        we were adding watches are not missed.
+
+        """
+        while True:
+            directories = {nearest_directory(p) for p in paths}
+            new = directories - self.watched - {None}
+            if not new:
+                return
+            for directory in new:
+                wd = libc().inotify_add_watch(
+                    self.fd, os.fsencode(directory), WATCH_MASK
+                )
+                if wd < 0:
+                    raise OSError(
+                        ctypes.get_errno(), "inotify_add_watch failed"
+                    )
+                self.watched.add(directory)
+
+    def wait(self, timeout):
+        """Wait until an event arrives and drain all pending events."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except BlockingIOError:
+                break
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def wait_for(paths, timeout, check=Path.exists, interval=SAFETY_INTERVAL):
+    """Wait until one of `paths` passes `check` and return it.
+
+    Checks again at least every `interval` seconds, use a short interval
+    for checks whose outcome can change without an inotify event.
+
+    Raises `TimeoutError` if none did within `timeout` seconds.
+
+    """
+    paths = [Path(p) for p in paths]
+    deadline = time.monotonic() + timeout
+    try:
+        inotify = Inotify()
+    except OSError:
+        inotify = None
+    try:
+        while True:
+            if inotify is not None:
+                # Add watches *before* checking to avoid losing events.
+                try:
+                    inotify.watch(paths)
+                except OSError:
+                    inotify.close()
+                    inotify = None
+            for path in paths:
+                if check(path):
+                    return path
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    "Timed out waiting for " + ", ".join(map(str, paths))
+                )
+            if inotify is not None:
+                inotify.wait(min(remaining, interval))
+            else:
+                time.sleep(min(remaining, interval, POLL_INTERVAL))
+    finally:
+        if inotify is not None:
+            inotify.close()
@@ -0,0 +1,599 @@
+"""Build small disk images in user space.
+
+Seeding the cloud-init volume used to require mapping the image,
+partitioning it with `sgdisk`, waiting for udev to pick up the partition,
+running `mkfs.vfat`, mounting it, writing a handful of files and
+unmapping it again. This module builds an equivalent image (a GPT with a
+single FAT partition) in memory instead, which can then be written to
+Ceph with a single `rbd import-diff`.
+
+Only what we need is supported: a single partition, FAT12/16 with long
+file names and small files in a shallow directory tree.
+
+The helpers for the `rbd export-diff` format are also used to copy
+pre-formatted tmp file systems from their templates and to write swap
+signatures without mapping the volume.
+
+"""
+
+import itertools
+import os
+import resource
+import string
+import struct
+import time
+import uuid
+import zlib
+
+SECTOR = 512
+
+# First sector of the partition: 1 MiB aligned, like sgdisk does.
+PARTITION_START = 2048
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+GPT_ENTRY_SECTORS = GPT_ENTRIES * GPT_ENTRY_SIZE // SECTOR
+LINUX_FILESYSTEM = uuid.UUID("0fc63daf-8483-4772-8e79-3d69d8477de4")
+
+RESERVED_SECTORS = 1
+FAT_COUNT = 2
+ROOT_ENTRIES = 512
+DIR_ENTRY_SIZE = 32
+ROOT_SECTORS = ROOT_ENTRIES * DIR_ENTRY_SIZE // SECTOR
+MEDIA_DESCRIPTOR = 0xF8
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+
+# Characters allowed in 8.3 names besides letters and digits.
+SHORT_NAME_CHARS = set(
+    string.ascii_uppercase + string.digits + "!#$%&'()-@^_`{}~"
+)
+LONG_NAME_CHARS_PER_ENTRY = 13
+
+SWAP_MAGIC = b"SWAPSPACE2"
+SWAP_BOOTBITS = 1024
+SWAP_LABEL_SIZE = 16
+
+DIFF_HEADER = b"rbd diff v1\n"
+
+# Default RBD object size. Discarding whole objects reliably zeroes them,
+# partial discards may be skipped by librbd.
+OBJECT_SIZE = 4 * 1024 * 1024
+
+
+class SparseImage(object):
+    """A disk image that only stores the areas that have been written."""
+
+    def __init__(self, size):
+        if size % SECTOR:
+            raise ValueError(f"Image size must be a multiple of {SECTOR}")
+        self.size = size
+        self._extents = {}
+
+    def write(self, offset, data):
+        if offset < 0 or offset + len(data) > self.size:
+            raise ValueError(
+                f"Write at {offset} ({len(data)} bytes) exceeds image size"
+            )
+        self._extents[offset] = bytes(data)
+
+    def extents(self):
+        """Return (offset, data) tuples ordered by offset."""
+        return sorted(self._extents.items())
+
+
+def write_gpt(image, name, disk_guid=None, partition_guid=None):
+    """Write a GPT with one partition spanning the usable space.
+
+    Returns the first and last sector of the partition.
+
+    """
+    disk_guid = disk_guid or uuid.uuid4()
+    partition_guid = partition_guid or uuid.uuid4()
+    sectors = image.size // SECTOR
+    first_usable = 2 + GPT_ENTRY_SECTORS
+    last_usable = sectors - GPT_ENTRY_SECTORS - 2
+    if last_usable < PARTITION_START:
+        raise ValueError(f"Image too small for a partition: {image.size}")
+
+    entries = struct.pack(
+        "<16s16sQQQ72s",
+        LINUX_FILESYSTEM.bytes_le,
+        partition_guid.bytes_le,
+        PARTITION_START,
+        last_usable,
+        0,
+        name.encode("utf-16-le"),
+    ).ljust(GPT_ENTRIES * GPT_ENTRY_SIZE, b"\0")
+
+    def header(current, backup, entries_start):
+        header = struct.pack(
+            "<8sIIIIQQQQ16sQIII",
+            b"EFI PART",
+            0x00010000,
+            92,
+            0,  # CRC, see below
+            0,
+            current,
+            backup,
+            first_usable,
+            last_usable,
+            disk_guid.bytes_le,
+            entries_start,
+            GPT_ENTRIES,
+            GPT_ENTRY_SIZE,
+            zlib.crc32(entries),
+        )
+        crc = struct.pack("<I", zlib.crc32(header))
+        return header[:16] + crc + header[20:]
+
+    # Protective MBR
+    mbr = bytearray(SECTOR)
+    mbr[446:462] = struct.pack(
+        "<B3sB3sII",
+        0,
+        b"\x00\x02\x00",
+        0xEE,
+        b"\xff\xff\xff",
+        1,
+        min(sectors - 1, 0xFFFFFFFF),
+    )
+    mbr[510:512] = b"\x55\xaa"
+    image.write(0, mbr)
+
+    backup_entries = sectors - 1 - GPT_ENTRY_SECTORS
+    image.write(1 * SECTOR, header(1, sectors - 1, 2))
+    image.write(2 * SECTOR, entries)
+    image.write(backup_entries * SECTOR, entries)
+    image.write((sectors - 1) * SECTOR, header(sectors - 1, 1, backup_entries))
+    return PARTITION_START, last_usable
+
+
+def fat_layout(sectors):
+    """Determine FAT type and geometry for a file system size.
+
+    Returns (fat bits, sectors per cluster, sectors per FAT, clusters).
+    Prefers small clusters.
+
+    """
+    for sectors_per_cluster in [1, 2, 4, 8, 16, 32, 64]:
+        # The FAT type is determined by the number of clusters only.
+        for bits, min_clusters, max_clusters in [
+            (12, 1, 4084),
+            (16, 4085, 65524),
+        ]:
+            fat_sectors = 1
+            while True:
+                data_sectors = (
+                    sectors
+                    - RESERVED_SECTORS
+                    - FAT_COUNT * fat_sectors
+                    - ROOT_SECTORS
+                )
+                clusters = data_sectors // sectors_per_cluster
+                # Two reserved entries at the start of the FAT.
+                needed = -(-((clusters + 2) * bits) // (8 * SECTOR))
+                if needed <= fat_sectors:
+                    break
+                fat_sectors = needed
+            if min_clusters <= clusters <= max_clusters:
+                return bits, sectors_per_cluster, fat_sectors, clusters
+    raise ValueError(f"Unsupported FAT file system size: {sectors} sectors")
+
+
+def short_name(name, existing):
+    """Generate a unique 8.3 alias for a long file name."""
+    base, dot, ext = name.upper().lstrip(".").rpartition(".")
+    if not dot:
+        base, ext = ext, ""
+
+    def clean(part):
+        return "".join(
+            c if c in SHORT_NAME_CHARS else "_" for c in part if c not in " ."
+        )
+
+    base, ext = clean(base) or "_", clean(ext)[:3]
+    for i in itertools.count(1):
+        tail = f"~{i}"
+        candidate = (base[: 8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+        candidate = candidate.encode("ascii")
+        if candidate not in existing:
+            existing.add(candidate)
+            return candidate
+
+
+def long_name_entries(name, short):
+    """Return the VFAT long name entries for `name` in on-disk order."""
+    checksum = 0
+    for byte in short:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+    units = name.encode("utf-16-le")
+    size = 2 * LONG_NAME_CHARS_PER_ENTRY
+    count = -(-len(units) // size)
+    # NUL-terminated unless the name fills the last entry, padded with 0xFFFF
+    padded = (units + b"\0\0")[: count * size].ljust(count * size, b"\xff")
+    entries = []
+    for i in range(count):
+        part = padded[i * size : (i + 1) * size]
+        sequence = i + 1
+        if sequence == count:
+            sequence |= 0x40
+        entries.append(
+            struct.pack(
+                "<B10sBBB12sH4s",
+                sequence,
+                part[:10],
+                ATTR_LONG_NAME,
+                0,
+                checksum,
+                part[10:22],
+                0,
+                part[22:],
+            )
+        )
+    return list(reversed(entries))
+
+
+def directory_entry_count(tree, root=False):
+    # Volume label or "." and ".."
+    count = 1 if root else 2
+    for name in tree:
+        units = len(name.encode("utf-16-le")) // 2
+        count += -(-units // LONG_NAME_CHARS_PER_ENTRY) + 1
+    return count
+
+
+class FATFilesystem(object):
+    """Lay out a FAT12/16 file system within a sparse image.
+
+    Files are given as a mapping of slash-separated paths to their content
+    (bytes). Directories are created implicitly. All data is stored
+    contiguously.
+
+    """
+
+    def __init__(
+        self,
+        image,
+        offset,
+        sectors,
+        label,
+        hidden_sectors=0,
+        volume_id=None,
+        timestamp=None,
+    ):
+        if len(label) > 11:
+            raise ValueError(f"Label too long: {label}")
+        self.image = image
+        self.offset = offset
+        self.sectors = sectors
+        self.label = label.encode("ascii").ljust(11)
+        self.hidden_sectors = hidden_sectors
+        if volume_id is None:
+            volume_id = int.from_bytes(os.urandom(4), "little")
+        self.volume_id = volume_id
+        timestamp = time.localtime(timestamp)
+        self.date = (
+            ((timestamp.tm_year - 1980) << 9)
+            | (timestamp.tm_mon << 5)
+            | timestamp.tm_mday
+        )
+        self.time = (
+            (timestamp.tm_hour << 11)
+            | (timestamp.tm_min << 5)
+            | (timestamp.tm_sec // 2)
+        )
+
+        (
+            self.bits,
+            self.sectors_per_cluster,
+            self.fat_sectors,
+            self.clusters,
+        ) = fat_layout(sectors)
+        self.cluster_size = self.sectors_per_cluster * SECTOR
+        self.fat_offset = offset + RESERVED_SECTORS * SECTOR
+        self.root_offset = (
+            self.fat_offset + FAT_COUNT * self.fat_sectors * SECTOR
+        )
+        self.data_offset = self.root_offset + ROOT_SECTORS * SECTOR
+
+        end_of_chain = (1 << self.bits) - 1
+        self.fat = [end_of_chain & ~0x07 | MEDIA_DESCRIPTOR, end_of_chain]
+
+    def store(self, files):
+        tree = {}
+        for path, content in files.items():
+            *directories, filename = path.split("/")
+            directory = tree
+            for name in directories:
+                directory = directory.setdefault(name, {})
+            directory[filename] = content
+        self._store_directory(tree, 0, root=True)
+        self.image.write(self.offset, self._boot_sector())
+        fat = self._encode_fat()
+        for i in range(FAT_COUNT):
+            self.image.write(
+                self.fat_offset + i * self.fat_sectors * SECTOR, fat
+            )
+
+    def _entry(self, name, attributes, cluster, size):
+        return struct.pack(
+            "<11sBBBHHHHHHHI",
+            name,
+            attributes,
+            0,
+            0,
+            self.time,
+            self.date,
+            self.date,
+            cluster >> 16,
+            self.time,
+            self.date,
+            cluster & 0xFFFF,
+            size,
+        )
+
+    def _allocate(self, size):
+        """Allocate a contiguous cluster chain and return its start."""
+        count = max(1, -(-size // self.cluster_size))
+        first = len(self.fat)
+        # Cluster numbers start at 2
+        if first + count > self.clusters + 2:
+            raise ValueError("Not enough space on the file system")
+        self.fat.extend(range(first + 1, first + count))
+        self.fat.append((1 << self.bits) - 1)
+        return first
+
+    def _write_clusters(self, cluster, data):
+        offset = self.data_offset + (cluster - 2) * self.cluster_size
+        self.image.write(offset, data)
+
+    def _store_directory(self, tree, parent, root=False):
+        """Store a directory and its contents. Returns its first cluster."""
+        size = directory_entry_count(tree, root) * DIR_ENTRY_SIZE
+        if root:
+            if size > ROOT_ENTRIES * DIR_ENTRY_SIZE:
+                raise ValueError("Too many entries in root directory")
+            cluster = 0
+            entries = [self._entry(self.label, ATTR_VOLUME_ID, 0, 0)]
+        else:
+            cluster = self._allocate(size)
+            entries = [
+                self._entry(b".".ljust(11), ATTR_DIRECTORY, cluster, 0),
+                self._entry(b"..".ljust(11), ATTR_DIRECTORY, parent, 0),
+            ]
+        short_names = set()
+        for name, content in tree.items():
+            short = short_name(name, short_names)
+            if isinstance(content, dict):
+                first = self._store_directory(content, cluster)
+                attributes, size = ATTR_DIRECTORY, 0
+            else:
+                first = 0
+                if content:
+                    first = self._allocate(len(content))
+                    self._write_clusters(first, content)
+                attributes, size = ATTR_ARCHIVE, len(content)
+            entries.extend(long_name_entries(name, short))
+            entries.append(self._entry(short, attributes, first, size))
+        # Write the directory completely so that an end marker follows
+        # our entries even if the image has not been zeroed.
+        if root:
+            data = b"".join(entries).ljust(ROOT_SECTORS * SECTOR, b"\0")
+            self.image.write(self.root_offset, data)
+        else:
+            data = b"".join(entries)
+            data = data.ljust(
+                -(-len(data) // self.cluster_size) * self.cluster_size, b"\0"
+            )
+            self._write_clusters(cluster, data)
+        return cluster
+
+    def _encode_fat(self):
+        if self.bits == 16:
+            fat = struct.pack(f"<{len(self.fat)}H", *self.fat)
+        else:
+            entries = self.fat + [0] * (len(self.fat) % 2)
+            fat = bytearray()
+            for a, b in zip(entries[::2], entries[1::2]):
+                fat.extend([a & 0xFF, (a >> 8) | ((b & 0x0F) << 4), b >> 4])
+        return bytes(fat).ljust(self.fat_sectors * SECTOR, b"\0")
+
+    def _boot_sector(self):
+        boot = bytearray(SECTOR)
+        small = self.sectors < 0x10000
+        struct.pack_into(
+            "<3s8sHBHBHHBHHHII",
+            boot,
+            0,
+            b"\xeb\x3c\x90",
+            b"mkfs.fat",
+            SECTOR,
+            self.sectors_per_cluster,
+            RESERVED_SECTORS,
+            FAT_COUNT,
+            ROOT_ENTRIES,
+            self.sectors if small else 0,
+            MEDIA_DESCRIPTOR,
+            self.fat_sectors,
+            32,  # sectors per track
+            64,  # heads
+            self.hidden_sectors,
+            0 if small else self.sectors,
+        )
+        struct.pack_into(
+            "<BBBI11s8s",
+            boot,
+            36,
+            0x80,
+            0,
+            0x29,
+            self.volume_id,
+            self.label,
+            f"FAT{self.bits}".ljust(8).encode("ascii"),
+        )
+        # Not bootable: loop forever.
+        boot[62:64] = b"\xeb\xfe"
+        boot[510:512] = b"\x55\xaa"
+        return boot
+
+
+def partitioned_fat_image(size, label, files, timestamp=None):
+    """Build an image with a GPT and a single FAT partition.
+
+    The partition is named like the file system label.
+
+    """
+    image = SparseImage(size)
+    first, last = write_gpt(image, label)
+    fs = FATFilesystem(
+        image,
+        first * SECTOR,
+        last - first + 1,
+        label,
+        hidden_sectors=first,
+        timestamp=timestamp,
+    )
+    fs.store(files)
+    return image
+
+
+def swap_header(size, label, swap_uuid=None, pagesize=None):
+    """Return the first page of a swap area like `mkswap` creates it."""
+    pagesize = pagesize or resource.getpagesize()
+    swap_uuid = swap_uuid or uuid.uuid4()
+    pages = size // pagesize
+    # Same lower limit as mkswap.
+    if pages < 10:
+        raise ValueError(f"Swap area too small: {size}")
+    label = label.encode("utf-8")
+    if len(label) > SWAP_LABEL_SIZE:
+        raise ValueError(f"Label too long: {label}")
+    header = bytearray(pagesize)
+    struct.pack_into(
+        "<III16s16s",
+        header,
+        SWAP_BOOTBITS,
+        1,  # version
+        pages - 1,  # last page
+        0,  # bad pages
+        swap_uuid.bytes,
+        label,
+    )
+    header[-len(SWAP_MAGIC) :] = SWAP_MAGIC
+    return bytes(header)
+
+
+def encode_diff(image, discard=True):
+    """Encode an image as `rbd export-diff` stream (format v1).
+
+    Everything but the written areas is zeroed, unless `discard` is false.
+
+    """
+    chunks = [DIFF_HEADER]
+    if discard:
+        chunks.append(b"z" + struct.pack("<QQ", 0, image.size))
+    for offset, data in image.extents():
+        chunks.append(b"w" + struct.pack("<QQ", offset, len(data)))
+        chunks.append(data)
+    chunks.append(b"e")
+    return b"".join(chunks)
+
+
+def decode_diff(data):
+    """Parse an `rbd export-diff` stream (format v1).
+
+    Yields tuples: ("f", snapname), ("t", snapname), ("s", size),
+    ("w", offset, data), ("z", offset, length).
+
+    """
+    if not data.startswith(DIFF_HEADER):
+        raise ValueError("Not an rbd diff (v1)")
+    pos = len(DIFF_HEADER)
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated rbd diff")
+        tag = chr(data[pos])
+        pos += 1
+        if tag == "e":
+            return
+        if tag in "ft":
+            (length,) = struct.unpack_from("<I", data, pos)
+            pos += 4
+            yield tag, data[pos : pos + length].decode("utf-8")
+            pos += length
+        elif tag == "s":
+            (size,) = struct.unpack_from("<Q", data, pos)
+            pos += 8
+            yield tag, size
+        elif tag in "wz":
+            offset, length = struct.unpack_from("<QQ", data, pos)
+            pos += 16
+            if tag == "w":
+                yield tag, offset, data[pos : pos + length]
+                pos += length
+            else:
+                yield tag, offset, length
+        else:
+            raise ValueError(f"Unknown record in rbd diff: {tag!r}")
+
+
+def overwrite_diff(data, object_size=OBJECT_SIZE):
+    """Turn an exported diff into one that can be applied to other images.
+
+    Snapshot and size records are dropped. Zeroes covering whole objects
+    become discards, everything else that has been written in the source
+    is written explicitly, including zeroes.
+
+    """
+    chunks = [DIFF_HEADER]
+    pending = None  # zeroed range that hasn't been emitted, yet
+
+    def flush():
+        nonlocal pending
+        if pending:
+            chunks.append(b"z" + struct.pack("<QQ", *pending))
+        pending = None
+
+    def zero(offset, length):
+        nonlocal pending
+        if pending and pending[0] + pending[1] == offset:
+            pending = (pending[0], pending[1] + length)
+        else:
+            flush()
+            pending = (offset, length)
+
+    def write(offset, data):
+        flush()
+        chunks.append(b"w" + struct.pack("<QQ", offset, len(data)))
+        chunks.append(data)
+
+    def windows(offset, length):
+        """Split a range at object boundaries."""
+        end = offset + length
+        while offset < end:
+            boundary = min(end, (offset // object_size + 1) * object_size)
+            yield offset, boundary, boundary - offset == object_size
+            offset = boundary
+
+    for record in decode_diff(data):
+        if record[0] == "w":
+            _, offset, content = record
+            for start, end, whole in windows(offset, len(content)):
+                part = content[start - offset : end - offset]
+                if whole and part.count(0) == len(part):
+                    zero(start, end - start)
+                else:
+                    write(start, part)
+        elif record[0] == "z":
+            _, offset, length = record
+            for start, end, whole in windows(offset, length):
+                if whole:
+                    zero(start, end - start)
+                else:
+                    write(start, bytes(end - start))
+    flush()
+    chunks.append(b"e")
+    return b"".join(chunks)
@@ -1,8 +1,13 @@
 import fcntl
+import hashlib
 import json
 import random
 import socket
+import time
+from codecs import encode
 
+from .. import util
+from ..timeout import TimeoutError
 from ..util import log
 
 
@@ -10,15 +15,34 @@ class ClientError(RuntimeError):
     pass
 
 
+class DelimitedSyncUnsupported(ClientError):
+    pass
+
+
 SYNC_TIMEOUT = 30
 
+# Resets the agent's parser when sent and precedes the response to
+# `guest-sync-delimited`. It can never appear in (UTF-8) JSON.
+DELIMITER = b"\xff"
+
+# Commands executed in a guest session need to finish within this time.
+EXEC_TIMEOUT = 5
+# We poll for finished commands quickly at first and back off to
+# `EXEC_POLL_MAX` for commands that take longer.
+EXEC_POLL_MIN = 0.01
+EXEC_POLL_MAX = 1
+
 
 class GuestAgent(object):
     """Wraps qemu guest agent wire protocol."""
 
-    def __init__(self, machine, timeout, client_factory=socket.socket):
+    def __init__(
+        self, machine, timeout, client_factory=socket.socket, sync_mode=None
+    ):
         self.machine = machine
         self.timeout = timeout
+        # "delimited" or "legacy"
+        self.sync_mode = sync_mode or "delimited"
         self.log = log.bind(machine=machine, subsystem="qemu/guestagent")
         self.file = None
 
@@ -67,6 +91,33 @@ class GuestAgent(object):
             self.client.settimeout(timeout or self.timeout)
             return self.read(unwrap=(cmd != "guest-ping"))
 
+    def cmds(self, commands, timeout=None):
+        """Issues several GA commands at once and returns their results.
+
+        `commands` is a list of `(cmd, args)` tuples. The agent handles
+        requests strictly in order, so we send all of them before reading
+        the first response.
+
+        Errors reported by the agent are returned as `ClientError`
+        instances in place of the result, so that one failing command
+        doesn't hide the results of the others.
+
+        """
+        self.connect()
+        for cmd, args in commands:
+            message = json.dumps({"execute": cmd, "arguments": args})
+            message = message.encode("utf-8")
+            self.log.debug("send", message=message)
+            self.client.send(message)
+        self.client.settimeout(timeout or self.timeout)
+        results = []
+        for _ in commands:
+            try:
+                results.append(self.read())
+            except ClientError as e:
+                results.append(e)
+        return results
+
     def sync(self):
         """Ensures that request and response are in order."""
 
@@ -78,6 +129,105 @@ class GuestAgent(object):
             json.dumps({"execute": "guest-fsfreeze-thaw"}).encode("utf-8")
         )
 
+        if self.sync_mode == "delimited":
+            try:
+                self.sync_delimited()
+                return
+            except DelimitedSyncUnsupported:
+                # Old agent or the command is blocked. Stick to the legacy
+                # mode for this agent and do not try again.
+                self.log.info("sync-delimited-unsupported", action="fallback")
+                self.sync_mode = "legacy"
+        self.sync_legacy()
+
+    def sync_delimited(self):
+        """Sync using `guest-sync-delimited`.
+
+        The agent prefixes its response with a 0xFF byte, so we can skip
+        anything that was left in the connection (responses for clients
+        that went away, partial messages) without having to wait for it
+        to time out.
+
+        """
+        # Phase 2: drop whatever is already waiting, without waiting.
+        self.client.settimeout(0)
+        self.log.debug("clear-buffer")
+        try:
+            while buffer := self.client.recv(4096):
+                self.log.debug("found-buffer-garbage", buffer=buffer)
+        except BlockingIOError:
+            pass
+        self.log.debug("cleared-buffer")
+
+        # Phase 3: the leading delimiter resets the agent's parser in
+        # case a previous client left a partial command behind.
+        sync_id = random.randint(0, 0xFFFF)
+        message = json.dumps(
+            {"execute": "guest-sync-delimited", "arguments": {"id": sync_id}}
+        ).encode("utf-8")
+        self.log.debug("send", message=message)
+        self.client.send(DELIMITER + message)
+
+        deadline = time.monotonic() + SYNC_TIMEOUT
+        buffer = b""
+        framed = False
+        while True:
+            if DELIMITER in buffer:
+                stale, _, buffer = buffer.rpartition(DELIMITER)
+                self._check_stale(stale)
+                framed = True
+            while b"\n" in buffer:
+                line, _, buffer = buffer.partition(b"\n")
+                if not framed:
+                    self._check_stale(line)
+                    continue
+                framed = False
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    result = None
+                self.log.debug("sync-response", expected=sync_id, got=result)
+                if isinstance(result, dict) and result.get("return") == sync_id:
+                    if buffer:
+                        self.log.debug("found-buffer-garbage", buffer=buffer)
+                    return
+            buffer += self._recv_until(deadline)
+
+    def _check_stale(self, data):
+        """Inspect data received before our sync response."""
+        if not data.strip():
+            return
+        self.log.debug("found-buffer-garbage", buffer=data)
+        for line in data.splitlines():
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(result, dict):
+                continue
+            error = result.get("error")
+            if error and "guest-sync-delimited" in error.get("desc", ""):
+                raise DelimitedSyncUnsupported(result)
+
+    def _recv_until(self, deadline):
+        try:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise socket.timeout("timed out")
+            self.client.settimeout(timeout)
+            data = self.client.recv(4096)
+        except socket.timeout:
+            self.log.debug("read-timeout")
+            self.disconnect()
+            raise
+        if not data:
+            self.disconnect()
+            raise ClientError("Guest agent closed the connection during sync.")
+        return data
+
+    def sync_legacy(self):
+        """Sync using `guest-sync`, waiting for stale data to arrive."""
+
         # Phase 2: clear the connection buffer from previous connections. We
         # set a very short timeout because the guest agent might still be
         # stuck trying to send a response to a client that went away. However,
@@ -132,3 +282,250 @@ class GuestAgent(object):
             pass
         finally:
             self.client = None
+
+
+class GuestOperation(object):
+    """A file write or command execution queued in a `GuestSession`."""
+
+    def __init__(self, description, on_error=None):
+        self.description = description
+        self.on_error = on_error
+        self.error = None
+        self.done = False
+        self.skipped = False
+
+    def fail(self, error):
+        self.error = error
+        self.done = True
+
+    def check(self):
+        """Raise the error this operation failed with, if any."""
+        if self.error is not None:
+            raise self.error
+
+
+class GuestFileCache(object):
+    """Remembers which content we wrote to which file in the guest.
+
+    The cache lives on the host and is only valid for the Qemu process it
+    was written for, identified by the process' start time. Entries older
+    than `refresh_interval` seconds are written again anyway, as the guest
+    may have lost them (e.g. files in `/run` after a reboot of the guest).
+
+    """
+
+    def __init__(self, path, process_start, refresh_interval, log):
+        self.path = path
+        self.process_start = process_start
+        self.refresh_interval = refresh_interval
+        self.log = log
+        self.files = self._read()
+        self.changed = False
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if cache.get("process_start") != self.process_start:
+            return {}
+        return cache["files"]
+
+    @staticmethod
+    def _hash(content):
+        return hashlib.sha256(content).hexdigest()
+
+    def unchanged(self, path, content):
+        entry = self.files.get(path)
+        if entry is None or entry["hash"] != self._hash(content):
+            return False
+        return 0 <= time.time() - entry["written"] < self.refresh_interval
+
+    def record(self, path, content):
+        self.files[path] = {"hash": self._hash(content), "written": time.time()}
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        cache = {"files": self.files, "process_start": self.process_start}
+        try:
+            util.conditional_update(self.path, cache, mode=0o600)
+        except OSError:
+            self.log.debug("guest-file-cache-write-failed", exc_info=True)
+        self.changed = False
+
+
+class GuestSession(object):
+    """Queues file writes and command executions for a guest.
+
+    `run` pipelines them over the agent's (single, synced) connection:
+    all files are opened with one batch of requests, then written and
+    closed with a second one. Afterwards all commands are started at once
+    and their status is polled together.
+
+    Failures are recorded per operation and reported through their
+    `on_error` callbacks.
+
+    With a `GuestFileCache` writes of content that the guest already has
+    are skipped.
+
+    """
+
+    def __init__(self, agent, cache=None):
+        self.agent = agent
+        self.cache = cache
+        self.files = []
+        self.execs = []
+
+    def write_file(self, path, content: bytes, on_error=None):
+        if not isinstance(content, bytes):
+            raise TypeError("Expected bytes, got string.")
+        op = GuestOperation(f"write {path}", on_error)
+        op.path = path
+        op.content = content
+        if self.cache is not None and self.cache.unchanged(path, content):
+            self.agent.log.debug("guest-file-unchanged", path=path)
+            op.done = op.skipped = True
+            return op
+        self.files.append(op)
+        return op
+
+    def exec(self, executable, arg, after=None, on_error=None):
+        """Queue a command.
+
+        Commands run after all files have been written. If `after` is
+        given the command is skipped when that operation failed or was
+        skipped itself.
+
+        """
+        op = GuestOperation(f"exec {executable}", on_error)
+        op.executable = executable
+        op.arg = arg
+        op.after = after
+        self.execs.append(op)
+        return op
+
+    def run(self):
+        operations = self.files + self.execs
+        try:
+            self._write_files()
+            self._exec()
+        except Exception as e:
+            # The connection broke down (and has been reset), report this
+            # for everything that didn't finish.
+            for op in operations:
+                if not op.done:
+                    op.fail(e)
+        self.files = []
+        self.execs = []
+        if self.cache is not None:
+            self.cache.save()
+        for op in operations:
+            if op.error is None:
+                continue
+            self.agent.log.debug(
+                "guest-session-failed",
+                operation=op.description,
+                reason=str(op.error),
+            )
+            if op.on_error:
+                op.on_error(op.error)
+
+    def _write_files(self):
+        if not self.files:
+            return
+        handles = self.agent.cmds(
+            [
+                ("guest-file-open", {"path": op.path, "mode": "w"})
+                for op in self.files
+            ]
+        )
+        opened = []
+        requests = []
+        for op, handle in zip(self.files, handles):
+            if isinstance(handle, ClientError):
+                op.fail(handle)
+                continue
+            opened.append(op)
+            # The ASCII armour needs to be turned into text again, because
+            # the JSON encoder doesn't handle bytes-like objects.
+            buf = encode(op.content, "base64").decode("ascii")
+            requests.append(
+                ("guest-file-write", {"handle": handle, "buf-b64": buf})
+            )
+            requests.append(("guest-file-close", {"handle": handle}))
+        results = self.agent.cmds(requests)
+        for i, op in enumerate(opened):
+            write, close = results[2 * i : 2 * i + 2]
+            for result in [write, close]:
+                if isinstance(result, ClientError):
+                    op.fail(result)
+                    break
+            else:
+                op.done = True
+                if self.cache is not None:
+                    self.cache.record(op.path, op.content)
+
+    def _exec(self):
+        execs = []
+        for op in self.execs:
+            if op.after is None:
+                execs.append(op)
+            elif op.after.error is not None:
+                op.fail(op.after.error)
+            elif op.after.skipped:
+                op.done = op.skipped = True
+            else:
+                execs.append(op)
+        if not execs:
+            return
+        outputs = self.agent.cmds(
+            [
+                ("guest-exec", {"path": op.executable, "arg": op.arg})
+                for op in execs
+            ]
+        )
+        pending = {}
+        for op, output in zip(execs, outputs):
+            if isinstance(output, ClientError):
+                op.fail(output)
+            elif "pid" not in output:
+                op.fail(RuntimeError("Command could not be started. No PID"))
+            else:
+                pending[output["pid"]] = op
+
+        deadline = time.monotonic() + EXEC_TIMEOUT
+        interval = EXEC_POLL_MIN
+        while pending:
+            statuses = self.agent.cmds(
+                [("guest-exec-status", {"pid": pid}) for pid in pending]
+            )
+            for (pid, op), status in zip(list(pending.items()), statuses):
+                if isinstance(status, ClientError):
+                    op.fail(status)
+                elif not status["exited"]:
+                    continue
+                elif signal := status.get("signal"):
+                    op.fail(
+                        RuntimeError(
+                            f"Command was terminated with signal number {signal}"
+                        )
+                    )
+                elif exitcode := status["exitcode"]:
+                    op.fail(
+                        RuntimeError(f"Command failed with exitcode {exitcode}")
+                    )
+                else:
+                    op.done = True
+                del pending[pid]
+            if not pending:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for op in pending.values():
+                    op.fail(TimeoutError())
+                break
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, EXEC_POLL_MAX)
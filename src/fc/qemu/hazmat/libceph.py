@@ -4,16 +4,29 @@ compile against them.
 
 This helps us to be more version-neutral.
 
+The actual cluster communication is delegated to a backend. The native
+backend talks to librados/librbd through ctypes and keeps a single cluster
+connection per process. The CLI backend runs the `rbd` and `ceph` command
+line tools and is used as a fallback if the shared libraries are not
+available.
+
 """
 
+import atexit
+import contextlib
 import errno
 import json
-import shlex
+import os
 import subprocess
+import threading
 import time
 from pathlib import Path
 
 from fc.qemu import util
+from fc.qemu.hazmat import devices
+
+# How long to wait for the device node after `rbd map`.
+MAP_TIMEOUT = 60
 
 
 class ImageNotFound(Exception):
@@ -28,25 +41,27 @@ class ImageExists(Exception):
     pass
 
 
-class Rados:
-    POOLS_CACHE = []  # mutable on purpose as a global cache.
+class CLIBackend:
+    """Cluster access by calling the `rbd` and `ceph` command line tools.
+
+    Every operation forks a process that has to authenticate against the
+    cluster. This is slow, but does not require any shared libraries.
+
+    """
+
+    kind = "cli"
 
     def __init__(self, conffile, name, log):
         self.conffile = conffile
         self.name = name
-        self.log = log.bind(subsystem="libceph")
-        self._ioctx = {}
-
-    def open_ioctx(self, pool):
-        if pool not in self._ioctx:
-            self._ioctx[pool] = Ioctx(self, pool)
-        return self._ioctx[pool]
+        self.log = log
 
     def _ceph(self, *args, use_json=True):
-        shargs = shlex.join(args)
-        format_arg = "--format json" if use_json else ""
+        format_args = ["--format", "json"] if use_json else []
         result = util.cmd(
-            f"ceph -c {self.conffile} --name {self.name} {format_arg} {shargs}",
+            ["ceph", "-c", self.conffile, "--name", self.name]
+            + format_args
+            + list(args),
             log=self.log,
             log_error_verbose=False,
         )
@@ -54,28 +69,253 @@ class Rados:
             result = json.loads(result)
         return result
 
-    def _rbd(self, *args, use_json=True):
-        shargs = shlex.join(args)
-        format_arg = "--format json" if use_json else ""
+    def _rbd(self, *args, use_json=True, input=None):
+        format_args = ["--format", "json"] if use_json else []
         result = util.cmd(
-            f"rbd -c {self.conffile} --name {self.name} {format_arg} {shargs}",
+            ["rbd", "-c", self.conffile, "--name", self.name]
+            + format_args
+            + list(args),
             log=self.log,
             log_error_verbose=False,
+            input=input,
         )
         if use_json:
             result = json.loads(result)
         return result
 
+    def list_pools(self):
+        return [p["poolname"] for p in self._ceph("osd", "lspools")]
+
+    def list_images(self, pool):
+        return self._rbd("ls", pool)
+
+    def image_info(self, pool, name, snapname=None):
+        spec = f"{pool}/{name}"
+        if snapname:
+            spec += f"@{snapname}"
+        try:
+            return self._rbd("info", spec)
+        except subprocess.CalledProcessError as e:
+            stdout = e.stdout.strip()
+            if (
+                stdout
+                == f"rbd: error opening image {name}: (2) No such file or directory"
+            ):
+                raise ImageNotFound(name)
+            raise
+
+    def create(self, pool, name, size):
+        self._rbd(
+            "create", f"{pool}/{name}", "--size", f"{size}B", use_json=False
+        )
+
+    def remove(self, pool, name):
+        self._rbd("rm", f"{pool}/{name}", use_json=False)
+
+    def resize(self, pool, name, size):
+        self._rbd(
+            "resize", f"{pool}/{name}", "--size", f"{size}B", use_json=False
+        )
+
+    def lock_add(self, pool, name, cookie):
+        self._rbd("lock", "add", f"{pool}/{name}", cookie, use_json=False)
+
+    def lock_list(self, pool, name):
+        return self._rbd("lock", "list", f"{pool}/{name}")
+
+    def lock_remove(self, pool, name, cookie, locker):
+        self._rbd(
+            "lock", "rm", f"{pool}/{name}", cookie, locker, use_json=False
+        )
+
+    def snap_list(self, pool, name):
+        return self._rbd("snap", "list", f"{pool}/{name}")
+
+    def snap_create(self, pool, name, snapname):
+        self._rbd("snap", "create", f"{pool}/{name}@{snapname}", use_json=False)
+
+    def snap_remove(self, pool, name, snapname):
+        self._rbd("snap", "rm", f"{pool}/{name}@{snapname}", use_json=False)
+
+    def shutdown(self):
+        pass
+
+
+def open_native_backend(conffile, name, log):
+    """Connect to the cluster using librados/librbd.
+
+    Returns None if the shared libraries are not available.
+
+    """
+    from . import librbd
+
+    try:
+        return librbd.NativeBackend(conffile, name, log)
+    except librbd.LibraryNotFound as e:
+        log.debug("native-backend-unavailable", library=str(e))
+        return None
+
+
+class Rados:
+    POOLS_CACHE = []  # mutable on purpose as a global cache.
+
+    # Native backends keep a cluster connection which is expensive to set
+    # up, share them globally within a process. The PID is part of the key
+    # as cluster connections must not be shared across forks.
+    BACKENDS = {}
+    BACKENDS_LOCK = threading.Lock()
+
+    def __init__(
+        self,
+        conffile,
+        name,
+        log,
+        backend="auto",
+        broker_socket=None,
+        pool_cache=None,
+        pool_cache_ttl=300,
+    ):
+        """Set up pool access.
+
+        `backend` is either the kind of backend to use (see `backend`)
+        or an already instantiated backend object.
+
+        `pool_cache` is the path of a file that shares the list of pools
+        between processes for `pool_cache_ttl` seconds.
+
+        """
+        self.conffile = conffile
+        self.name = name
+        self.log = log.bind(subsystem="libceph")
+        self.backend_kind = backend
+        self.broker_socket = broker_socket
+        self.pool_cache = pool_cache
+        self.pool_cache_ttl = pool_cache_ttl
+        self._broker = None
+        self._lock = threading.Lock()
+        self._ioctx = {}
+        # Kernel mapping and other CLI-only operations always go through the
+        # command line tools.
+        self.cli = CLIBackend(conffile, name, self.log)
+
+    @property
+    def backend(self):
+        """The backend for all operations except mapping.
+
+        The `auto` mode prefers the host-local broker if it is running, then
+        the native backend and falls back to the CLI if the shared libraries
+        can not be loaded.
+
+        """
+        if not isinstance(self.backend_kind, str):
+            return self.backend_kind
+        if self.backend_kind == "cli":
+            return self.cli
+        if self.backend_kind not in ["auto", "native"]:
+            raise ValueError(f"Unknown Ceph backend: {self.backend_kind}")
+        if (
+            self.backend_kind == "auto"
+            and self.broker_socket
+            and os.path.exists(self.broker_socket)
+        ):
+            with self._lock:
+                if self._broker is None:
+                    from .cephbroker import BrokerBackend
+
+                    self._broker = BrokerBackend(
+                        self.broker_socket, self.log, self._direct_backend
+                    )
+            return self._broker
+        return self._direct_backend()
+
+    def _direct_backend(self):
+        key = (os.getpid(), self.conffile, self.name)
+        with self.BACKENDS_LOCK:
+            if key not in self.BACKENDS:
+                self.BACKENDS[key] = open_native_backend(
+                    self.conffile, self.name, self.log
+                )
+            backend = self.BACKENDS[key]
+        if backend is None:
+            if self.backend_kind == "native":
+                raise RuntimeError("Native Ceph backend is not available.")
+            return self.cli
+        return backend
+
+    def open_ioctx(self, pool):
+        if pool not in self._ioctx:
+            self._ioctx[pool] = Ioctx(self, pool)
+        return self._ioctx[pool]
+
+    def _ceph(self, *args, use_json=True):
+        return self.cli._ceph(*args, use_json=use_json)
+
+    def _rbd(self, *args, use_json=True, input=None):
+        return self.cli._rbd(*args, use_json=use_json, input=input)
+
     def list_pools(self):
         # This is a hot-spot, cache it globally so this helps both for
         # multiple calls on a single instances as well as for mass operations
         # on multiple VMs. Pools are *very* slow moving and we invalidate
         # the cache by restarting the process all the time anyway.
         if not self.POOLS_CACHE:
-            pools = self._ceph("osd", "lspools")
-            self.POOLS_CACHE.extend([p["poolname"] for p in pools])
+            pools = self._read_pool_cache()
+            if pools is None:
+                pools = self.backend.list_pools()
+                self._write_pool_cache(pools)
+            self.POOLS_CACHE.extend(pools)
         return self.POOLS_CACHE
 
+    def invalidate_pools(self):
+        """Forget the list of pools, also for other processes."""
+        self.POOLS_CACHE.clear()
+        if self.pool_cache:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.pool_cache)
+
+    def _read_pool_cache(self):
+        if not self.pool_cache:
+            return None
+        try:
+            with open(self.pool_cache) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (cache.get("conffile"), cache.get("name")) != (
+            self.conffile,
+            self.name,
+        ):
+            return None
+        if not 0 <= time.time() - cache["timestamp"] < self.pool_cache_ttl:
+            return None
+        return cache["pools"]
+
+    def _write_pool_cache(self, pools):
+        if not self.pool_cache:
+            return
+        cache = {
+            "conffile": self.conffile,
+            "name": self.name,
+            "pools": pools,
+            "timestamp": time.time(),
+        }
+        try:
+            # Readers either see the old or the new file, never a partial one.
+            util.conditional_update(self.pool_cache, cache, mode=0o644)
+        except OSError:
+            self.log.debug("pool-cache-write-failed", exc_info=True)
+
+    @classmethod
+    def shutdown_backends(cls):
+        with cls.BACKENDS_LOCK:
+            for key, backend in list(cls.BACKENDS.items()):
+                if backend and key[0] == os.getpid():
+                    backend.shutdown()
+            cls.BACKENDS.clear()
+
+
+atexit.register(Rados.shutdown_backends)
+
 
 class Ioctx:
     """Access to a pool."""
@@ -89,17 +329,14 @@ class Ioctx:
 
 
 class RBD:
+    def list(self, ioctx):
+        return ioctx.rados.backend.list_images(ioctx.name)
+
     def create(self, ioctx, name, size):
-        ioctx.rados._rbd(
-            "create",
-            f"{ioctx.name}/{name}",
-            "--size",
-            f"{size}B",
-            use_json=False,
-        )
+        ioctx.rados.backend.create(ioctx.name, name, size)
 
     def remove(self, ioctx, name):
-        ioctx.rados._rbd("rm", f"{ioctx.name}/{name}", use_json=False)
+        ioctx.rados.backend.remove(ioctx.name, name)
 
 
 class Image:
@@ -116,22 +353,19 @@ class Image:
         if self.snapname:
             self._name += f"@{self.snapname}"
 
-        try:
-            # Not using _info because we want to check the image
-            # and not the snapshot (if this is a snapshot handle)
-            self.ioctx.rados._rbd("info", f"{self.ioctx.name}/{self.name}")
-        except subprocess.CalledProcessError as e:
-            stdout = e.stdout.strip()
-            if (
-                stdout
-                == f"rbd: error opening image {self.name}: (2) No such file or directory"
-            ):
-                raise ImageNotFound(self.name)
-            raise
+        # Not using _info because we want to check the image
+        # and not the snapshot (if this is a snapshot handle)
+        self.backend.image_info(self.ioctx.name, self.name)
+
+    @property
+    def backend(self):
+        return self.ioctx.rados.backend
 
     def _info(self):
         assert not self.closed
-        return self.ioctx.rados._rbd("info", self._name)
+        return self.backend.image_info(
+            self.ioctx.name, self.name, self.snapname
+        )
 
     def size(self):
         assert not self.closed
@@ -139,18 +373,14 @@ class Image:
 
     def resize(self, size):
         assert not self.closed
-        self.ioctx.rados._rbd(
-            "resize", self._name, "--size", f"{size}B", use_json=False
-        )
+        self.backend.resize(self.ioctx.name, self.name, size)
 
     def lock_exclusive(self, cookie):
         assert not self.closed
         try:
-            self.ioctx.rados._rbd(
-                "lock", "add", self._name, cookie, use_json=False
-            )
+            self.backend.lock_add(self.ioctx.name, self.name, cookie)
         except Exception:
-            for lock in self.ioctx.rados._rbd("lock", "list", self._name):
+            for lock in self.backend.lock_list(self.ioctx.name, self.name):
                 if lock["id"] == cookie:
                     # XXX slight issue here - can't identify whether it's an
                     # exclusive lock, but I'm going to run with it for now.
@@ -162,7 +392,7 @@ class Image:
         assert not self.closed
         # Emulate the librbd format
         lockers = {"lockers": []}
-        for locker in self.ioctx.rados._rbd("lock", "list", self._name):
+        for locker in self.backend.lock_list(self.ioctx.name, self.name):
             lockers["lockers"].append(
                 (locker["locker"], locker["id"], locker["address"])
             )
@@ -171,33 +401,29 @@ class Image:
     def list_snaps(self):
         assert not self.closed
         assert "@" not in self._name
-        return self.ioctx.rados._rbd("snap", "list", self._name)
+        return self.backend.snap_list(self.ioctx.name, self.name)
 
     def create_snap(self, snapname):
         assert not self.closed
         assert "@" not in self._name
-        self.ioctx.rados._rbd(
-            "snap", "create", f"{self._name}@{snapname}", use_json=False
-        )
+        self.backend.snap_create(self.ioctx.name, self.name, snapname)
 
     def remove_snap(self, snapname):
         assert not self.closed
         assert "@" not in self._name
-        self.ioctx.rados._rbd(
-            "snap", "rm", f"{self._name}@{snapname}", use_json=False
-        )
+        self.backend.snap_remove(self.ioctx.name, self.name, snapname)
 
     def unlock(self, cookie):
         assert not self.closed
         # This is a tiny bit fishy - because we can't really know whether this
         # was our lock the whole "locker" handling is ... weird.
-        for lock in self.ioctx.rados._rbd("lock", "list", self._name):
+        for lock in self.backend.lock_list(self.ioctx.name, self.name):
             if lock["id"] == cookie:
                 break
         else:
             raise ImageBusy(errno.EBUSY, "Lock cookie not found")
-        self.ioctx.rados._rbd(
-            "lock", "rm", self._name, cookie, lock["locker"], use_json=False
+        self.backend.lock_remove(
+            self.ioctx.name, self.name, cookie, lock["locker"]
         )
 
     def map(self):
@@ -205,10 +431,33 @@ class Image:
         if not self.mapped_device:
             self.ioctx.rados._rbd("map", self._name, use_json=False)
             self.mapped_device = Path("/dev/rbd") / self._name
-            while not self.mapped_device.exists():
-                time.sleep(0.1)  # pragma: no cover
+            devices.wait_for([self.mapped_device], MAP_TIMEOUT)
         return self.mapped_device
 
+    def export_diff(self, path):
+        """Write the image in `rbd export-diff` format to a file."""
+        assert not self.closed
+        self.ioctx.rados._rbd(
+            "export-diff",
+            "--no-progress",
+            self._name,
+            str(path),
+            use_json=False,
+        )
+
+    def import_diff(self, data):
+        """Apply a diff in `rbd export-diff` format to the image."""
+        assert not self.closed
+        assert "@" not in self._name
+        self.ioctx.rados._rbd(
+            "import-diff",
+            "--no-progress",
+            "-",
+            self._name,
+            use_json=False,
+            input=data,
+        )
+
     def unmap(self):
         assert not self.closed
         if not self.mapped_device:
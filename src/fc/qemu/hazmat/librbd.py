@@ -0,0 +1,424 @@
+"""ctypes bindings to librados and librbd.
+
+Only the small subset of the C API that fc.qemu needs is covered. The
+libraries are loaded at runtime so we neither need a compiler nor the
+version-specific Python bindings shipped with Ceph.
+
+The native backend keeps one cluster connection and one ioctx per pool
+for the lifetime of the process. Images are opened and closed for every
+operation to avoid leaving watchers behind that would prevent volumes
+from being deleted.
+
+"""
+
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import os
+import threading
+import time
+from ctypes import (
+    POINTER,
+    byref,
+    c_char_p,
+    c_int,
+    c_int64,
+    c_size_t,
+    c_ssize_t,
+    c_uint64,
+    c_void_p,
+    create_string_buffer,
+)
+
+from .libceph import ImageBusy, ImageExists, ImageNotFound
+
+
+class LibraryNotFound(Exception):
+    pass
+
+
+class rbd_image_info_t(ctypes.Structure):
+    _fields_ = [
+        ("size", c_uint64),
+        ("obj_size", c_uint64),
+        ("num_objs", c_uint64),
+        ("order", c_int),
+        ("block_name_prefix", ctypes.c_char * 24),
+        ("parent_pool", c_int64),
+        ("parent_name", ctypes.c_char * 96),
+    ]
+
+
+class rbd_snap_info_t(ctypes.Structure):
+    _fields_ = [
+        ("id", c_uint64),
+        ("size", c_uint64),
+        ("name", c_char_p),
+    ]
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+LIBRADOS_PROTOTYPES = {
+    "rados_create2": (c_int, [POINTER(c_void_p), c_char_p, c_char_p, c_uint64]),
+    "rados_conf_read_file": (c_int, [c_void_p, c_char_p]),
+    "rados_connect": (c_int, [c_void_p]),
+    "rados_shutdown": (None, [c_void_p]),
+    "rados_pool_list": (c_int, [c_void_p, c_char_p, c_size_t]),
+    "rados_ioctx_create": (c_int, [c_void_p, c_char_p, POINTER(c_void_p)]),
+    "rados_ioctx_destroy": (None, [c_void_p]),
+}
+
+LIBRBD_PROTOTYPES = {
+    "rbd_open": (c_int, [c_void_p, c_char_p, POINTER(c_void_p), c_char_p]),
+    "rbd_open_read_only": (
+        c_int,
+        [c_void_p, c_char_p, POINTER(c_void_p), c_char_p],
+    ),
+    "rbd_close": (c_int, [c_void_p]),
+    "rbd_stat": (c_int, [c_void_p, POINTER(rbd_image_info_t), c_size_t]),
+    "rbd_list": (c_int, [c_void_p, c_char_p, POINTER(c_size_t)]),
+    "rbd_create": (c_int, [c_void_p, c_char_p, c_uint64, POINTER(c_int)]),
+    "rbd_remove": (c_int, [c_void_p, c_char_p]),
+    "rbd_resize": (c_int, [c_void_p, c_uint64]),
+    "rbd_lock_exclusive": (c_int, [c_void_p, c_char_p]),
+    "rbd_break_lock": (c_int, [c_void_p, c_char_p, c_char_p]),
+    "rbd_list_lockers": (
+        c_ssize_t,
+        [
+            c_void_p,
+            POINTER(c_int),
+            c_char_p,
+            POINTER(c_size_t),
+            c_char_p,
+            POINTER(c_size_t),
+            c_char_p,
+            POINTER(c_size_t),
+            c_char_p,
+            POINTER(c_size_t),
+        ],
+    ),
+    "rbd_snap_list": (
+        c_int,
+        [c_void_p, POINTER(rbd_snap_info_t), POINTER(c_int)],
+    ),
+    "rbd_snap_list_end": (None, [POINTER(rbd_snap_info_t)]),
+    "rbd_snap_create": (c_int, [c_void_p, c_char_p]),
+    "rbd_snap_remove": (c_int, [c_void_p, c_char_p]),
+    "rbd_snap_is_protected": (c_int, [c_void_p, c_char_p, POINTER(c_int)]),
+    "rbd_snap_get_timestamp": (
+        c_int,
+        [c_void_p, c_uint64, POINTER(timespec)],
+    ),
+}
+
+
+def load_library(name, version):
+    candidates = [f"lib{name}.so.{version}"]
+    if found := ctypes.util.find_library(name):
+        candidates.append(found)
+    for candidate in candidates:
+        try:
+            return ctypes.CDLL(candidate, use_errno=True)
+        except OSError:
+            continue
+    raise LibraryNotFound(name)
+
+
+def declare(lib, prototypes):
+    """Attach argument and return types to the library functions.
+
+    Test doubles are plain Python objects and are left alone.
+
+    """
+    if not isinstance(lib, ctypes.CDLL):
+        return
+    for name, (restype, argtypes) in prototypes.items():
+        func = getattr(lib, name)
+        func.restype = restype
+        func.argtypes = argtypes
+
+
+def check(ret, context):
+    """Turn negative errno return values into exceptions."""
+    if ret >= 0:
+        return ret
+    err = -ret
+    raise OSError(err, f"{os.strerror(err)} ({context})")
+
+
+def check_image(ret, name):
+    """Like `check` but map the errors we handle explicitly for images."""
+    if ret >= 0:
+        return ret
+    err = -ret
+    if err == errno.ENOENT:
+        raise ImageNotFound(name)
+    if err == errno.EBUSY:
+        raise ImageBusy(err, "Image is busy")
+    if err == errno.EEXIST:
+        raise ImageExists(err, "Image exists")
+    raise OSError(err, f"{os.strerror(err)} ({name})")
+
+
+def split_strings(buf, length, count=None):
+    """Split a buffer of NUL-separated strings."""
+    items = [s.decode("utf-8") for s in buf.raw[:length].split(b"\0")]
+    if count is None:
+        return [s for s in items if s]
+    return items[:count]
+
+
+class NativeBackend:
+    """Cluster access through librados/librbd."""
+
+    kind = "native"
+
+    # The C API reports the buffer size it needs if ours are too small.
+    # Only retry a limited number of times in case things keep growing.
+    MAX_RETRIES = 5
+
+    def __init__(self, conffile, name, log, librados=None, librbd=None):
+        self.conffile = conffile
+        self.name = name
+        self.log = log
+        self.librados = librados or load_library("rados", 2)
+        self.librbd = librbd or load_library("rbd", 1)
+        declare(self.librados, LIBRADOS_PROTOTYPES)
+        declare(self.librbd, LIBRBD_PROTOTYPES)
+
+        self._lock = threading.Lock()
+        self._ioctxs = {}
+
+        started = time.time()
+        self.cluster = c_void_p()
+        check(
+            self.librados.rados_create2(
+                byref(self.cluster), b"ceph", name.encode("ascii"), 0
+            ),
+            "rados_create2",
+        )
+        try:
+            check(
+                self.librados.rados_conf_read_file(
+                    self.cluster, conffile.encode("utf-8")
+                ),
+                "rados_conf_read_file",
+            )
+            check(self.librados.rados_connect(self.cluster), "rados_connect")
+        except Exception:
+            self.librados.rados_shutdown(self.cluster)
+            raise
+        self.log.debug(
+            "native-backend-connected",
+            name=name,
+            duration=round(time.time() - started, 3),
+        )
+
+    def _ioctx(self, pool):
+        with self._lock:
+            if pool not in self._ioctxs:
+                ioctx = c_void_p()
+                check(
+                    self.librados.rados_ioctx_create(
+                        self.cluster, pool.encode("utf-8"), byref(ioctx)
+                    ),
+                    f"open pool {pool}",
+                )
+                self._ioctxs[pool] = ioctx
+            return self._ioctxs[pool]
+
+    @contextlib.contextmanager
+    def _image(self, pool, name, snapname=None, read_only=True):
+        image = c_void_p()
+        if read_only:
+            open_ = self.librbd.rbd_open_read_only
+        else:
+            open_ = self.librbd.rbd_open
+        check_image(
+            open_(
+                self._ioctx(pool),
+                name.encode("utf-8"),
+                byref(image),
+                snapname.encode("utf-8") if snapname else None,
+            ),
+            name,
+        )
+        try:
+            yield image
+        finally:
+            self.librbd.rbd_close(image)
+
+    def list_pools(self):
+        size = 1024
+        for _ in range(self.MAX_RETRIES):
+            buf = create_string_buffer(size)
+            needed = check(
+                self.librados.rados_pool_list(self.cluster, buf, size),
+                "rados_pool_list",
+            )
+            if needed <= size:
+                return split_strings(buf, needed)
+            size = needed
+        raise OSError(errno.ERANGE, "Pool list keeps growing")
+
+    def list_images(self, pool):
+        size = c_size_t(1024)
+        for _ in range(self.MAX_RETRIES):
+            buf = create_string_buffer(size.value)
+            used = self.librbd.rbd_list(self._ioctx(pool), buf, byref(size))
+            if used != -errno.ERANGE:
+                break
+        check(used, f"list images in {pool}")
+        return split_strings(buf, used)
+
+    def image_info(self, pool, name, snapname=None):
+        info = rbd_image_info_t()
+        with self._image(pool, name, snapname) as image:
+            check_image(
+                self.librbd.rbd_stat(image, byref(info), ctypes.sizeof(info)),
+                name,
+            )
+        return {
+            "name": name,
+            "size": info.size,
+            "objects": info.num_objs,
+            "order": info.order,
+            "object_size": info.obj_size,
+            "block_name_prefix": info.block_name_prefix.decode("ascii"),
+        }
+
+    def create(self, pool, name, size):
+        order = c_int(0)
+        check_image(
+            self.librbd.rbd_create(
+                self._ioctx(pool), name.encode("utf-8"), size, byref(order)
+            ),
+            name,
+        )
+
+    def remove(self, pool, name):
+        check_image(
+            self.librbd.rbd_remove(self._ioctx(pool), name.encode("utf-8")),
+            name,
+        )
+
+    def resize(self, pool, name, size):
+        with self._image(pool, name, read_only=False) as image:
+            check_image(self.librbd.rbd_resize(image, size), name)
+
+    def lock_add(self, pool, name, cookie):
+        with self._image(pool, name, read_only=False) as image:
+            check_image(
+                self.librbd.rbd_lock_exclusive(image, cookie.encode("utf-8")),
+                name,
+            )
+
+    def lock_list(self, pool, name):
+        exclusive = c_int()
+        lengths = [c_size_t(256) for _ in range(4)]
+        with self._image(pool, name) as image:
+            for _ in range(self.MAX_RETRIES):
+                tag, clients, cookies, addrs = buffers = [
+                    create_string_buffer(length.value) for length in lengths
+                ]
+                count = self.librbd.rbd_list_lockers(
+                    image,
+                    byref(exclusive),
+                    tag,
+                    byref(lengths[0]),
+                    clients,
+                    byref(lengths[1]),
+                    cookies,
+                    byref(lengths[2]),
+                    addrs,
+                    byref(lengths[3]),
+                )
+                if count != -errno.ERANGE:
+                    break
+            check_image(count, name)
+        clients, cookies, addrs = [
+            split_strings(buf, length.value, count)
+            for buf, length in zip(buffers[1:], lengths[1:])
+        ]
+        return [
+            {"locker": locker, "id": cookie, "address": address}
+            for locker, cookie, address in zip(clients, cookies, addrs)
+        ]
+
+    def lock_remove(self, pool, name, cookie, locker):
+        with self._image(pool, name, read_only=False) as image:
+            check_image(
+                self.librbd.rbd_break_lock(
+                    image, locker.encode("utf-8"), cookie.encode("utf-8")
+                ),
+                name,
+            )
+
+    def snap_list(self, pool, name):
+        max_snaps = c_int(16)
+        result = []
+        with self._image(pool, name) as image:
+            for _ in range(self.MAX_RETRIES):
+                snaps = (rbd_snap_info_t * max_snaps.value)()
+                count = self.librbd.rbd_snap_list(
+                    image, snaps, byref(max_snaps)
+                )
+                if count != -errno.ERANGE:
+                    break
+            check_image(count, name)
+            try:
+                for snap in snaps[:count]:
+                    protected = c_int()
+                    check_image(
+                        self.librbd.rbd_snap_is_protected(
+                            image, snap.name, byref(protected)
+                        ),
+                        name,
+                    )
+                    timestamp = timespec()
+                    check_image(
+                        self.librbd.rbd_snap_get_timestamp(
+                            image, snap.id, byref(timestamp)
+                        ),
+                        name,
+                    )
+                    # Emulate the `rbd snap list --format json` output.
+                    result.append(
+                        {
+                            "id": snap.id,
+                            "name": snap.name.decode("utf-8"),
+                            "size": snap.size,
+                            "protected": "true" if protected.value else "false",
+                            "timestamp": time.ctime(timestamp.tv_sec),
+                        }
+                    )
+            finally:
+                self.librbd.rbd_snap_list_end(snaps)
+        return result
+
+    def snap_create(self, pool, name, snapname):
+        with self._image(pool, name, read_only=False) as image:
+            check_image(
+                self.librbd.rbd_snap_create(image, snapname.encode("utf-8")),
+                name,
+            )
+
+    def snap_remove(self, pool, name, snapname):
+        with self._image(pool, name, read_only=False) as image:
+            check_image(
+                self.librbd.rbd_snap_remove(image, snapname.encode("utf-8")),
+                name,
+            )
+
+    def shutdown(self):
+        with self._lock:
+            for ioctx in self._ioctxs.values():
+                self.librados.rados_ioctx_destroy(ioctx)
+            self._ioctxs.clear()
+            if self.cluster:
+                self.librados.rados_shutdown(self.cluster)
+                self.cluster = None
@@ -5,7 +5,7 @@ import fcntl
 import os
 import socket
 import subprocess
-from codecs import encode
+import time
 from pathlib import Path
 from typing import Any, List
 
@@ -14,11 +14,18 @@ import yaml
 
 from ..exc import QemuNotRunning, VMStateInconsistent
 from ..sysconfig import sysconfig
-from ..timeout import TimeOut
+from ..timeout import TimeOut, TimeoutError
 from ..util import ControlledRuntimeException, log
-from .guestagent import ClientError, GuestAgent
+from .guestagent import (
+    ClientError,
+    GuestAgent,
+    GuestFileCache,
+    GuestSession,
+)
+from .qmp import PipelinedQEMUMonitorProtocol as PipelinedQmp
 from .qmp import QEMUMonitorProtocol as Qmp
-from .qmp import QMPConnectError
+from .qmp import QMPConnectError, QMPTimeoutError
+from .qmpmux import MultiplexerClient, MultiplexerUnavailable
 
 # Freeze requests may take a _long_ _long_ time and the default
 # timeout of 3 seconds will cause everything to explode when
@@ -30,6 +37,8 @@ from .qmp import QMPConnectError
 # This is a global variable so we can instrument it during testing.
 FREEZE_TIMEOUT = 300
 
+MIGRATION_EVENTS = {"MIGRATION", "MIGRATION_PASS"}
+
 
 class InvalidMigrationStatus(Exception):
     pass
@@ -107,10 +116,22 @@ class Qemu(object):
     block_throttle: dict[str, Any]  # map of pool names -> throttle settings
 
     guestagent_timeout = 3.0
+    # "delimited" syncs with the guest agent in a single round trip,
+    # "legacy" waits for stale responses to drain first.
+    guestagent_sync = "delimited"
+    # Rewrite unchanged files in the guest after this many seconds, see
+    # `guest_session`. 0 disables the cache.
+    guest_file_refresh_interval = 900
     # QMP runs in the main thread and can block. Our original 15s timeout
     # is definitely too short. Many discussions mention that 5 minutes have
     # stabilized the situation even under adverse situations.
     qmp_timeout: float = 5 * 60
+    # Use the QMP client that matches responses by id and collects events
+    # in the background.
+    qmp_pipelined = False
+    # Talk to the monitor through the host's QMP multiplexer if it is
+    # running (`fc-qemu qmp-multiplexer`).
+    qmp_multiplexer_socket = ""
     thaw_retry_timeout = 2
     vm_max_total_memory = 0  # MiB: maximum amount of booked memory (-m)
     # on this host
@@ -132,6 +153,7 @@ class Qemu(object):
     arg_file = Path("run/qemu.{name}.args")
     arg_file_in = Path("run/qemu.{name}.args.in")
     qmp_socket = Path("run/qemu.{name}.qmp.sock")
+    guest_file_cache = Path("run/qemu.{name}.guest-files.json")
     serial_file = Path("var/log/vm/{name}.log")
 
     _global_lock_fd = None
@@ -157,6 +179,7 @@ class Qemu(object):
             "arg_file",
             "arg_file_in",
             "qmp_socket",
+            "guest_file_cache",
             "migration_lock_file",
             "chroot",
             "serial_file",
@@ -173,19 +196,50 @@ class Qemu(object):
         self.migration_address = ":".join(a)
         self.name = self.cfg["name"]
         self.monitor_port = self.cfg["id"] + self.MONITOR_OFFSET
-        self.guestagent = GuestAgent(self.name, timeout=self.guestagent_timeout)
+        self.guestagent = GuestAgent(
+            self.name,
+            timeout=self.guestagent_timeout,
+            sync_mode=self.guestagent_sync,
+        )
 
         self.log = log.bind(machine=self.name, subsystem="qemu")
 
     __qmp = None
 
+    @property
+    def qmp_multiplexed(self):
+        return bool(self.qmp_multiplexer_socket) and os.path.exists(
+            self.qmp_multiplexer_socket
+        )
+
+    def _connect_multiplexer(self):
+        qmp = MultiplexerClient(
+            self.qmp_multiplexer_socket, self.name, self.log
+        )
+        qmp.settimeout(self.qmp_timeout)
+        try:
+            qmp.connect()
+        except MultiplexerUnavailable:
+            qmp.close()
+            self.log.debug("qmp-multiplexer-unavailable")
+            return None
+        except socket.error:
+            qmp.close()
+            raise
+        return qmp
+
     @property
     def qmp(self):
         if self.__qmp is None:
-            qmp = Qmp(str(self.qmp_socket), self.log)
-            qmp.settimeout(self.qmp_timeout)
             try:
-                qmp.connect()
+                qmp = None
+                if self.qmp_multiplexed:
+                    qmp = self._connect_multiplexer()
+                if qmp is None:
+                    factory = PipelinedQmp if self.qmp_pipelined else Qmp
+                    qmp = factory(str(self.qmp_socket), self.log)
+                    qmp.settimeout(self.qmp_timeout)
+                    qmp.connect()
             except socket.error:
                 # We do not log this as this does happen quite regularly and
                 # is usually fine as the VM wasn't started (yet).
@@ -373,7 +427,7 @@ class Qemu(object):
             if self.is_running():
                 return
 
-    def freeze(self):
+    def freeze(self, timeout=None):
         try:
             # This request may take a _long_ _long_ time and the default
             # timeout of 3 seconds will cause everything to explode when
@@ -381,7 +435,9 @@ class Qemu(object):
             # period in some busy and large machines. So we increase this
             # to a lot more and also perform a gratuitous thaw in case
             # we error out.
-            self.guestagent.cmd("guest-fsfreeze-freeze", timeout=FREEZE_TIMEOUT)
+            self.guestagent.cmd(
+                "guest-fsfreeze-freeze", timeout=timeout or FREEZE_TIMEOUT
+            )
         except ClientError:
             self.log.debug("guest-fsfreeze-freeze-failed", exc_info=True)
             self.guestagent.cmd("guest-fsfreeze-thaw", fire_and_forget=True)
@@ -406,43 +462,36 @@ class Qemu(object):
             # but that would be ignored during the gratuitous thaw.
             raise
 
+    def guest_session(self, cached=False):
+        """Start a session to batch file writes and commands in the guest.
+
+        A cached session skips writing files whose content we already
+        wrote to this Qemu process recently.
+
+        """
+        cache = None
+        if cached and self.guest_file_refresh_interval > 0:
+            proc = self.proc()
+            if proc is not None:
+                cache = GuestFileCache(
+                    self.guest_file_cache,
+                    proc.create_time(),
+                    self.guest_file_refresh_interval,
+                    self.log,
+                )
+        return GuestSession(self.guestagent, cache)
+
     def write_file(self, path, content: bytes):
-        if not isinstance(content, bytes):
-            raise TypeError("Expected bytes, got string.")
-        handle = self.guestagent.cmd("guest-file-open", path=path, mode="w")
-        try:
-            self.guestagent.cmd(
-                "guest-file-write",
-                handle=handle,
-                # The ASCII armour needs to be turned into text again, because the
-                # JSON encoder doesn't handle bytes-like objects.
-                **{"buf-b64": encode(content, "base64").decode("ascii")},
-            )
-        finally:
-            self.guestagent.cmd("guest-file-close", handle=handle)
+        session = self.guest_session()
+        op = session.write_file(path, content)
+        session.run()
+        op.check()
 
     def exec(self, executable: str, arg: List[str]):
-        output = self.guestagent.cmd(
-            "guest-exec",
-            path=executable,
-            arg=arg,
-        )
-        try:
-            pid = output["pid"]
-        except KeyError:
-            raise RuntimeError("Command could not be started. No PID")
-        timeout = TimeOut(5, 1, raise_on_timeout=True)
-        while timeout.tick():
-            status = self.guestagent.cmd("guest-exec-status", pid=pid)
-            if not status["exited"]:
-                continue
-            if signal := status.get("signal"):
-                raise RuntimeError(
-                    f"Command was terminated with signal number {signal}"
-                )
-            if exitcode := status["exitcode"]:
-                raise RuntimeError(f"Command failed with exitcode {exitcode}")
-            break
+        session = self.guest_session()
+        op = session.exec(executable, arg)
+        session.run()
+        op.check()
 
     def inmigrate(self):
         self._start([f"-incoming {self.migration_address}"])
@@ -464,6 +513,8 @@ class Qemu(object):
             capabilities=[
                 {"capability": "xbzrle", "state": False},
                 {"capability": "auto-converge", "state": True},
+                # Emit MIGRATION events so we notice completion right away.
+                {"capability": "events", "state": True},
             ],
         )
         self.qmp.command(
@@ -480,18 +531,29 @@ class Qemu(object):
             **self.qmp.command("query-migrate-parameters"),
         )
 
+    def wait_for_migration_event(self, timeout):
+        """Wait up to `timeout` seconds for a migration event.
+
+        Returns the event or None.
+
+        """
+        try:
+            return self.qmp.wait_event(MIGRATION_EVENTS, timeout)
+        except QMPTimeoutError:
+            return None
+
     def poll_migration_status(self, timeout=30):
         """Monitor ongoing migration.
 
-        Every few seconds, the migration status is queried from the Qemu
-        monitor. It is yielded to the calling context to provide a hook
-        for communicating status updates.
+        Whenever Qemu signals a change of the migration (or after a few
+        seconds at the latest), the migration status is queried from the
+        Qemu monitor. It is yielded to the calling context to provide a
+        hook for communicating status updates.
 
         """
-        timeout = TimeOut(timeout, 1, raise_on_timeout=True)
-        while timeout.tick():
-            if timeout.interval < 10:
-                timeout.interval *= 1.4142
+        interval = 1
+        cutoff = time.time() + timeout
+        while True:
             info = self.qmp.command("query-migrate")
             yield info
 
@@ -509,7 +571,11 @@ class Qemu(object):
                 pass
             else:
                 raise InvalidMigrationStatus(info)
-            timeout.cutoff += 30
+            if time.time() > cutoff:
+                raise TimeoutError()
+            cutoff += 30
+            self.wait_for_migration_event(interval)
+            interval = min(interval * 1.4142, 10)
 
     def process_exists(self):
         proc = self.proc()
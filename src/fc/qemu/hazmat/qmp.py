@@ -8,9 +8,15 @@
 # This work is licensed under the terms of the GNU GPL, version 2.  See
 # the COPYING file in the top-level directory.
 
+import collections
+import concurrent.futures
+import itertools
 import json
+import select
 import socket
 import sys
+import threading
+import time
 
 
 class QMPError(Exception):
@@ -44,6 +50,7 @@ class QEMUMonitorProtocol:
         """
         self.log = log.bind(subsystem="qemu/qmp")
         self.__events = []
+        self.__timeout = None
         self.__address = address
         self._debug = debug
         self.__sock = self.__get_sock()
@@ -104,7 +111,7 @@ class QEMUMonitorProtocol:
             self.__json_read()
         except BlockingIOError:
             pass
-        self.__sock.setblocking(1)
+        self.__sock.settimeout(self.__timeout)
 
         # Wait for new events, if needed.
         # if wait is 0.0, this means "no wait" and is also implicitly false.
@@ -117,9 +124,10 @@ class QEMUMonitorProtocol:
                 raise QMPTimeoutError("Timeout waiting for event")
             except Exception:
                 raise QMPConnectError("Error while reading from socket")
+            finally:
+                self.__sock.settimeout(self.__timeout)
             if ret is None:
                 raise QMPConnectError("Error while reading from socket")
-            self.__sock.settimeout(None)
 
     def connect(self, negotiate=True):
         """
@@ -131,7 +139,7 @@ class QEMUMonitorProtocol:
         @raise QMPCapabilitiesError if fails to negotiate capabilities
         """
         self.__sock.connect(self.__address)
-        self.__sockfile = self.__sock.makefile()
+        self.__sockfile = self.__sock.makefile("rb")
         if negotiate:
             return self.__negotiate_capabilities()
 
@@ -146,7 +154,7 @@ class QEMUMonitorProtocol:
         """
         self.__sock.settimeout(15)
         self.__sock, _ = self.__sock.accept()
-        self.__sockfile = self.__sock.makefile()
+        self.__sockfile = self.__sock.makefile("rb")
         return self.__negotiate_capabilities()
 
     def cmd_obj(self, qmp_cmd):
@@ -233,6 +241,53 @@ class QEMUMonitorProtocol:
         self.__get_events(wait)
         return self.__events
 
+    def wait_event(self, events, timeout=None, match=lambda event: True):
+        """
+        Remove and return the first pending or future matching event.
+
+        @param events: event name or collection of event names
+        @param match: additional filter on the event dict
+
+        @raise QMPTimeoutError: if the timeout elapses
+        @raise QMPConnectError: if the connection has been closed
+        """
+        if isinstance(events, str):
+            events = {events}
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for event in self.__events:
+                if event["event"] in events and match(event):
+                    self.__events.remove(event)
+                    return event
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise QMPTimeoutError("Timeout waiting for event")
+            # Don't use a socket timeout here: the socket file can't be
+            # read from anymore once a timeout occurred. Lines that were
+            # read together with an earlier response are already in the
+            # socket file's buffer, the socket won't become readable for
+            # them.
+            if not self.__buffered():
+                ready, _, _ = select.select(
+                    [self.__sock], [], [], remaining
+                )
+                if not ready:
+                    raise QMPTimeoutError("Timeout waiting for event")
+            if self.__json_read(only_event=True) is None:
+                raise QMPConnectError("Error while reading from socket")
+
+    def __buffered(self):
+        """Return whether the socket file has buffered data to read."""
+        self.__sock.setblocking(0)
+        try:
+            return bool(self.__sockfile.peek(1))
+        except BlockingIOError:
+            return False
+        finally:
+            self.__sock.settimeout(self.__timeout)
+
     def clear_events(self):
         """
         Clear current list of pending events.
@@ -246,6 +301,7 @@ class QEMUMonitorProtocol:
     timeout = socket.timeout
 
     def settimeout(self, timeout):
+        self.__timeout = timeout
         self.__sock.settimeout(timeout)
 
     def get_sock_fd(self):
@@ -253,3 +309,311 @@ class QEMUMonitorProtocol:
 
     def is_scm_available(self):
         return self.__sock.family == socket.AF_UNIX
+
+
+class PipelinedQEMUMonitorProtocol:
+    """QMP client that allows multiple commands to be in flight at once.
+
+    Every command gets a monotonically increasing id and a background
+    thread dispatches the responses to the waiting callers by id. Events
+    are kept in a bounded queue and can be subscribed to by type.
+
+    The interface is compatible with `QEMUMonitorProtocol`.
+
+    """
+
+    # Number of events to keep if nobody pulls them.
+    EVENT_BACKLOG = 1000
+
+    error = socket.error
+    timeout = socket.timeout
+
+    def __init__(self, address, log, debug=False):
+        self.log = log.bind(subsystem="qemu/qmp")
+        self.address = address
+        self._debug = debug
+        self._timeout = None
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._events = collections.deque(maxlen=self.EVENT_BACKLOG)
+        self._subscriptions = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._closed = False
+        self._reader = None
+        self._sockfile = None
+        family = (
+            socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+        )
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def connect(self, negotiate=True):
+        """
+        Connect to the QMP Monitor and perform capabilities negotiation.
+
+        @return QMP greeting dict
+        @raise socket.error on socket connection errors
+        @raise QMPConnectError if the greeting is not received
+        @raise QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        self._sock.settimeout(self._timeout)
+        self._sock.connect(self.address)
+        self._sockfile = self._sock.makefile("rb")
+        greeting = self._sockfile.readline()
+        greeting = json.loads(greeting) if greeting else None
+        if greeting is None or "QMP" not in greeting:
+            raise QMPConnectError
+        # From here on the reader thread blocks and we apply our timeouts
+        # while waiting for responses.
+        self._sock.settimeout(None)
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+        if negotiate:
+            resp = self.cmd("qmp_capabilities")
+            if resp is None or "return" not in resp:
+                raise QMPCapabilitiesError
+            return greeting
+
+    def _read_loop(self):
+        try:
+            for line in self._sockfile:
+                message = json.loads(line)
+                if self._debug:
+                    print("QMP:<<< %s" % message, file=sys.stderr)
+                if "event" in message:
+                    self._dispatch_event(message)
+                else:
+                    self._dispatch_response(message)
+        except (OSError, ValueError) as e:
+            if not self._closed:
+                self.log.debug("qmp-read-error", reason=str(e))
+        finally:
+            with self._lock:
+                self._closed = True
+                pending, self._pending = self._pending, {}
+                self._changed.notify_all()
+            for future in pending.values():
+                future.set_result(None)
+
+    def _dispatch_response(self, response):
+        key = json.dumps(response.get("id"), sort_keys=True)
+        with self._lock:
+            future = self._pending.pop(key, None)
+        if future is None:
+            # QEMU can only answer without an id if it couldn't parse our
+            # request at all.
+            self.log.warning("qmp-unexpected-response", response=response)
+            return
+        future.set_result(response)
+
+    def _dispatch_event(self, event):
+        # Subscribers see the event before anybody waiting for it wakes up.
+        with self._lock:
+            callbacks = list(self._subscriptions[event["event"]])
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception:
+                self.log.exception("qmp-event-callback-failed")
+        with self._lock:
+            self._events.append(event)
+            self._changed.notify_all()
+
+    def submit(self, name, args=None, id=None):
+        """Send a command without waiting for the response.
+
+        Returns a future that resolves to the response or to None if the
+        connection has been closed.
+
+        """
+        qmp_cmd = {"execute": name}
+        if args:
+            qmp_cmd["arguments"] = args
+        qmp_cmd["id"] = id if id is not None else next(self._ids)
+        return self._submit(qmp_cmd)
+
+    def _submit(self, qmp_cmd):
+        self.log.debug(
+            qmp_cmd["execute"],
+            arguments=qmp_cmd.get("arguments", {}),
+            id=qmp_cmd["id"],
+        )
+        if self._debug:
+            print("QMP:>>> %s" % qmp_cmd, file=sys.stderr)
+        key = json.dumps(qmp_cmd["id"], sort_keys=True)
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                future.set_result(None)
+                return future
+            self._pending[key] = future
+        try:
+            with self._send_lock:
+                self._sock.sendall(json.dumps(qmp_cmd).encode("ascii"))
+        except OSError:
+            with self._lock:
+                self._pending.pop(key, None)
+            future.set_result(None)
+        return future
+
+    def _result(self, future):
+        try:
+            return future.result(self._timeout)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                for key, pending in list(self._pending.items()):
+                    if pending is future:
+                        del self._pending[key]
+            raise socket.timeout("Timeout waiting for QMP response")
+
+    def cmd_obj(self, qmp_cmd):
+        """
+        Send a QMP command to the QMP Monitor.
+
+        @param qmp_cmd: QMP command to be sent as a Python dict
+        @return QMP response as a Python dict or None if the connection has
+                been closed
+        """
+        qmp_cmd = dict(qmp_cmd)
+        if qmp_cmd.get("id") is None:
+            qmp_cmd["id"] = next(self._ids)
+        return self._result(self._submit(qmp_cmd))
+
+    def cmd(self, name, args=None, id=None):
+        """
+        Build a QMP command and send it to the QMP Monitor.
+
+        @param name: command name (string)
+        @param args: command arguments (dict)
+        @param id: command id (dict, list, string or int)
+        """
+        return self._result(self.submit(name, args, id))
+
+    def command(self, cmd, **kwds):
+        ret = self.cmd(cmd, kwds)
+        if ret is None:
+            raise QMPConnectError("Connection went away.")
+        if "error" in ret:
+            raise Exception(ret["error"]["desc"])
+        return ret["return"]
+
+    def subscribe(self, event, callback):
+        """Call `callback` (from the reader thread) for every `event`."""
+        with self._lock:
+            self._subscriptions[event].append(callback)
+
+    def unsubscribe(self, event, callback):
+        with self._lock:
+            self._subscriptions[event].remove(callback)
+
+    def wait_event(self, events, timeout=None, match=lambda event: True):
+        """Remove and return the first queued or future matching event.
+
+        @param events: event name or collection of event names
+        @param match: additional filter on the event dict
+
+        @raise QMPTimeoutError: if the timeout elapses
+        @raise QMPConnectError: if the connection has been closed
+        """
+        if isinstance(events, str):
+            events = {events}
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                for event in self._events:
+                    if event["event"] in events and match(event):
+                        self._events.remove(event)
+                        return event
+                if self._closed:
+                    raise QMPConnectError("Connection went away.")
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise QMPTimeoutError("Timeout waiting for event")
+                self._changed.wait(remaining)
+
+    def _wait_for_events(self, wait):
+        if isinstance(wait, bool):
+            timeout = None
+        else:
+            timeout = wait
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while not self._events:
+                if self._closed:
+                    raise QMPConnectError("Error while reading from socket")
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise QMPTimeoutError("Timeout waiting for event")
+                self._changed.wait(remaining)
+
+    def pull_event(self, wait=False):
+        """
+        Get and delete the first available QMP event.
+
+        @param wait (bool): block until an event is available.
+        @param wait (float): If wait is a float, treat it as a timeout value.
+
+        @raise QMPTimeoutError: If a timeout float is provided and the timeout
+                                period elapses.
+        @raise QMPConnectError: If wait is True but no events could be retrieved
+                                or if some other error occurred.
+
+        @return The first available QMP event, or None.
+        """
+        if wait:
+            self._wait_for_events(wait)
+        with self._lock:
+            if self._events:
+                return self._events.popleft()
+        return None
+
+    def get_events(self, wait=False):
+        """
+        Get a list of available QMP events.
+
+        @param wait (bool): block until an event is available.
+        @param wait (float): If wait is a float, treat it as a timeout value.
+
+        @return The list of available QMP events.
+        """
+        if wait:
+            self._wait_for_events(wait)
+        with self._lock:
+            return list(self._events)
+
+    def clear_events(self):
+        """
+        Clear current list of pending events.
+        """
+        with self._lock:
+            self._events.clear()
+
+    def close(self):
+        self._closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        if self._reader not in (None, threading.current_thread()):
+            self._reader.join()
+        if self._sockfile is not None:
+            self._sockfile.close()
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def get_sock_fd(self):
+        return self._sock.fileno()
+
+    def is_scm_available(self):
+        return self._sock.family == socket.AF_UNIX
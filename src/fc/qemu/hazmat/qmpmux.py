@@ -0,0 +1,358 @@
+"""Host-local multiplexer for QMP connections.
+
+Qemu's QMP socket only serves a single client at a time, so every
+fc-qemu process that wants to talk to the monitor has to wait for the
+others. The multiplexer is a long-running process that keeps one
+persistent (pipelined) QMP connection per running VM and lets any number
+of fc-qemu processes share it through a single unix socket.
+
+Read-only queries are answered from a short-lived cache so that status
+checks of many processes don't pile up in the monitor. Any other command
+for a VM and any event that changes what a query returns invalidates its
+cache.
+
+The protocol is line-based JSON: a request names the VM and carries a
+QMP command, the response carries the QMP response (`null` if the
+monitor connection went away while waiting) or a reason why the VM's
+monitor isn't available. Instead of a command a request can also ask to
+wait for one of the given events, the response then carries the event
+(`null` if none arrived before the timeout).
+
+"""
+
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from .qmp import (
+    PipelinedQEMUMonitorProtocol,
+    QMPConnectError,
+    QMPError,
+    QMPTimeoutError,
+)
+
+# Commands that don't change the VM's state and may be cached.
+READ_ONLY_COMMANDS = {
+    "query-block",
+    "query-migrate",
+    "query-migrate-parameters",
+    "query-status",
+}
+
+# Events that make cached query results stale.
+INVALIDATING_EVENTS = {
+    "MIGRATION",
+    "MIGRATION_PASS",
+    "RESUME",
+    "SHUTDOWN",
+    "STOP",
+}
+
+QMP_SOCKET = "qemu.{name}.qmp.sock"
+
+# How long to wait for the greeting of a VM's monitor.
+CONNECT_TIMEOUT = 5
+
+# Timeout for commands on the VM's monitor, see `Qemu.qmp_timeout`.
+COMMAND_TIMEOUT = 5 * 60
+
+# How often to look for new VMs.
+DISCOVERY_INTERVAL = 5
+
+
+class MultiplexerUnavailable(Exception):
+    pass
+
+
+class MultiplexerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = server.handle_request(request)
+            except (OSError, QMPError) as e:
+                response = {"unavailable": str(e) or e.__class__.__name__}
+            except Exception as e:
+                server.log.exception("qmp-multiplexer-error")
+                response = {"unavailable": repr(e)}
+            try:
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up waiting.
+                return
+
+
+class MultiplexerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, run_dir, log, cache_ttl=1):
+        self.path = Path(path)
+        self.run_dir = Path(run_dir)
+        self.log = log.bind(subsystem="qmp-multiplexer")
+        self.cache_ttl = cache_ttl
+        self.monitors = {}
+        self.cache = {}
+        self._lock = threading.Lock()
+        self._connecting = defaultdict(threading.Lock)
+        with contextlib.suppress(FileNotFoundError):
+            self.path.unlink()
+        # Nobody else may connect, not even before we could chmod.
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(self.path), MultiplexerRequestHandler)
+        finally:
+            os.umask(umask)
+        self.path.chmod(0o600)
+
+    def monitor(self, name):
+        """Return the connection to the VM's monitor, connecting if needed."""
+        with self._connecting[name]:
+            with self._lock:
+                monitor = self.monitors.get(name)
+            if monitor is not None and not monitor.closed:
+                return monitor
+            if monitor is not None:
+                self.forget(name)
+            socket_path = self.run_dir / QMP_SOCKET.format(name=name)
+            monitor = PipelinedQEMUMonitorProtocol(str(socket_path), self.log)
+            monitor.settimeout(CONNECT_TIMEOUT)
+            try:
+                monitor.connect()
+            except Exception:
+                monitor.close()
+                raise
+            monitor.settimeout(COMMAND_TIMEOUT)
+            for event in INVALIDATING_EVENTS:
+                monitor.subscribe(event, lambda _: self._invalidate(name))
+            self.log.info("qmp-connected", machine=name)
+            with self._lock:
+                self.monitors[name] = monitor
+            return monitor
+
+    def forget(self, name):
+        with self._lock:
+            monitor = self.monitors.pop(name, None)
+            self.invalidate(name)
+        if monitor is not None:
+            monitor.close()
+            self.log.info("qmp-disconnected", machine=name)
+
+    def invalidate(self, name):
+        for key in [k for k in self.cache if k[0] == name]:
+            del self.cache[key]
+
+    def _invalidate(self, name):
+        with self._lock:
+            self.invalidate(name)
+
+    def handle_request(self, request):
+        name = request["vm"]
+        monitor = self.monitor(name)
+        if "wait-event" in request:
+            try:
+                event = monitor.wait_event(
+                    set(request["wait-event"]), request.get("timeout")
+                )
+            except QMPTimeoutError:
+                event = None
+            return {"event": event}
+        if "execute" not in request:
+            # Just checking that the monitor is available.
+            return {"response": {"return": {}}}
+        command = request["execute"]
+        arguments = request.get("arguments", {})
+        key = (name, command, json.dumps(arguments, sort_keys=True))
+        if command in READ_ONLY_COMMANDS:
+            with self._lock:
+                expires, response = self.cache.get(key, (0, None))
+            if time.monotonic() < expires:
+                return {"response": dict(response, id=request.get("id"))}
+        else:
+            with self._lock:
+                self.invalidate(name)
+        response = monitor.cmd(command, arguments)
+        if response is None:
+            self.forget(name)
+        elif command in READ_ONLY_COMMANDS and "return" in response:
+            with self._lock:
+                self.cache[key] = (time.monotonic() + self.cache_ttl, response)
+        if response is not None:
+            response = dict(response, id=request.get("id"))
+        return {"response": response}
+
+    def discover(self):
+        """Connect to all VMs that have a monitor socket."""
+        prefix, suffix = QMP_SOCKET.split("{name}")
+        for path in self.run_dir.glob(QMP_SOCKET.format(name="*")):
+            name = path.name[len(prefix) : -len(suffix)]
+            try:
+                self.monitor(name)
+            except Exception as e:
+                self.log.debug(
+                    "qmp-connect-failed", machine=name, reason=str(e)
+                )
+        with self._lock:
+            closed = [n for n, m in self.monitors.items() if m.closed]
+        for name in closed:
+            self.forget(name)
+
+    def server_close(self):
+        super().server_close()
+        with contextlib.suppress(FileNotFoundError):
+            self.path.unlink()
+        for name in list(self.monitors):
+            self.forget(name)
+
+
+@contextlib.contextmanager
+def running_multiplexer(path, run_dir, log, cache_ttl=1):
+    """Run a multiplexer in a background thread."""
+    server = MultiplexerServer(path, run_dir, log, cache_ttl)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+class MultiplexerClient:
+    """Talks to a VM's monitor through the multiplexer.
+
+    The interface is compatible with `QEMUMonitorProtocol`. Events can
+    only be waited for, they are not queued for the client.
+
+    """
+
+    error = socket.error
+    timeout = socket.timeout
+
+    def __init__(self, path, name, log):
+        self.path = str(path)
+        self.name = name
+        self.log = log.bind(subsystem="qemu/qmp")
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._file = None
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def _request(self, request):
+        request["vm"] = self.name
+        self._file.write(json.dumps(request).encode("utf-8") + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            return None
+        response = json.loads(line)
+        if "unavailable" in response:
+            # Behave like a refused connection to the monitor itself.
+            raise ConnectionRefusedError(response["unavailable"])
+        return response
+
+    def connect(self, negotiate=True):
+        """Connect to the multiplexer and check the VM's monitor.
+
+        @raise MultiplexerUnavailable if the multiplexer isn't running
+        @raise socket.error if the VM's monitor is not available
+        """
+        try:
+            self._sock.connect(self.path)
+        except OSError as e:
+            raise MultiplexerUnavailable(str(e))
+        self._file = self._sock.makefile("rwb")
+        if self._request({}) is None:
+            raise MultiplexerUnavailable("connection closed")
+
+    def cmd_obj(self, qmp_cmd):
+        """
+        Send a QMP command to the QMP Monitor.
+
+        @param qmp_cmd: QMP command to be sent as a Python dict
+        @return QMP response as a Python dict or None if the connection has
+                been closed
+        """
+        self.log.debug(
+            qmp_cmd["execute"],
+            arguments=qmp_cmd.get("arguments", {}),
+            id=qmp_cmd.get("id", None),
+        )
+        response = self._request(dict(qmp_cmd))
+        return response and response["response"]
+
+    def cmd(self, name, args=None, id=None):
+        qmp_cmd = {"execute": name}
+        if args:
+            qmp_cmd["arguments"] = args
+        if id:
+            qmp_cmd["id"] = id
+        return self.cmd_obj(qmp_cmd)
+
+    def command(self, cmd, **kwds):
+        ret = self.cmd(cmd, kwds)
+        if ret is None:
+            raise QMPConnectError("Connection went away.")
+        if "error" in ret:
+            raise Exception(ret["error"]["desc"])
+        return ret["return"]
+
+    def wait_event(self, events, timeout=None):
+        """Return the first pending or future event of the VM's monitor.
+
+        @param events: event name or collection of event names
+
+        @raise QMPTimeoutError: if the timeout elapses
+        @raise QMPConnectError: if the connection has been closed
+        """
+        if isinstance(events, str):
+            events = {events}
+        try:
+            response = self._request(
+                {"wait-event": sorted(events), "timeout": timeout}
+            )
+        except ConnectionRefusedError as e:
+            raise QMPConnectError(str(e))
+        if response is None:
+            raise QMPConnectError("Connection went away.")
+        if response["event"] is None:
+            raise QMPTimeoutError("Timeout waiting for event")
+        return response["event"]
+
+    def close(self):
+        if self._file is not None:
+            with contextlib.suppress(OSError):
+                self._file.close()
+        self._sock.close()
+
+
+def serve(path, run_dir, cache_ttl, log):
+    """Run the multiplexer until interrupted."""
+    log.info("qmp-multiplexer-start", socket=str(path))
+    server = MultiplexerServer(path, run_dir, log, cache_ttl)
+    stopped = threading.Event()
+
+    def discover():
+        while True:
+            server.discover()
+            if stopped.wait(DISCOVERY_INTERVAL):
+                break
+
+    threading.Thread(target=discover, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        server.server_close()
+        log.info("qmp-multiplexer-stop")
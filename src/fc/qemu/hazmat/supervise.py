@@ -5,8 +5,8 @@ import subprocess
 import sys
 import time
 
-from fc.qemu.main import daemonize
-from fc.qemu.util import FlushingStream, ensure_separate_cgroup
+from fc.qemu.main import daemonize, ensure_separate_cgroup
+from fc.qemu.util import FlushingStream
 
 
 def run_supervised(cmd, name, logfile):
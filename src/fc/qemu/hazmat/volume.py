@@ -6,14 +6,25 @@ base class for both volumes and snapshots.
 """
 
 import contextlib
+import datetime
+import re
 import subprocess
 from pathlib import Path
 from typing import Optional
 
 import fc.qemu.hazmat.libceph as libceph
 
-from ..timeout import TimeOut
 from ..util import cmd, remove_empty_dirs
+from . import devices
+
+# Marker for a lock status that has not been queried (yet).
+UNKNOWN = object()
+
+# How long to wait for a partition to appear after `partprobe`.
+PARTITION_TIMEOUT = 5
+
+# Suffix of snapshots that expire, see `Agent.snapshot`.
+KEEP_UNTIL = re.compile(r"-keep-until-(?P<date>[0-9]{8})$")
 
 
 class Image(object):
@@ -50,35 +61,38 @@ class Image(object):
             self.device.with_name(self.device.name + "-part1"),
             self.device.with_name(self.device.name + "p1"),
         ]
-        timeout = TimeOut(5, interval=0.1, raise_on_timeout=True, log=self.log)
-        while timeout.tick():
-            for candidate in candidates:
-                if candidate.is_block_device():
-                    self.log.debug(
-                        "found-partition",
-                        path=str(candidate),
-                        target=str(candidate.resolve()),
-                    )
-                    break
-            else:
-                continue
-            break  # let the break from inner loop bubble up
-        # Some protections against weird race conditions we have seen. Those are
-        # somewhat of a hail mary, though.
-        timeout = TimeOut(5, interval=0.1, raise_on_timeout=True, log=self.log)
-        self.cmd("udevadm settle")
-        while timeout.tick():
-            try:
-                self.cmd(f"blkid {candidate}")
-            except subprocess.CalledProcessError as e:
-                if e.returncode == 2:
-                    continue  # the device wasn't ready yet
-                # this is unexpected
-                raise
-            break
-        # We're fine if we made it here.
+        candidate = devices.wait_for(
+            candidates, PARTITION_TIMEOUT, check=Path.is_block_device
+        )
+        self.log.debug(
+            "found-partition",
+            path=str(candidate),
+            target=str(candidate.resolve()),
+        )
+        # The node may exist before udev is done with it. Confirm once and
+        # only wait for udev if the device isn't ready yet. Settling only
+        # covers the events udev knows about so far, keep checking for a
+        # bit.
+        if not self._probe(candidate):
+            self.cmd("udevadm settle")
+            devices.wait_for(
+                [candidate],
+                PARTITION_TIMEOUT,
+                check=self._probe,
+                interval=devices.POLL_INTERVAL,
+            )
         self.part1dev = candidate
 
+    def _probe(self, device):
+        """Return whether blkid can identify `device`."""
+        try:
+            self.cmd(f"blkid {device}")
+        except subprocess.CalledProcessError as e:
+            if e.returncode != 2:
+                raise
+            return False
+        return True
+
     def map(self):
         self.device = self.rbdimage.map()
 
@@ -138,11 +152,17 @@ class Image(object):
 
 
 class Snapshots(object):
-    """Container for all snapshots of a Volume."""
+    """Container for all snapshots of a Volume.
+
+    The list of snapshots is read once and kept until we create or
+    remove a snapshot or the volume gets closed.
+
+    """
 
     def __init__(self, volume):
         self.vol = volume
         self.log = self.vol.log
+        self._snaps = None
 
     def __iter__(self):
         """Iterate over all existing snapshots."""
@@ -152,7 +172,7 @@ class Snapshots(object):
         )
 
     def __len__(self):
-        return len(list(self._list_snaps()))
+        return len(self._list_snaps())
 
     def __getitem__(self, key):
         for s in self._list_snaps():
@@ -161,10 +181,15 @@ class Snapshots(object):
         raise KeyError(key)
 
     def _list_snaps(self):
-        try:
-            return self.vol.rbdimage.list_snaps()
-        except libceph.ImageNotFound:
-            return []
+        if self._snaps is None:
+            try:
+                self._snaps = list(self.vol.rbdimage.list_snaps())
+            except libceph.ImageNotFound:
+                return []
+        return self._snaps
+
+    def invalidate(self):
+        self._snaps = None
 
     def purge(self):
         """Remove all snapshots."""
@@ -180,6 +205,7 @@ class Snapshots(object):
         self.log.info(
             "create-snapshot", volume=self.vol.fullname, snapshot=snapname
         )
+        self.invalidate()
         self.vol.rbdimage.create_snap(snapname)
 
 
@@ -205,9 +231,21 @@ class Snapshot(Image):
     def fullname(self):
         return self.ioctx.name + "/" + self.name + "@" + self.snapname
 
+    @property
+    def keep_until(self):
+        """The last day to keep this snapshot or None to keep it forever."""
+        m = KEEP_UNTIL.search(self.snapname)
+        if not m:
+            return None
+        try:
+            return datetime.datetime.strptime(m["date"], "%Y%m%d").date()
+        except ValueError:
+            return None
+
     def remove(self):
         """Destroy myself."""
         self.log.info("remove-snapshot")
+        self.vol.snapshots.invalidate()
         self.vol.rbdimage.remove_snap(self.snapname)
 
 
@@ -234,6 +272,7 @@ class Volume(Image):
     def close(self):
         if self._image:
             self._image.close()
+        self.snapshots.invalidate()
         self.ceph._clean_volume(self)
 
     @property
@@ -266,14 +305,17 @@ class Volume(Image):
             try:
                 self.rbdimage.lock_exclusive(self.ceph.CEPH_LOCK_HOST)
                 self.locked_by_me = True
+                self._lock_status = (None, self.ceph.CEPH_LOCK_HOST)
                 return
             except libceph.ImageExists:
                 # This client and cookie already locked this. This is
                 # definitely fine.
+                self._lock_status = (None, self.ceph.CEPH_LOCK_HOST)
                 return
             except libceph.ImageBusy:
                 # Maybe the same client but different cookie. We're fine with
                 # different cookies - ignore this. Must be same client, though.
+                self.refresh()
                 lock_status = self.lock_status()
                 if lock_status is None:
                     # Someone had the lock but released it in between.
@@ -292,8 +334,36 @@ class Volume(Image):
             "Someone seems to be racing me."
         )
 
+    @property
+    def _lock_status(self):
+        return self.ceph.lock_statuses.get(self.fullname, UNKNOWN)
+
+    @_lock_status.setter
+    def _lock_status(self, status):
+        self.ceph.lock_statuses[self.fullname] = status
+
+    def refresh(self):
+        """Forget the cached lock status.
+
+        Required whenever somebody else may have changed the locks, e.g.
+        when handing over locks during a migration.
+
+        """
+        self.ceph.lock_statuses.pop(self.fullname, None)
+
     def lock_status(self):
-        """Return None if not locked and (client_id, lock_id) if it is."""
+        """Return None if not locked and (client_id, lock_id) if it is.
+
+        The status is queried once per Ceph session and then cached: our
+        own lock changes are written through. The client_id is None if we
+        took the lock ourselves since the last refresh.
+
+        """
+        if self._lock_status is UNKNOWN:
+            self._lock_status = self._query_lock_status()
+        return self._lock_status
+
+    def _query_lock_status(self):
         try:
             lockers = self.rbdimage.list_lockers()
         except libceph.ImageNotFound:
@@ -321,11 +391,19 @@ class Volume(Image):
 
         if self.locked_by_me or lock_id == self.ceph.CEPH_LOCK_HOST:
             self.log.info("unlock")
-            self.rbdimage.unlock(lock_id)
+            self._unlock(lock_id)
             self.locked_by_me = False
             return
 
         # We do not own this lock: need to explicitly ask for breaking.
         elif force:
             self.log.info("break-lock")
+            self._unlock(lock_id)
+
+    def _unlock(self, lock_id):
+        try:
             self.rbdimage.unlock(lock_id)
+        except Exception:
+            self.refresh()
+            raise
+        self._lock_status = None
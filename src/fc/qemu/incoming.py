@@ -203,6 +203,7 @@ class IncomingServer(object):
             raise RuntimeError("rescue not possible - destroyed VM", self.name)
         try:
             log.info("rescue-locks", machine=self.name)
+            self.ceph.refresh_locks()
             self.ceph.lock()
         except Exception:
             log.warning("rescue-locks-failed", machine=self.name, exc_info=True)
@@ -217,6 +218,8 @@ class IncomingServer(object):
         self.qemu.release_migration_lock()
 
     def acquire_ceph_locks(self):
+        # The source has just released its locks.
+        self.ceph.refresh_locks()
         self.ceph.lock()
 
     def finish_incoming(self):
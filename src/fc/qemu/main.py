@@ -2,7 +2,9 @@ import os
 import os.path
 import sys
 
-from .util import ControlledRuntimeException, ensure_separate_cgroup
+# Keep the imports of this module light: it is loaded by every fc-qemu
+# and supervised-qemu invocation. Subcommands import what they need.
+from . import daemon
 
 
 def daemonize(log=None):
@@ -63,8 +65,22 @@ def daemonize(log=None):
     os.dup2(se.fileno(), sys.stderr.fileno())
 
 
-def main():
-    ensure_separate_cgroup()
+def ensure_separate_cgroup():
+    "Move this process to a separate fc-qemu cgroup."
+    CGROUP = "/sys/fs/cgroup/fc-qemu"
+    if not os.path.exists(CGROUP):
+        try:
+            os.mkdir(CGROUP)
+        except OSError:
+            if not os.path.isdir(CGROUP):
+                raise
+            # The directory exists now. We've run into a race condition.
+            # Keep going.
+    with open("{}/cgroup.procs".format(CGROUP), "w") as f:
+        f.write(str(os.getpid()))
+
+
+def build_parser():
     import argparse
 
     a = argparse.ArgumentParser(description="Qemu VM agent")
@@ -115,6 +131,19 @@ def main():
     p.set_defaults(func="ensure")
     p.set_defaults(ceph_attach_on_enter=False)
 
+    p = sub.add_parser(
+        "ensure-all",
+        help="Ensure proper status of all VMs configured on this host.",
+    )
+    p.add_argument(
+        "-p",
+        "--parallelism",
+        type=int,
+        help="How many VMs to handle at the same time "
+        "(default from fc-qemu.conf)",
+    )
+    p.set_defaults(func="ensure_all")
+
     p = sub.add_parser("start", help="Start a VM.")
     p.add_argument("vm", metavar="VM", help="name of the VM")
     p.set_defaults(func="start")
@@ -151,6 +180,47 @@ def main():
     p.add_argument("snapshot", help="name of the snapshot")
     p.set_defaults(func="snapshot")
 
+    p = sub.add_parser(
+        "snapshot-all",
+        help="Take clean snapshots of all VMs running on this host.",
+    )
+    p.add_argument(
+        "-k",
+        "--keep",
+        default=7,
+        type=int,
+        help="How many days to keep the snapshots. "
+        "(default=7, forever=0) to keep",
+    )
+    p.add_argument(
+        "-p",
+        "--parallelism",
+        type=int,
+        help="How many VMs to snapshot at the same time "
+        "(default from fc-qemu.conf)",
+    )
+    p.add_argument("snapshot", help="name of the snapshots")
+    p.set_defaults(func="snapshot_all")
+
+    p = sub.add_parser(
+        "snapshot-gc",
+        help="Remove expired snapshots of all VMs on this host.",
+    )
+    p.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Only report expired snapshots, don't remove them.",
+    )
+    p.add_argument(
+        "-p",
+        "--parallelism",
+        type=int,
+        help="How many VMs to handle at the same time "
+        "(default from fc-qemu.conf)",
+    )
+    p.set_defaults(func="snapshot_gc")
+
     p = sub.add_parser(
         "force-unlock",
         help="Release all locks of a VM even if we don't own them.",
@@ -183,19 +253,75 @@ def main():
     )
     p.set_defaults(func="handle_consul_event")
 
+    p = sub.add_parser(
+        "ceph-broker",
+        help="Serve Ceph operations to other fc-qemu processes on this host.",
+    )
+    p.set_defaults(func="ceph_broker")
+
+    p = sub.add_parser(
+        "qmp-multiplexer",
+        help="Share the monitor connections of all VMs between fc-qemu "
+        "processes on this host.",
+    )
+    p.set_defaults(func="qmp_multiplexer")
+
+    p = sub.add_parser(
+        "agent-daemon",
+        help="Run commands forwarded by other fc-qemu processes on this "
+        "host without starting up for each of them.",
+    )
+    p.add_argument(
+        "--socket",
+        dest="socket_path",
+        default=daemon.socket_path(),
+        help="unix socket to listen on (default: %(default)s)",
+    )
+    p.set_defaults(func="agent_daemon")
+
     p = sub.add_parser(
         "telnet", help="Open a telnet connection to the VM's monitor port"
     )
     p.add_argument("vm", metavar="VM", help="name of the VM")
     p.set_defaults(func="telnet")
 
+    return a
+
+
+def main():
+    ensure_separate_cgroup()
+    a = build_parser()
     args = a.parse_args()
-    func = args.func
 
-    if func == "print_usage":
+    if args.func == "print_usage":
         a.print_usage()
         sys.exit(1)
 
+    if args.daemonize:
+        # Needed to help spawn subprocesses from consul without blocking.
+        daemonize()
+
+    if args.func not in daemon.LOCAL_ONLY:
+        exitcode = daemon.forward(args, sys.argv)
+        if exitcode is not None:
+            sys.exit(exitcode)
+
+    sys.exit(run(args))
+
+
+def run_in_daemon(args):
+    """Run a command forwarded to the agent daemon in its worker process."""
+    import importlib
+
+    from . import logging
+
+    # Colors depend on whether the client's output is a terminal.
+    importlib.reload(logging)
+    return run(args, load_config=False)
+
+
+def run(args, load_config=True):
+    func = args.func
     vm = getattr(args, "vm", None)
     kwargs = dict(args._get_kwargs())
     del kwargs["func"]
@@ -205,23 +331,21 @@ def main():
     del kwargs["verbose"]
     del kwargs["ceph_attach_on_enter"]
 
-    if args.daemonize:
-        # Needed to help spawn subprocesses from consul without blocking.
-        daemonize()
-
     from .agent import Agent, InvalidCommand, VMConfigNotFound
     from .logging import init_logging
-    from .util import log
+    from .util import ControlledRuntimeException, log
 
     exitcode = os.EX_UNAVAILABLE
     try:
         init_logging(args.verbose)
         log.debug(" ".join(sys.argv))
-        log.debug("load-system-config")
 
-        from .sysconfig import sysconfig
+        if load_config:
+            log.debug("load-system-config")
+
+            from .sysconfig import sysconfig
 
-        sysconfig.load_system_config()
+            sysconfig.load_system_config()
 
         if vm is None:
             # Expecting a class/static method
@@ -261,4 +385,4 @@ def main():
 
     if exitcode != os.EX_OK:
         log.debug("exit", status=exitcode)
-    sys.exit(exitcode)
+    return exitcode
@@ -273,6 +273,7 @@ class Outgoing(object):
             break
 
     def transfer_ceph_locks(self):
+        self.agent.ceph.refresh_locks()
         self.agent.ceph.unlock()
         self.target.acquire_ceph_locks(self.cookie)
 
@@ -338,6 +339,8 @@ class Outgoing(object):
                     self.log.exception("destroy-remote-failed", exc_info=True)
         try:
             self.log.info("continue-locally")
+            # The target may have taken over (some of) the locks already.
+            self.agent.ceph.refresh_locks()
             self.agent.ceph.lock()
             assert self.agent.qemu.is_running()
         except Exception:
@@ -0,0 +1,242 @@
+"""Run external commands.
+
+Commands are executed directly (without a shell) as asyncio subprocesses
+in their own session. This allows us to enforce timeouts reliably: the
+whole process group gets killed, including any children a command may
+have spawned.
+
+A host-wide semaphore limits the number of commands running concurrently
+so that mass operations (e.g. evacuating a host) don't overload the
+host or the Ceph cluster. The semaphore is a set of lock files that are
+held with `flock` and thus released automatically if a process dies.
+
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import fcntl
+import os
+import shlex
+import signal
+import subprocess
+import time
+from pathlib import Path
+
+# Upper bound for the captured output of a single command.
+MAX_OUTPUT = 32 * 1024 * 1024
+
+# How long to wait for a process group to exit after SIGTERM.
+KILL_GRACE_PERIOD = 2
+
+
+def to_argv(cmdline):
+    """Turn a command line into an argument vector.
+
+    Strings are split with shell quoting rules, but shell features like
+    pipes or redirections are *not* available.
+
+    """
+    if isinstance(cmdline, str):
+        return shlex.split(cmdline)
+    return [str(arg) for arg in cmdline]
+
+
+class CommandSlots:
+    """A host-wide counting semaphore based on lock files."""
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, directory, count):
+        self.directory = Path(directory)
+        self.count = count
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, log, deadline=None):
+        fd = await self._acquire(log, deadline)
+        try:
+            yield
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    async def _acquire(self, log, deadline):
+        try:
+            self.directory.mkdir(mode=0o755, exist_ok=True)
+            fds = [
+                os.open(self.directory / f"slot.{i}", os.O_RDWR | os.O_CREAT)
+                for i in range(self.count)
+            ]
+        except OSError:
+            # Limiting is a safety measure: don't let it stop us.
+            log.debug("command-slots-unavailable", exc_info=True)
+            return None
+        waiting = False
+        try:
+            while True:
+                for fd in fds:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    fds.remove(fd)
+                    return fd
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError("Timed out waiting for a command slot.")
+                if not waiting:
+                    log.debug("command-slot-wait", slots=self.count)
+                    waiting = True
+                await asyncio.sleep(self.POLL_INTERVAL)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+
+async def _read_output(stream, max_output, encoding, errors, on_line):
+    """Collect output, passing complete lines to `on_line` as they arrive.
+
+    Returns the captured output and whether it has been truncated.
+
+    """
+    chunks = []
+    captured = 0
+    truncated = False
+    pending = b""
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        keep = chunk[: max(0, max_output - captured)]
+        if len(keep) < len(chunk):
+            truncated = True
+        chunks.append(keep)
+        captured += len(keep)
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            on_line(line.decode(encoding, errors) + "\n")
+        # Don't let a single endless line eat our memory.
+        if len(pending) > max_output:
+            pending = pending[-max_output:]
+    if pending:
+        on_line(pending.decode(encoding, errors))
+    return b"".join(chunks).decode(encoding, errors), truncated
+
+
+async def _kill(proc, log):
+    """Terminate the process group of `proc`."""
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(proc.pid, sig)
+        try:
+            await asyncio.wait_for(proc.wait(), KILL_GRACE_PERIOD)
+            return
+        except asyncio.TimeoutError:
+            continue
+    # Processes stuck in the kernel (e.g. in uninterruptible IO) can not
+    # be killed. Don't wait for them forever.
+    log.warning("command-kill-failed", pid=proc.pid)
+
+
+async def run(
+    argv,
+    log,
+    timeout=None,
+    input=None,
+    encoding="ascii",
+    errors="replace",
+    max_output=MAX_OUTPUT,
+    slots=None,
+    on_line=lambda line: None,
+):
+    """Run a command and return (returncode, output).
+
+    stdout and stderr are combined. Raises `subprocess.TimeoutExpired` if
+    the command (including waiting for a slot) takes longer than
+    `timeout` seconds.
+
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    slot = slots.acquire(log, deadline) if slots else contextlib.nullcontext()
+    try:
+        async with slot:
+            return await _run(
+                argv,
+                log,
+                deadline,
+                input,
+                encoding,
+                errors,
+                max_output,
+                on_line,
+            )
+    except TimeoutError:
+        raise subprocess.TimeoutExpired(argv, timeout)
+
+
+async def _run(
+    argv, log, deadline, input, encoding, errors, max_output, on_line
+):
+    proc = await asyncio.create_subprocess_exec(
+        *argv,
+        stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+
+    async def feed():
+        proc.stdin.write(input)
+        with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+            await proc.stdin.drain()
+        proc.stdin.close()
+
+    async def communicate():
+        # Feed stdin while reading the output, like `Process.communicate`:
+        # commands may write more than a pipe buffer before they finished
+        # reading their input.
+        reading = _read_output(
+            proc.stdout, max_output, encoding, errors, on_line
+        )
+        if input is None:
+            output = await reading
+        else:
+            _, output = await asyncio.gather(feed(), reading)
+        await proc.wait()
+        return output
+
+    remaining = None
+    if deadline is not None:
+        remaining = max(0, deadline - time.monotonic())
+    try:
+        output, truncated = await asyncio.wait_for(communicate(), remaining)
+    except asyncio.TimeoutError:
+        log.warning("command-timeout", pid=proc.pid, action="kill")
+        await _kill(proc, log)
+        raise TimeoutError()
+    except BaseException:
+        await _kill(proc, log)
+        raise
+    finally:
+        # Don't leave the transport to be cleaned up after the event loop
+        # has been closed.
+        if proc.stdin is not None:
+            proc.stdin.close()
+    if truncated:
+        log.warning("command-output-truncated", max_output=max_output)
+    return proc.returncode, output
+
+
+def run_sync(*args, **kw):
+    """Synchronous facade for `run`.
+
+    Works both from plain threads and from within a running event loop
+    (where it blocks the calling coroutine).
+
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run(*args, **kw))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, run(*args, **kw)).result()
@@ -47,16 +47,35 @@ class SysConfig(object):
         self.ceph = {}
         self.agent = {}
 
+    CONFIG_FILES = [
+        os.path.dirname(__file__) + "/default.conf",
+        "/etc/qemu/fc-qemu.conf",
+    ]
+
     def read_config_files(self):
         """Tries to open fc-qemu.conf at various location."""
         self.cp = configparser.ConfigParser()
-        self.cp.read(os.path.dirname(__file__) + "/default.conf")
-        self.cp.read("/etc/qemu/fc-qemu.conf")
+        self.mtimes = self._config_file_mtimes()
+        for path in self.CONFIG_FILES:
+            self.cp.read(path)
         if "qemu" not in self.cp.sections():
             raise RuntimeError(
                 "error while reading config file: section [qemu] not found"
             )
 
+    def _config_file_mtimes(self):
+        mtimes = []
+        for path in self.CONFIG_FILES:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def changed(self):
+        """Whether a config file changed since the config was loaded."""
+        return self._config_file_mtimes() != getattr(self, "mtimes", None)
+
     def load_system_config(self):
         self.read_config_files()
 
@@ -75,6 +94,21 @@ class SysConfig(object):
         self.qemu["vm_expected_overhead"] = self.cp.getint(
             "qemu", "vm-expected-overhead"
         )
+        self.qemu["guestagent_sync"] = self.cp.get(
+            "qemu", "guest-agent-sync", fallback="delimited"
+        )
+        self.qemu["guest_file_refresh_interval"] = self.cp.getint(
+            "qemu", "guest-file-refresh-interval", fallback=900
+        )
+        self.qemu["qmp_pipelined"] = self.cp.getboolean(
+            "qemu", "qmp-pipelined", fallback=False
+        )
+        self.qemu["qmp_multiplexer_socket"] = self.cp.get(
+            "qemu", "qmp-multiplexer-socket", fallback=""
+        )
+        self.qemu["qmp_cache_ttl"] = self.cp.getfloat(
+            "qemu", "qmp-cache-ttl", fallback=1.0
+        )
 
         self.qemu["block_throttle"] = bt = {}
         for section, items in section_matches_as_dicts(
@@ -89,6 +123,34 @@ class SysConfig(object):
         self.agent["consul_event_threads"] = self.cp.getint(
             "consul", "event-threads"
         )
+        self.agent["consul_event_queue_size"] = self.cp.getint(
+            "consul", "event-queue-size", fallback=1000
+        )
+        self.agent["consul_ensure_rate"] = self.cp.getfloat(
+            "consul", "ensure-rate", fallback=20
+        )
+        self.agent["consul_ensure_rate_max"] = self.cp.getfloat(
+            "consul", "ensure-rate-max", fallback=100
+        )
+
+        # Snapshots
+        self.agent["snapshot_parallelism"] = self.cp.getint(
+            "snapshot", "parallelism", fallback=10
+        )
+        self.agent["snapshot_freeze_timeout"] = self.cp.getint(
+            "snapshot", "freeze-timeout", fallback=300
+        )
+        self.agent["snapshot_gc_rate"] = self.cp.getfloat(
+            "snapshot", "gc-rate", fallback=5
+        )
+
+        # Ensure all
+        self.agent["ensure_all_parallelism"] = self.cp.getint(
+            "ensure-all", "parallelism", fallback=10
+        )
+        self.agent["ensure_all_image_index_ttl"] = self.cp.getfloat(
+            "ensure-all", "image-index-ttl", fallback=60
+        )
 
         # Qemu
         self.agent["accelerator"] = self.cp.get("qemu", "accelerator")
@@ -107,6 +169,17 @@ class SysConfig(object):
             "qemu", "maintenance-evacuation-timeout"
         )
 
+        # External commands
+        self.agent["command_slots"] = self.cp.getint(
+            "commands", "slots", fallback=0
+        )
+        self.agent["command_slot_directory"] = self.cp.get(
+            "commands", "slot-directory", fallback="/run/fc-qemu.command-slots"
+        )
+        self.agent["command_timeout"] = self.cp.getint(
+            "commands", "timeout", fallback=0
+        )
+
         self.agent["network_hooks"] = nh = {}
         for key, path in self.cp.items("network"):
             nh[key.lstrip("tap-")] = path
@@ -126,6 +199,21 @@ class SysConfig(object):
         self.ceph["CREATE_VM"] = self.cp.get("ceph", "create-vm")
         self.ceph["MKFS_XFS"] = self.cp.get("ceph", "mkfs-xfs")
         self.ceph["MKFS_VFAT"] = self.cp.get("ceph", "mkfs-vfat")
+        self.ceph["CEPH_BACKEND"] = self.cp.get(
+            "ceph", "backend", fallback="auto"
+        )
+        self.ceph["CEPH_BROKER_SOCKET"] = self.cp.get(
+            "ceph", "broker-socket", fallback=""
+        )
+        self.ceph["CEPH_POOL_CACHE"] = self.cp.get(
+            "ceph", "pool-cache", fallback=""
+        )
+        self.ceph["CEPH_POOL_CACHE_TTL"] = self.cp.getint(
+            "ceph", "pool-cache-ttl", fallback=300
+        )
+        self.ceph["TMP_TEMPLATE_CACHE"] = self.cp.getboolean(
+            "ceph", "tmp-template-cache", fallback=False
+        )
 
 
 sysconfig = SysConfig()
@@ -6,14 +6,18 @@ import filecmp
 import json
 import os
 import os.path
+import shlex
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 from typing import IO, Any, Callable, Dict, List
 
 from structlog import get_logger
 
+from .sysconfig import sysconfig
+
 MiB = 2**20
 GiB = 2**30
 
@@ -93,6 +97,16 @@ def remove_empty_dirs(d):
         d = os.path.dirname(d)
 
 
+def command_slots():
+    """The host-wide limit for concurrently running commands."""
+    from . import runner
+
+    count = sysconfig.agent.get("command_slots")
+    if not count:
+        return None
+    return runner.CommandSlots(sysconfig.agent["command_slot_directory"], count)
+
+
 def cmd(
     cmdline,
     log,
@@ -100,35 +114,58 @@ def cmd(
     errors="replace",
     timeout=None,
     log_error_verbose=True,
+    input=None,
+    shell=False,
 ):
-    """Execute cmdline with stdin closed to avoid questions on terminal"""
-    # XXX need to implement the timeout ... this likely requires switching to
-    # using asyncio with something like this: https://stackoverflow.com/a/34114767
-    prefix = cmdline.split()[0]
-    args = " ".join(cmdline.split()[1:])
+    """Execute cmdline with stdin closed to avoid questions on terminal
+
+    `cmdline` is either a list of arguments or a string that is split
+    like a shell would do it. No shell is involved, though, unless `shell`
+    is set (for command lines given by the administrator).
+
+    The command gets killed if it doesn't finish within `timeout` seconds,
+    which defaults to the host-wide command timeout (none, unless
+    configured). `input` (bytes) is passed to the command on stdin.
+
+    """
+    if isinstance(cmdline, str):
+        prefix = cmdline.split()[0]
+        args = " ".join(cmdline.split()[1:])
+    else:
+        prefix = cmdline[0]
+        args = shlex.join(cmdline[1:])
     log.debug(prefix, args=args)
-    with open("/dev/null") as null:
-        proc = subprocess.Popen(
-            cmdline,
-            shell=True,
-            stdin=null,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+    if timeout is None:
+        timeout = sysconfig.agent.get("command_timeout") or None
+
+    # The runner pulls in asyncio, which most subcommands never need.
+    from . import runner
+
+    def log_line(line):
+        # This ensures we get partial output in case of test failures
+        log.debug(os.path.basename(prefix), output_line=line)
+
+    try:
+        returncode, stdout = runner.run_sync(
+            ["/bin/sh", "-c", cmdline] if shell else runner.to_argv(cmdline),
+            log,
+            timeout=timeout,
+            input=input,
             encoding=encoding,
             errors=errors,
+            slots=command_slots(),
+            on_line=log_line,
         )
-        # This allows for more interactive logging and capturing
-        # stdout in unit tests even if we get stuck.
-        stdout = ""
-        while True:
-            line = proc.stdout.readline()
-            if line:
-                # This ensures we get partial output in case of test failures
-                log.debug(os.path.basename(prefix), output_line=line)
-                stdout += line
-            else:
-                break
-    returncode = proc.wait()
+    except FileNotFoundError:
+        # Behave like a shell would.
+        returncode, stdout = 127, f"{prefix}: command not found"
+    except OSError as e:
+        # Not executable (or not a valid executable).
+        returncode, stdout = 126, f"{prefix}: {e.strerror or e}"
+    except subprocess.TimeoutExpired as e:
+        log.warning(prefix, timeout=timeout, result="timeout")
+        e.cmd = cmdline
+        raise
     # Keep this here for compatibility with tests
     output = stdout.strip()
     log.debug(prefix, returncode=returncode)
@@ -157,19 +194,22 @@ def today():
     return datetime.date.today()
 
 
-def ensure_separate_cgroup():
-    "Move this process to a separate fc-qemu cgroup."
-    CGROUP = "/sys/fs/cgroup/fc-qemu"
-    if not os.path.exists(CGROUP):
-        try:
-            os.mkdir(CGROUP)
-        except OSError:
-            if not os.path.isdir(CGROUP):
-                raise
-            # The directory exists now. We've run into a race condition.
-            # Keep going.
-    with open("{}/cgroup.procs".format(CGROUP), "w") as f:
-        f.write(str(os.getpid()))
+class RateLimit(object):
+    """Spread calls of `wait` from any number of threads to at most `rate`
+    per second. A rate of 0 does not limit anything."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
 
 
 def parse_export_format(data: str) -> Dict[str, str]:
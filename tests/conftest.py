@@ -4,6 +4,7 @@ import os
 import random
 import shutil
 import socket
+import struct
 import subprocess
 import sys
 import time
@@ -21,7 +22,7 @@ import fc.qemu.agent
 import fc.qemu.hazmat.qemu
 import fc.qemu.logging
 from fc.qemu.agent import Agent
-from fc.qemu.hazmat import libceph
+from fc.qemu.hazmat import diskimage, libceph
 from fc.qemu.hazmat.ceph import Ceph, RootSpec, VolumeSpecification
 from fc.qemu.util import GiB
 
@@ -32,7 +33,7 @@ from fc.qemu.util import GiB
 class RadosMock(object):
     tmp_path: Path
 
-    def __init__(self, conffile, name, log):
+    def __init__(self, conffile, name, log, **kw):
         self.conffile = conffile
         self.name = name
         self._ioctx = {}
@@ -45,6 +46,9 @@ class RadosMock(object):
     def list_pools(self):
         return ["rbd", "data", "rbd.ssd", "rbd.hdd", "rbd.rgw.foo"]
 
+    def invalidate_pools(self):
+        pass
+
 
 class IoctxMock(object):
     """Mock access to a pool."""
@@ -205,6 +209,37 @@ class ImageMock(object):
             )
         return image["mapped_device"]
 
+    def export_diff(self, path):
+        assert not self.closed
+        image = self.ioctx.rbd_images[self._name]
+        chunks = [diskimage.DIFF_HEADER]
+        if self.snapname:
+            name = self.snapname.encode("utf-8")
+            chunks.append(b"t" + struct.pack("<I", len(name)) + name)
+        chunks.append(b"s" + struct.pack("<Q", image["size"]))
+        with image["path"].open("rb") as f:
+            offset = 0
+            while block := f.read(diskimage.OBJECT_SIZE):
+                if block.count(0) != len(block):
+                    chunks.append(b"w" + struct.pack("<QQ", offset, len(block)))
+                    chunks.append(block)
+                offset += len(block)
+        chunks.append(b"e")
+        Path(path).write_bytes(b"".join(chunks))
+
+    def import_diff(self, data):
+        assert not self.closed
+        image = self.ioctx.rbd_images[self._name]
+        with image["path"].open("r+b") as f:
+            for record in diskimage.decode_diff(data):
+                match record:
+                    case ("w", offset, chunk):
+                        f.seek(offset)
+                        f.write(chunk)
+                    case ("z", offset, length):
+                        f.seek(offset)
+                        f.write(bytes(length))
+
     def unmap(self):
         assert not self.closed
         image = self.ioctx.rbd_images[self._name]
@@ -873,3 +908,12 @@ def pytest_assertrepr_compare(op, left, right):
         return left.compare(right).diff
     elif right.__class__.__name__ == "Ellipsis":
         return right.compare(left).diff
+
+
+@pytest.fixture
+def permissive_umask(monkeypatch):
+    """Run with fc-qemu's umask and without chmod'ing sockets afterwards."""
+    umask = os.umask(0)
+    monkeypatch.setattr(Path, "chmod", lambda self, mode: None)
+    yield
+    os.umask(umask)
@@ -5,6 +5,10 @@ import mock
 import pytest
 
 from fc.qemu.hazmat.guestagent import GuestAgent
+from fc.qemu.hazmat.librbd import NativeBackend
+from fc.qemu.util import log
+
+from .fakelibceph import FakeCluster, FakeLibrados, FakeLibrbd
 
 
 @pytest.fixture
@@ -15,12 +19,16 @@ def guest_agent(monkeypatch, tmpdir):
         timeout: int = 0
         messages_sent: typing.List[bytes]
         responses: typing.List[str]
-
-        receive_buffer = ""
+        # Data already waiting in the connection before we send anything.
+        stale: typing.List[bytes]
+        # Data that only arrives after waiting, e.g. delimited responses.
+        received: typing.List[bytes]
 
         def __init__(self):
             self.messages_sent = []
             self.responses = []
+            self.stale = []
+            self.received = []
 
         def settimeout(self, timeout):
             self.timeout = timeout
@@ -35,7 +43,13 @@ def guest_agent(monkeypatch, tmpdir):
             self.messages_sent.append(msg)
 
         def recv(self, buffersize):
-            return self.receive_buffer
+            if self.stale:
+                return self.stale.pop(0)
+            if self.timeout == 0:
+                raise BlockingIOError()
+            if self.received:
+                return self.received.pop(0)
+            return b""
 
         def makefile(self):
             pseudo_socket_filename = tempfile.mktemp(dir=tmpdir)
@@ -53,3 +67,21 @@ def guest_agent(monkeypatch, tmpdir):
     monkeypatch.setattr("random.randint", randint)
 
     return guest_agent
+
+
+@pytest.fixture
+def fake_cluster():
+    return FakeCluster()
+
+
+@pytest.fixture
+def native_backend(fake_cluster):
+    backend = NativeBackend(
+        "/etc/ceph/ceph.conf",
+        "client.admin",
+        log,
+        librados=FakeLibrados(fake_cluster),
+        librbd=FakeLibrbd(fake_cluster),
+    )
+    yield backend
+    backend.shutdown()
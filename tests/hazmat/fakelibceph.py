@@ -0,0 +1,261 @@
+"""In-memory stand-ins for librados and librbd.
+
+They implement the subset of the C API used by the native backend with the
+same calling conventions: out parameters are passed by reference, buffers
+are filled in place and errors are returned as negative errno values.
+
+"""
+
+import ctypes
+import errno
+import itertools
+
+
+def deref(ref):
+    """Return the object behind a `ctypes.byref()` argument."""
+    return ref._obj
+
+
+def fill(buf, strings, length_ref=None):
+    """Write NUL-separated strings into a buffer.
+
+    Returns -ERANGE and updates the length if the buffer is too small.
+
+    """
+    data = b"".join(s.encode("utf-8") + b"\0" for s in strings)
+    if length_ref is not None:
+        length = deref(length_ref)
+        if len(data) > length.value:
+            length.value = len(data)
+            return -errno.ERANGE
+        length.value = len(data)
+    if len(data) > len(buf):
+        return -errno.ERANGE
+    ctypes.memmove(buf, data, len(data))
+    return 0
+
+
+class FakeCluster:
+    def __init__(self, pools=("rbd", "rbd.ssd", "rbd.hdd")):
+        self.pools = {pool: {} for pool in pools}
+        self.handles = {}
+        self.ids = itertools.count(1)
+        self.connected = False
+        self.calls = []
+        self.client = "client.4242"
+        self.address = "192.168.0.1:0/1234"
+
+    def handle(self, obj):
+        handle = next(self.ids)
+        self.handles[handle] = obj
+        return handle
+
+    def lookup(self, handle):
+        return self.handles[handle.value]
+
+
+class FakeLibrados:
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def rados_create2(self, pcluster, clustername, name, flags):
+        self.cluster.calls.append("rados_create2")
+        deref(pcluster).value = self.cluster.handle(self.cluster)
+        return 0
+
+    def rados_conf_read_file(self, cluster, path):
+        return 0
+
+    def rados_connect(self, cluster):
+        self.cluster.calls.append("rados_connect")
+        self.cluster.connected = True
+        return 0
+
+    def rados_shutdown(self, cluster):
+        self.cluster.calls.append("rados_shutdown")
+        self.cluster.connected = False
+
+    def rados_pool_list(self, cluster, buf, length):
+        data = b"".join(p.encode("utf-8") + b"\0" for p in self.cluster.pools)
+        data += b"\0"
+        if len(data) <= length:
+            ctypes.memmove(buf, data, len(data))
+        return len(data)
+
+    def rados_ioctx_create(self, cluster, pool, pioctx):
+        self.cluster.calls.append("rados_ioctx_create")
+        pool = pool.decode("utf-8")
+        if pool not in self.cluster.pools:
+            return -errno.ENOENT
+        deref(pioctx).value = self.cluster.handle(pool)
+        return 0
+
+    def rados_ioctx_destroy(self, ioctx):
+        self.cluster.calls.append("rados_ioctx_destroy")
+
+
+class FakeLibrbd:
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.snapids = itertools.count(1)
+
+    def _images(self, ioctx):
+        return self.cluster.pools[self.cluster.lookup(ioctx)]
+
+    def _image(self, image):
+        return self.cluster.lookup(image)
+
+    def rbd_open(self, ioctx, name, pimage, snapname):
+        images = self._images(ioctx)
+        name = name.decode("utf-8")
+        if name not in images:
+            return -errno.ENOENT
+        image = images[name]
+        if snapname and snapname.decode("utf-8") not in image["snaps"]:
+            return -errno.ENOENT
+        deref(pimage).value = self.cluster.handle(
+            (image, snapname.decode("utf-8") if snapname else None)
+        )
+        self.cluster.calls.append("rbd_open")
+        return 0
+
+    rbd_open_read_only = rbd_open
+
+    def rbd_close(self, image):
+        self.cluster.calls.append("rbd_close")
+        return 0
+
+    def rbd_stat(self, image, pinfo, infosize):
+        image, snapname = self._image(image)
+        info = deref(pinfo)
+        if snapname:
+            info.size = image["snaps"][snapname]["size"]
+        else:
+            info.size = image["size"]
+        info.obj_size = 4 * 1024 * 1024
+        info.num_objs = -(-info.size // info.obj_size)
+        info.order = 22
+        info.block_name_prefix = b"rbd_data.1234"
+        return 0
+
+    def rbd_list(self, ioctx, names, psize):
+        result = fill(names, list(self._images(ioctx)), psize)
+        if result < 0:
+            return result
+        return deref(psize).value
+
+    def rbd_create(self, ioctx, name, size, porder):
+        images = self._images(ioctx)
+        name = name.decode("utf-8")
+        if name in images:
+            return -errno.EEXIST
+        images[name] = {"size": size, "lockers": [], "snaps": {}}
+        return 0
+
+    def rbd_remove(self, ioctx, name):
+        images = self._images(ioctx)
+        name = name.decode("utf-8")
+        if name not in images:
+            return -errno.ENOENT
+        if images[name]["lockers"]:
+            return -errno.EBUSY
+        del images[name]
+        return 0
+
+    def rbd_resize(self, image, size):
+        image, _ = self._image(image)
+        image["size"] = size
+        return 0
+
+    def rbd_lock_exclusive(self, image, cookie):
+        image, _ = self._image(image)
+        cookie = cookie.decode("utf-8")
+        for client, existing, _ in image["lockers"]:
+            if (client, existing) == (self.cluster.client, cookie):
+                return -errno.EEXIST
+            return -errno.EBUSY
+        image["lockers"].append(
+            (self.cluster.client, cookie, self.cluster.address)
+        )
+        return 0
+
+    def rbd_break_lock(self, image, client, cookie):
+        image, _ = self._image(image)
+        locker = (client.decode("utf-8"), cookie.decode("utf-8"))
+        for entry in image["lockers"]:
+            if entry[:2] == locker:
+                image["lockers"].remove(entry)
+                return 0
+        return -errno.ENOENT
+
+    def rbd_list_lockers(
+        self,
+        image,
+        pexclusive,
+        tag,
+        ptag_len,
+        clients,
+        pclients_len,
+        cookies,
+        pcookies_len,
+        addrs,
+        paddrs_len,
+    ):
+        image, _ = self._image(image)
+        lockers = image["lockers"]
+        deref(pexclusive).value = 1
+        results = [
+            fill(tag, [""], ptag_len),
+            fill(clients, [c for c, _, _ in lockers], pclients_len),
+            fill(cookies, [c for _, c, _ in lockers], pcookies_len),
+            fill(addrs, [a for _, _, a in lockers], paddrs_len),
+        ]
+        if -errno.ERANGE in results:
+            return -errno.ERANGE
+        return len(lockers)
+
+    def rbd_snap_list(self, image, snaps, pmax_snaps):
+        image, _ = self._image(image)
+        max_snaps = deref(pmax_snaps)
+        # librbd needs room for a terminating entry
+        if max_snaps.value < len(image["snaps"]) + 1:
+            max_snaps.value = len(image["snaps"]) + 1
+            return -errno.ERANGE
+        for i, (name, snap) in enumerate(image["snaps"].items()):
+            snaps[i].id = snap["id"]
+            snaps[i].size = snap["size"]
+            snaps[i].name = name.encode("utf-8")
+        return len(image["snaps"])
+
+    def rbd_snap_list_end(self, snaps):
+        self.cluster.calls.append("rbd_snap_list_end")
+
+    def rbd_snap_create(self, image, snapname):
+        image, _ = self._image(image)
+        snapname = snapname.decode("utf-8")
+        if snapname in image["snaps"]:
+            return -errno.EEXIST
+        image["snaps"][snapname] = {
+            "id": next(self.snapids),
+            "size": image["size"],
+            "timestamp": 1700000000,
+        }
+        return 0
+
+    def rbd_snap_remove(self, image, snapname):
+        image, _ = self._image(image)
+        if not image["snaps"].pop(snapname.decode("utf-8"), None):
+            return -errno.ENOENT
+        return 0
+
+    def rbd_snap_is_protected(self, image, snapname, pprotected):
+        deref(pprotected).value = 0
+        return 0
+
+    def rbd_snap_get_timestamp(self, image, snapid, ptimestamp):
+        image, _ = self._image(image)
+        for snap in image["snaps"].values():
+            if snap["id"] == snapid:
+                deref(ptimestamp).tv_sec = snap["timestamp"]
+                return 0
+        return -errno.ENOENT
@@ -1,9 +1,21 @@
+import subprocess
+import threading
+import time
 from unittest.mock import Mock, patch
 
 import pytest
 import yaml
 
 from fc.qemu.hazmat import libceph
+from fc.qemu.hazmat.ceph import (
+    TMP_TEMPLATE_BUILDING,
+    TMP_TEMPLATE_PREFIX,
+    TMP_TEMPLATE_SNAPSHOT,
+    ImageIndex,
+    TmpSpec,
+    tmp_template_name,
+)
+from fc.qemu.hazmat.volume import Volume
 from tests.conftest import get_log
 
 
@@ -46,6 +58,7 @@ def test_ceph_stop_remove_only_own_locks(ceph_with_volumes):
     """Test case where failed migrations leave inconsistent locking."""
     ceph_with_volumes.volumes["root"].unlock()
     ceph_with_volumes.volumes["root"].rbdimage.lock_exclusive("someotherhost")
+    ceph_with_volumes.refresh_locks()
     # It unlocks what it can.
     ceph_with_volumes.stop()
     assert ceph_with_volumes.volumes["root"].lock_status()
@@ -53,6 +66,53 @@ def test_ceph_stop_remove_only_own_locks(ceph_with_volumes):
     assert ceph_with_volumes.volumes["tmp"].lock_status() is None
 
 
+def test_ceph_locks_volumes_concurrently(ceph_with_volumes):
+    ceph = ceph_with_volumes
+    ceph.unlock()
+    get_log()
+    volumes = list(ceph.opened_volumes)
+    # All volumes have to enter the lock at the same time.
+    barrier = threading.Barrier(len(volumes), timeout=5)
+
+    def slow_lock_exclusive(lock_exclusive, delay):
+        def wrapper(cookie):
+            barrier.wait()
+            # Finish in reverse order.
+            time.sleep(delay)
+            return lock_exclusive(cookie)
+
+        return wrapper
+
+    for i, volume in enumerate(volumes):
+        volume.rbdimage.lock_exclusive = slow_lock_exclusive(
+            volume.rbdimage.lock_exclusive, (len(volumes) - i) * 0.05
+        )
+    ceph.lock()
+
+    assert ceph.locked_by_me()
+    assert get_log() == "\n".join(
+        f"lock machine=simplevm subsystem=ceph volume={volume.fullname}"
+        for volume in volumes
+    )
+
+
+def test_ceph_unlock_aggregates_errors(ceph_with_volumes):
+    volumes = list(ceph_with_volumes.opened_volumes)
+
+    def broken_unlock(cookie):
+        raise libceph.ImageBusy("broken")
+
+    volumes[0].rbdimage.unlock = broken_unlock
+    with pytest.raises(RuntimeError):
+        ceph_with_volumes.unlock()
+    # The other volumes got unlocked anyway.
+    assert volumes[0].lock_status()
+    for volume in volumes[1:]:
+        assert volume.lock_status() is None
+    assert "unlock-failed" in get_log()
+    del volumes[0].rbdimage.unlock
+
+
 @pytest.mark.live
 def test_ceph_exclusive_lock_can_be_taken_twice_with_same_cookie(ceph_inst):
     """Test case where failed migrations leave inconsistent locking."""
@@ -75,12 +135,101 @@ def test_is_unlocked(ceph_with_volumes):
 def test_multiple_images_raises_error(ceph_inst):
     libceph.RBD().create(ceph_inst.ioctxs["rbd.hdd"], "simplevm.root", 1024)
     libceph.RBD().create(ceph_inst.ioctxs["rbd.ssd"], "simplevm.root", 1024)
+    ceph_inst.image_index.invalidate()
     root_spec = ceph_inst.specs["root"]
     assert sorted(root_spec.exists_in_pools()) == ["rbd.hdd", "rbd.ssd"]
     with pytest.raises(RuntimeError):
         root_spec.exists_in_pool()
 
 
+def test_image_index_lists_each_pool_once(ceph_inst, monkeypatch):
+    listed = []
+    list_images = ceph_inst.rbd.list
+
+    def list_and_count(ioctx):
+        listed.append(ioctx.name)
+        return list_images(ioctx)
+
+    monkeypatch.setattr(ceph_inst.rbd, "list", list_and_count)
+    ceph_inst.image_index.invalidate()
+    for spec in ceph_inst.specs.values():
+        assert spec.exists_in_pools() == []
+    assert sorted(listed) == ["rbd", "rbd.hdd", "rbd.ssd"]
+
+    # Creating an image only invalidates its pool.
+    ceph_inst.specs["tmp"].ensure_presence()
+    assert ceph_inst.specs["tmp"].exists_in_pools() == ["rbd.hdd"]
+    assert sorted(listed) == ["rbd", "rbd.hdd", "rbd.hdd", "rbd.ssd"]
+
+
+def test_shared_image_index_survives_new_sessions(ceph_inst, monkeypatch):
+    listed = []
+    list_images = ceph_inst.rbd.list
+
+    def list_and_count(ioctx):
+        listed.append(ioctx.name)
+        return list_images(ioctx)
+
+    monkeypatch.setattr(ceph_inst.rbd, "list", list_and_count)
+    shared = ImageIndex(None)
+    ceph_inst.image_index = ImageIndex(ceph_inst, share=shared)
+    assert "simplevm.tmp" not in ceph_inst.image_index.images("rbd.hdd")
+    other = ImageIndex(ceph_inst, share=shared)
+    assert "simplevm.tmp" not in other.images("rbd.hdd")
+    assert listed == ["rbd.hdd"]
+
+    ceph_inst.__exit__(None, None, None)
+    ceph_inst.__enter__()
+    other.images("rbd.hdd")
+    assert listed.count("rbd.hdd") == 1
+
+    # Invalidating a pool affects all sharing indexes.
+    ceph_inst.specs["tmp"].ensure_presence()
+    assert "simplevm.tmp" in other.images("rbd.hdd")
+    assert listed.count("rbd.hdd") == 2
+
+
+def test_shared_image_index_expires(ceph_inst, monkeypatch):
+    listed = []
+    list_images = ceph_inst.rbd.list
+
+    def list_and_count(ioctx):
+        listed.append(ioctx.name)
+        return list_images(ioctx)
+
+    monkeypatch.setattr(ceph_inst.rbd, "list", list_and_count)
+    shared = ImageIndex(None, ttl=60)
+    index = ImageIndex(ceph_inst, share=shared)
+    assert index.ttl == 60
+    index.images("rbd.hdd")
+    index.images("rbd.hdd")
+    assert listed == ["rbd.hdd"]
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    index.images("rbd.hdd")
+    assert listed == ["rbd.hdd", "rbd.hdd"]
+
+
+def test_unknown_pool_refreshes_pool_list(ceph_inst, monkeypatch):
+    pools = ceph_inst.rados.list_pools()
+    invalidated = []
+    monkeypatch.setattr(
+        ceph_inst.rados, "invalidate_pools", lambda: invalidated.append(True)
+    )
+    assert ceph_inst.ioctx("rbd.ssd") is ceph_inst.ioctxs["rbd.ssd"]
+    assert invalidated == []
+
+    monkeypatch.setattr(
+        ceph_inst.rados, "list_pools", lambda: pools + ["rbd.new"]
+    )
+    assert ceph_inst.ioctx("rbd.new").name == "rbd.new"
+    assert invalidated == [True]
+
+    with pytest.raises(KeyError):
+        ceph_inst.ioctx("rbd.missing")
+
+
 def test_fc_seed(ceph_with_volumes_ci):
     ceph = ceph_with_volumes_ci
     cidata_spec = ceph.specs["cidata"]
@@ -101,6 +250,165 @@ def test_fc_seed(ceph_with_volumes_ci):
         assert (fc_data / "qemu-binary-generation-booted").exists()
 
 
+def test_swap_start_writes_signature(ceph_with_volumes):
+    swap_spec = ceph_with_volumes.specs["swap"]
+    swap_spec.start()
+    assert not swap_spec.volume.device
+    with swap_spec.volume.mapped() as device:
+        output = subprocess.check_output(
+            ["blkid", "-p", "-o", "export", str(device)], text=True
+        )
+    assert "TYPE=swap" in output.splitlines()
+    assert "LABEL=swap" in output.splitlines()
+
+
+def test_tmp_template_cache(ceph_with_volumes_ci):
+    ceph = ceph_with_volumes_ci
+    ceph.TMP_TEMPLATE_CACHE = True
+    tmp_spec = ceph.specs["tmp"]
+    pool = tmp_spec.volume.ioctx.name
+
+    def templates():
+        ceph.image_index.invalidate(pool)
+        return sorted(
+            name
+            for name in ceph.image_index.images(pool)
+            if name.startswith(TMP_TEMPLATE_PREFIX)
+        )
+
+    try:
+        tmp_spec.start()
+        template = tmp_template_name(tmp_spec.volume.size, ceph.MKFS_XFS)
+        assert templates() == [template]
+        with tmp_spec.volume.mounted() as target:
+            fc_data = target / "fc-data"
+            assert (fc_data / "enc.json").exists()
+            assert (fc_data / "qemu-binary-generation-booted").exists()
+
+        # The template is re-used and rebuilt if the options change.
+        tmp_spec.start()
+        assert templates() == [template]
+        ceph.MKFS_XFS = "-q -f -K -m crc=1"
+        tmp_spec.start()
+        assert templates() == [
+            tmp_template_name(tmp_spec.volume.size, ceph.MKFS_XFS)
+        ]
+        with tmp_spec.volume.mounted() as target:
+            assert (target / "fc-data" / "enc.json").exists()
+    finally:
+        for name in templates():
+            volume = Volume(ceph, ceph.ioctx(pool), name)
+            volume.snapshots.purge()
+            ceph.remove_volume(name, pool)
+
+
+def tmp_templates(ceph, pool):
+    ceph.image_index.invalidate(pool)
+    return sorted(
+        name
+        for name in ceph.image_index.images(pool)
+        if name.startswith(TMP_TEMPLATE_PREFIX)
+    )
+
+
+def test_tmp_template_build_failure_removes_template(
+    ceph_with_volumes_ci, monkeypatch
+):
+    ceph = ceph_with_volumes_ci
+    ceph.TMP_TEMPLATE_CACHE = True
+    tmp_spec = ceph.specs["tmp"]
+    pool = tmp_spec.volume.ioctx.name
+    mkfs = TmpSpec.mkfs
+
+    def mkfs_fails_for_templates(self, volume=None):
+        if volume is not None:
+            raise RuntimeError("mkfs failed")
+        mkfs(self, volume)
+
+    monkeypatch.setattr(TmpSpec, "mkfs", mkfs_fails_for_templates)
+    get_log()
+    tmp_spec.start()
+    log = get_log()
+    assert "build-template-failed" in log
+    assert "apply-template-failed" in log
+    # The volume got a file system nevertheless and no incomplete template
+    # is left behind.
+    assert tmp_templates(ceph, pool) == []
+    with tmp_spec.volume.mounted() as target:
+        assert (target / "fc-data" / "enc.json").exists()
+
+    # The next start builds the template.
+    monkeypatch.setattr(TmpSpec, "mkfs", mkfs)
+    try:
+        tmp_spec.start()
+        assert tmp_templates(ceph, pool) == [
+            tmp_template_name(tmp_spec.volume.size, ceph.MKFS_XFS)
+        ]
+    finally:
+        for name in tmp_templates(ceph, pool):
+            volume = Volume(ceph, ceph.ioctx(pool), name)
+            volume.snapshots.purge()
+            ceph.remove_volume(name, pool)
+
+
+def test_tmp_template_abandoned_build_is_rebuilt(ceph_with_volumes_ci):
+    ceph = ceph_with_volumes_ci
+    ceph.TMP_TEMPLATE_CACHE = True
+    tmp_spec = ceph.specs["tmp"]
+    pool = tmp_spec.volume.ioctx.name
+    name = tmp_template_name(tmp_spec.volume.size, ceph.MKFS_XFS)
+    # Another host started building the template long ago and died.
+    ceph.rbd.create(ceph.ioctx(pool), name, tmp_spec.volume.size)
+    abandoned = Volume(ceph, ceph.ioctx(pool), name)
+    abandoned.snapshots.create(f"{TMP_TEMPLATE_BUILDING}0")
+    abandoned.rbdimage.lock_exclusive("otherhost")
+    abandoned.close()
+    ceph.image_index.invalidate(pool)
+
+    get_log()
+    try:
+        tmp_spec.start()
+        log = get_log()
+        assert "template-abandoned" in log
+        assert "apply-template " in log
+        template = Volume(ceph, ceph.ioctx(pool), name)
+        assert [s.snapname for s in template.snapshots] == [
+            TMP_TEMPLATE_SNAPSHOT
+        ]
+        assert template.lock_status() is None
+    finally:
+        for name in tmp_templates(ceph, pool):
+            volume = Volume(ceph, ceph.ioctx(pool), name)
+            volume.unlock(force=True)
+            volume.snapshots.purge()
+            ceph.remove_volume(name, pool)
+
+
+def test_tmp_template_without_mark_gets_grace_period(ceph_inst, monkeypatch):
+    monkeypatch.setattr("fc.qemu.hazmat.ceph.TMP_TEMPLATE_CREATE_GRACE", 2)
+    tmp_spec = ceph_inst.specs["tmp"]
+    ioctx = ceph_inst.ioctx("rbd.hdd")
+    name = TMP_TEMPLATE_PREFIX + "test"
+    # Another host just created the template and marks it in a moment.
+    ceph_inst.rbd.create(ioctx, name, 1024 * 1024)
+    template = Volume(ceph_inst, ioctx, name)
+    builder = Volume(ceph_inst, ioctx, name)
+    mark = threading.Timer(
+        0.2,
+        builder.snapshots.create,
+        args=(f"{TMP_TEMPLATE_BUILDING}{int(time.time())}",),
+    )
+    mark.start()
+    assert not tmp_spec.template_abandoned(template)
+    mark.join()
+
+    # Without a mark after the grace period, the template was abandoned.
+    builder.snapshots.purge()
+    monkeypatch.setattr("fc.qemu.hazmat.ceph.TMP_TEMPLATE_CREATE_GRACE", 0.2)
+    template.snapshots.invalidate()
+    assert tmp_spec.template_abandoned(template)
+
+
 def test_cloud_init_seed_simple(ceph_inst_cloudinit_enc):
     ceph = ceph_inst_cloudinit_enc
     libceph.RBD().create(
@@ -108,6 +416,7 @@ def test_cloud_init_seed_simple(ceph_inst_cloudinit_enc):
         "simplevm.cidata",
         ceph.cfg["cidata_size"],
     )
+    ceph.image_index.invalidate()
 
     cidata_spec = ceph.specs["cidata"]
     cidata_spec.ensure_presence()
@@ -220,6 +529,7 @@ def test_cloud_init_seed_routed_pub(ceph_inst_cloudinit_enc):
         "simplevm.cidata",
         ceph.cfg["cidata_size"],
     )
+    ceph.image_index.invalidate()
 
     cidata_spec = ceph.specs["cidata"]
     cidata_spec.ensure_presence()
@@ -281,6 +591,7 @@ def test_rbd_pool_migration(ceph_inst, patterns) -> None:
         "simplevm.cidata",
         ceph_inst.cfg["cidata_size"],
     )
+    ceph_inst.image_index.invalidate()
     assert ceph_inst.specs["root"].exists_in_pool() == "rbd.ssd"
     assert ceph_inst.specs["swap"].exists_in_pool() == "rbd.ssd"
     assert ceph_inst.specs["tmp"].exists_in_pool() == "rbd.ssd"
@@ -292,14 +603,10 @@ def test_rbd_pool_migration(ceph_inst, patterns) -> None:
     first_start = patterns.first_start
     first_start.optional(
         """
-waiting interval=0 machine=simplevm remaining=... subsystem=ceph volume=rbd.hdd/simplevm.tmp
-waiting interval=0 machine=simplevm remaining=... subsystem=ceph volume=rbd.hdd/simplevm.cidata
 sgdisk> Setting name!
 sgdisk> partNum is 0
 mkfs.xfs>       mkfs.xfs: small data volume, ignoring data volume stripe unit ... and stripe width ...
 found-partition ...
-udevadm args=settle machine=simplevm subsystem=ceph volume=rbd.hdd/...
-udevadm machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/...
 blkid args=/dev/rbd/rbd.hdd/simplevm...-part1 machine=simplevm subsystem=ceph volume=rbd.hdd/...
 blkid>  /dev/rbd/rbd.hdd/simplevm...-part1: ...
 blkid machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/...
@@ -330,10 +637,7 @@ lock machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.swap
 ensure-size machine=simplevm subsystem=ceph volume_spec=swap
 start machine=simplevm subsystem=ceph volume_spec=swap
 start-swap machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.swap
-mkswap args=-f -L "swap" /dev/rbd/rbd.hdd/simplevm.swap machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.swap
-mkswap> Setting up swapspace version 1, size = 50 MiB (52424704 bytes)
-mkswap> LABEL=swap, UUID=...-...-...-...-...
-mkswap machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/simplevm.swap
+write-image machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.swap
 
 pre-start machine=simplevm subsystem=ceph volume_spec=tmp
 delete-outdated-tmp image=simplevm.tmp machine=simplevm pool=rbd.ssd subsystem=ceph volume=simplevm.tmp
@@ -370,28 +674,9 @@ lock machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
 ensure-size machine=simplevm subsystem=ceph volume_spec=cidata
 start machine=simplevm subsystem=ceph volume_spec=cidata
 start-cloud-init machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-create-fs machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-sgdisk args=-o "/dev/rbd/rbd.hdd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-sgdisk> Creating new GPT entries in memory.
-sgdisk> The operation has completed successfully.
-sgdisk machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/simplevm.cidata
-sgdisk args=-n 1:: -c "1:cidata" -t 1:8300 "/dev/rbd/rbd.hdd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-sgdisk> The operation has completed successfully.
-sgdisk machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/simplevm.cidata
-partprobe args=/dev/rbd/rbd.hdd/simplevm.cidata machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/simplevm.cidata
-mkfs.vfat args=-n "cidata" /dev/rbd/rbd.hdd/simplevm.cidata-part1 machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-mkfs.vfat>      mkfs.fat: Warning: lowercase labels might not work properly on some systems
-mkfs.vfat>      mkfs.fat 4.2 (2021-01-31)
-mkfs.vfat machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/simplevm.cidata
 seed-fc machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-partprobe args=/dev/rbd/rbd.hdd/simplevm.cidata machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/simplevm.cidata
-mount args="/dev/rbd/rbd.hdd/simplevm.cidata-part1" "/mnt/rbd/rbd.hdd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-mount machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/simplevm.cidata
 guest-properties machine=simplevm properties={'binary_generation': 2} subsystem=ceph volume=rbd.hdd/simplevm.cidata
-umount args="/mnt/rbd/rbd.hdd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
-umount machine=simplevm returncode=0 subsystem=ceph volume=rbd.hdd/simplevm.cidata
+write-image machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.cidata
 rbd-status locker=None machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.root
 rbd args=status --format json rbd.hdd/simplevm.root machine=simplevm subsystem=ceph volume=rbd.hdd/simplevm.root
 rbd>    {"watchers":[],"migration":{"source_pool_name":"rbd.ssd","source_pool_namespace":"","source_image_name":"simplevm.root","source_image_id":"...","dest_pool_name":"rbd.hdd","dest_pool_namespace":"","dest_image_name":"simplevm.root","dest_image_id":"...","state":"prepared","state_description":""}}
@@ -0,0 +1,157 @@
+import os
+import socket
+import stat
+import subprocess
+import threading
+
+import pytest
+
+from fc.qemu.hazmat.cephbroker import (
+    BrokerBackend,
+    BrokerUnavailable,
+    decode_exception,
+    encode_exception,
+    running_broker,
+)
+from fc.qemu.hazmat.libceph import (
+    RBD,
+    Image,
+    ImageBusy,
+    ImageNotFound,
+    Rados,
+)
+from fc.qemu.util import log
+
+
+@pytest.fixture
+def broker(tmp_path, native_backend):
+    with running_broker(tmp_path / "ceph.sock", native_backend, log) as server:
+        yield server
+
+
+def test_broker_socket_is_private_from_the_start(
+    tmp_path, native_backend, permissive_umask
+):
+    path = tmp_path / "ceph.sock"
+    with running_broker(path, native_backend, log):
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_rados_uses_broker_if_present(broker, fake_cluster):
+    rados = Rados(
+        "/etc/ceph/ceph.conf",
+        "client.admin",
+        log,
+        broker_socket=str(broker.path),
+    )
+    assert rados.backend.kind == "broker"
+    pool = rados.open_ioctx("rbd.ssd")
+
+    with pytest.raises(ImageNotFound):
+        Image(pool, "test")
+    RBD().create(pool, "test", 1024)
+    assert "test" in fake_cluster.pools["rbd.ssd"]
+
+    image = Image(pool, "test")
+    assert image.size() == 1024
+    image.lock_exclusive("host1")
+    assert image.list_lockers()["lockers"] == [
+        ("client.4242", "host1", "192.168.0.1:0/1234")
+    ]
+    with pytest.raises(ImageBusy):
+        image.lock_exclusive("host2")
+    image.unlock("host1")
+    image.create_snap("foo")
+    assert [s["name"] for s in image.list_snaps()] == ["foo"]
+
+    # All clients share the single cluster connection of the broker.
+    assert fake_cluster.calls.count("rados_connect") == 1
+
+
+def test_rados_without_broker_uses_direct_backend(tmp_path):
+    rados = Rados(
+        "/etc/ceph/ceph.conf",
+        "client.admin",
+        log,
+        backend="cli",
+        broker_socket=str(tmp_path / "ceph.sock"),
+    )
+    assert rados.backend is rados.cli
+
+
+def test_broker_falls_back_if_it_goes_away(tmp_path, native_backend):
+    fallback_calls = []
+
+    class Fallback:
+        def list_pools(self):
+            fallback_calls.append("list_pools")
+            return ["fallback"]
+
+    backend = BrokerBackend(tmp_path / "ceph.sock", log, Fallback)
+    assert backend.list_pools() == ["fallback"]
+
+    with running_broker(tmp_path / "ceph.sock", native_backend, log):
+        assert backend.list_pools() == ["rbd", "rbd.ssd", "rbd.hdd"]
+    assert not (tmp_path / "ceph.sock").exists()
+
+    assert backend.list_pools() == ["fallback"]
+    assert fallback_calls == ["list_pools", "list_pools"]
+
+
+def test_broker_does_not_repeat_changes_after_losing_the_connection(
+    tmp_path,
+):
+    fallback_calls = []
+
+    class Fallback:
+        def list_pools(self):
+            fallback_calls.append("list_pools")
+            return ["fallback"]
+
+        def create(self, pool, name, size):
+            fallback_calls.append("create")
+
+    # A broker that dies after receiving each request.
+    path = str(tmp_path / "ceph.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    def serve():
+        for _ in range(2):
+            conn, _ = server.accept()
+            with conn, conn.makefile("rb") as f:
+                f.readline()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    backend = BrokerBackend(path, log, Fallback)
+    with pytest.raises(BrokerUnavailable):
+        backend.create("rbd.ssd", "test", 1024)
+    assert backend.list_pools() == ["fallback"]
+    assert fallback_calls == ["list_pools"]
+    thread.join()
+    server.close()
+
+
+def test_broker_exception_roundtrip():
+    e = decode_exception(encode_exception(ImageBusy(16, "busy")))
+    assert isinstance(e, ImageBusy)
+    assert e.args == (16, "busy")
+
+    e = decode_exception(
+        encode_exception(
+            subprocess.CalledProcessError(2, "rbd info", output="error")
+        )
+    )
+    assert isinstance(e, subprocess.CalledProcessError)
+    assert e.returncode == 2
+    assert e.output == "error"
+
+    e = decode_exception(encode_exception(FileNotFoundError(2, "missing")))
+    assert isinstance(e, OSError)
+    assert e.errno == 2
+
+    e = decode_exception(encode_exception(KeyError("foo")))
+    assert "KeyError" in str(e)
@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+from fc.qemu.hazmat import devices
+from fc.qemu.timeout import TimeoutError
+
+
+def create_later(path, delay=0.2):
+    def create():
+        time.sleep(delay)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+
+    thread = threading.Thread(target=create)
+    thread.start()
+    return thread
+
+
+def test_wait_for_existing(tmp_path):
+    (tmp_path / "b").touch()
+    assert devices.wait_for([tmp_path / "a", tmp_path / "b"], 1) == (
+        tmp_path / "b"
+    )
+
+
+def test_wait_for_wakes_up_on_creation(tmp_path, monkeypatch):
+    # Make sure we don't just find it through the safety interval.
+    monkeypatch.setattr(devices, "SAFETY_INTERVAL", 30)
+    target = tmp_path / "a" / "b" / "device"
+    thread = create_later(target)
+    start = time.monotonic()
+    assert devices.wait_for([target], 10) == target
+    assert time.monotonic() - start < 5
+    thread.join()
+
+
+def test_wait_for_check(tmp_path):
+    target = tmp_path / "device"
+    target.touch()
+    with pytest.raises(TimeoutError):
+        devices.wait_for([target], 0.2, check=lambda p: p.is_block_device())
+
+
+def test_wait_for_timeout(tmp_path):
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        devices.wait_for([tmp_path / "missing"], 0.3)
+    assert time.monotonic() - start >= 0.3
+
+
+def test_wait_for_without_inotify(tmp_path, monkeypatch):
+    def unavailable():
+        raise OSError("no inotify")
+
+    monkeypatch.setattr(devices, "Inotify", unavailable)
+    target = tmp_path / "device"
+    thread = create_later(target)
+    assert devices.wait_for([target], 10) == target
+    thread.join()
@@ -0,0 +1,296 @@
+import shutil
+import struct
+import subprocess
+import uuid
+import zlib
+
+import pytest
+
+from fc.qemu.hazmat import diskimage
+
+MiB = 1024 * 1024
+
+FILES = {
+    "fc-data/enc.json": b'{"name": "simplevm"}\n',
+    "fc-data/qemu-guest-properties-booted": b'{"binary_generation": 2}',
+    "meta-data": b"instance-id: simplevm\n",
+    "user-data": b"#cloud-config\n" + b"x" * 5000,
+    "network-config": b"",
+}
+
+
+def render(image, path):
+    """Write an image to a file by applying its diff."""
+    with path.open("wb") as f:
+        f.truncate(image.size)
+        for record in diskimage.decode_diff(diskimage.encode_diff(image)):
+            if record[0] == "w":
+                f.seek(record[1])
+                f.write(record[2])
+    return path.read_bytes()
+
+
+def read_fat(data, offset):
+    """A minimal FAT reader, returns the label and a dict of all files."""
+    boot = data[offset : offset + 512]
+    (
+        sector_size,
+        sectors_per_cluster,
+        reserved,
+        fat_count,
+        root_entries,
+        _,
+        _,
+        fat_sectors,
+    ) = struct.unpack_from("<HBHBHHBH", boot, 11)
+    bits = int(boot[54:62].decode("ascii").strip()[3:])
+    fat_offset = offset + reserved * sector_size
+    root_offset = fat_offset + fat_count * fat_sectors * sector_size
+    data_offset = root_offset + root_entries * 32
+    cluster_size = sectors_per_cluster * sector_size
+    assert data[fat_offset : fat_offset + fat_sectors * sector_size] == (
+        data[root_offset - fat_sectors * sector_size : root_offset]
+    )
+
+    def next_cluster(cluster):
+        if bits == 16:
+            return struct.unpack_from("<H", data, fat_offset + 2 * cluster)[0]
+        (value,) = struct.unpack_from("<H", data, fat_offset + cluster * 3 // 2)
+        return value >> 4 if cluster % 2 else value & 0xFFF
+
+    def read_chain(cluster):
+        result = b""
+        while cluster < (1 << bits) - 8:
+            start = data_offset + (cluster - 2) * cluster_size
+            result += data[start : start + cluster_size]
+            cluster = next_cluster(cluster)
+        return result
+
+    def read_directory(raw):
+        entries = {}
+        label = None
+        long_name = []
+        for i in range(0, len(raw), 32):
+            entry = raw[i : i + 32]
+            if entry[0] == 0:
+                break
+            attributes = entry[11]
+            if attributes == 0x0F:
+                part = entry[1:11] + entry[14:26] + entry[28:32]
+                long_name.insert(0, (part, entry[13]))
+                continue
+            name = entry[:11]
+            if attributes & 0x08:
+                label = name.decode("ascii").strip()
+                continue
+            if name.startswith(b"."):
+                continue
+            checksum = 0
+            for byte in name:
+                checksum = ((checksum & 1) << 7) + (checksum >> 1) + byte
+                checksum &= 0xFF
+            assert all(c == checksum for _, c in long_name)
+            units = b"".join(part for part, _ in long_name)
+            name = units.decode("utf-16-le").split("\0")[0]
+            long_name = []
+            cluster, size = struct.unpack_from("<HI", entry, 26)
+            entries[name] = (attributes, cluster, size)
+        return label, entries
+
+    def walk(raw, prefix=""):
+        _, entries = read_directory(raw)
+        for name, (attributes, cluster, size) in entries.items():
+            if attributes & 0x10:
+                yield from walk(read_chain(cluster), f"{prefix}{name}/")
+            else:
+                yield f"{prefix}{name}", read_chain(cluster)[:size]
+
+    root = data[root_offset:data_offset]
+    label, _ = read_directory(root)
+    return label, dict(walk(root))
+
+
+def test_fat_layout():
+    assert diskimage.fat_layout(18399) == (16, 1, 72, 18222)
+    assert diskimage.fat_layout(4000) == (12, 1, 12, 3943)
+    # Clusters grow for larger file systems.
+    assert diskimage.fat_layout(256 * 2048)[:2] == (16, 8)
+    with pytest.raises(ValueError):
+        diskimage.fat_layout(8 * 1024 * 2048)
+
+
+def test_short_names():
+    existing = set()
+    assert diskimage.short_name("enc.json", existing) == b"ENC~1   JSO"
+    assert diskimage.short_name("enc.json", existing) == b"ENC~2   JSO"
+    assert (
+        diskimage.short_name("qemu-guest-properties-booted", existing)
+        == b"QEMU-G~1   "
+    )
+    assert diskimage.short_name("a b+c.d", existing) == b"AB_C~1  D  "
+
+
+@pytest.mark.parametrize("size", [10 * MiB, 3 * MiB, 64 * MiB])
+def test_image_roundtrip(tmp_path, size):
+    image = diskimage.partitioned_fat_image(size, "cidata", FILES)
+    data = render(image, tmp_path / "image.raw")
+    assert len(data) == size
+    label, files = read_fat(data, diskimage.PARTITION_START * 512)
+    assert label == "cidata"
+    assert files == FILES
+
+
+def test_gpt(tmp_path):
+    size = 10 * MiB
+    image = diskimage.partitioned_fat_image(size, "cidata", FILES)
+    data = render(image, tmp_path / "image.raw")
+    sectors = size // 512
+    assert data[510:512] == b"\x55\xaa"
+    assert data[450] == 0xEE
+
+    for header_lba, entries_lba in [(1, 2), (sectors - 1, sectors - 33)]:
+        header = data[header_lba * 512 : header_lba * 512 + 92]
+        assert header[:8] == b"EFI PART"
+        (crc,) = struct.unpack_from("<I", header, 16)
+        assert crc == zlib.crc32(header[:16] + b"\0\0\0\0" + header[20:])
+        current, _, first, last = struct.unpack_from("<QQQQ", header, 24)
+        assert current == header_lba
+        assert (first, last) == (34, sectors - 34)
+        start, count, entry_size, entries_crc = struct.unpack_from(
+            "<QIII", header, 72
+        )
+        assert start == entries_lba
+        entries = data[start * 512 : start * 512 + count * entry_size]
+        assert entries_crc == zlib.crc32(entries)
+
+        type_guid = uuid.UUID(bytes_le=entries[:16])
+        assert type_guid == diskimage.LINUX_FILESYSTEM
+        assert struct.unpack_from("<QQ", entries, 32) == (2048, sectors - 34)
+        name = entries[56:128].decode("utf-16-le").rstrip("\0")
+        assert name == "cidata"
+
+
+def test_image_too_small():
+    with pytest.raises(ValueError):
+        diskimage.partitioned_fat_image(1 * MiB, "cidata", FILES)
+
+
+def test_image_out_of_space():
+    with pytest.raises(ValueError):
+        diskimage.partitioned_fat_image(
+            2 * MiB, "cidata", {"big": b"x" * 2 * MiB}
+        )
+
+
+def test_diff_roundtrip():
+    image = diskimage.SparseImage(4096)
+    image.write(512, b"foo")
+    image.write(0, b"bar")
+    assert list(diskimage.decode_diff(diskimage.encode_diff(image))) == [
+        ("z", 0, 4096),
+        ("w", 0, b"bar"),
+        ("w", 512, b"foo"),
+    ]
+    with pytest.raises(ValueError):
+        image.write(4095, b"xx")
+    with pytest.raises(ValueError):
+        list(diskimage.decode_diff(b"rbd diff v2\n"))
+
+
+def test_blkid_matches_mkfs(tmp_path):
+    image = diskimage.partitioned_fat_image(10 * MiB, "cidata", FILES)
+    path = tmp_path / "image.raw"
+    render(image, path)
+
+    def blkid(path, offset=None):
+        args = ["blkid", "-p", "-o", "export"]
+        if offset is not None:
+            args += ["-O", str(offset)]
+        output = subprocess.check_output(args + [str(path)], text=True)
+        return dict(line.split("=", 1) for line in output.splitlines())
+
+    assert blkid(path)["PTTYPE"] == "gpt"
+    fs = blkid(path, 2048 * 512)
+    assert fs["TYPE"] == "vfat"
+    assert fs["LABEL"] == "cidata"
+
+    if not shutil.which("mkfs.vfat"):
+        return
+    # A file system the size of the partition, as created by `mkfs.vfat`.
+    reference = tmp_path / "reference.raw"
+    with reference.open("wb") as f:
+        f.truncate((20480 - 34 - 2048 + 1) * 512)
+    subprocess.check_call(
+        ["mkfs.vfat", "-n", "cidata", str(reference)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    expected = blkid(reference)
+    assert (fs["TYPE"], fs["LABEL"]) == (expected["TYPE"], expected["LABEL"])
+
+
+@pytest.mark.skipif(not shutil.which("mtype"), reason="requires mtools")
+def test_mtools_reads_image(tmp_path):
+    image = diskimage.partitioned_fat_image(10 * MiB, "cidata", FILES)
+    path = tmp_path / "image.raw"
+    render(image, path)
+    target = f"{path}@@{2048 * 512}"
+    for name, content in FILES.items():
+        output = subprocess.check_output(
+            ["mtype", "-i", target, f"::{name}"],
+            env={"MTOOLS_SKIP_CHECK": "1"},
+        )
+        assert output == content
+
+
+def test_overwrite_diff():
+    object_size = 4096
+    exported = b"".join(
+        [
+            diskimage.DIFF_HEADER,
+            b"t" + struct.pack("<I", 8) + b"template",
+            b"s" + struct.pack("<Q", 8 * object_size),
+            # Data, a whole zeroed object and a partially zeroed one
+            b"w" + struct.pack("<QQ", 0, 3 * object_size),
+            b"x" * 100 + bytes(2 * object_size - 100) + bytes(object_size),
+            # Discards are only kept for whole objects
+            b"z" + struct.pack("<QQ", 4 * object_size - 10, object_size + 20),
+            b"e",
+        ]
+    )
+    diff = diskimage.overwrite_diff(exported, object_size=object_size)
+    assert list(diskimage.decode_diff(diff)) == [
+        ("w", 0, b"x" * 100 + bytes(object_size - 100)),
+        ("z", object_size, 2 * object_size),
+        ("w", 4 * object_size - 10, bytes(10)),
+        ("z", 4 * object_size, object_size),
+        ("w", 5 * object_size, bytes(10)),
+    ]
+
+
+@pytest.mark.skipif(not shutil.which("mkswap"), reason="requires mkswap")
+def test_swap_header_matches_mkswap(tmp_path):
+    size = 64 * MiB
+    swap_uuid = uuid.UUID("6a7c1d2e-1111-4222-8333-444455556666")
+    reference = tmp_path / "reference.raw"
+    with reference.open("wb") as f:
+        f.truncate(size)
+    reference.chmod(0o600)
+    subprocess.check_call(
+        ["mkswap", "-f", "-L", "swap", "-U", str(swap_uuid), str(reference)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    image = diskimage.SparseImage(size)
+    image.write(0, diskimage.swap_header(size, "swap", swap_uuid))
+    diff = diskimage.encode_diff(image, discard=False)
+    assert [r[0] for r in diskimage.decode_diff(diff)] == ["w"]
+    assert render(image, tmp_path / "image.raw") == reference.read_bytes()
+
+
+def test_swap_header_limits():
+    with pytest.raises(ValueError):
+        diskimage.swap_header(9 * 4096, "swap", pagesize=4096)
+    with pytest.raises(ValueError):
+        diskimage.swap_header(MiB, "x" * 17)
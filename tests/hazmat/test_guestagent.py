@@ -1,8 +1,15 @@
 import io
+import json
+import socket
 
 import pytest
 
-from fc.qemu.hazmat.guestagent import ClientError
+from fc.qemu.hazmat.guestagent import (
+    ClientError,
+    GuestFileCache,
+    GuestSession,
+)
+from fc.qemu.util import log
 
 
 def test_ga_read(guest_agent):
@@ -17,6 +24,7 @@ def test_ga_read_error(guest_agent):
 
 
 def test_ga_sync_immediate(guest_agent):
+    guest_agent.sync_mode = "legacy"
     guest_agent._client_stub.responses = [
         '{"return": 87643}',
     ]
@@ -34,6 +42,7 @@ def test_ga_sync_immediate(guest_agent):
 
 
 def test_ga_sync_wrong_response(guest_agent):
+    guest_agent.sync_mode = "legacy"
     guest_agent._client_stub.responses = [
         '{"return": 1}',
     ]
@@ -45,3 +54,172 @@ def test_ga_sync_wrong_response(guest_agent):
         b'{"execute": "guest-fsfreeze-thaw"}',
         b'{"execute": "guest-sync", "arguments": {"id": 87643}}',
     ]
+
+
+SYNC_DELIMITED = (
+    b'\xff{"execute": "guest-sync-delimited", "arguments": {"id": 87643}}'
+)
+
+
+def test_ga_sync_delimited(guest_agent):
+    stub = guest_agent._client_stub
+    stub.stale = [b'{"return": 1}\n{"retu']
+    stub.received = [
+        # A response for a client that went away and the gratuitous thaw.
+        b'rn": 2}\n\xff{"return": 1}\n{"return": 0}\n',
+        b'\xff{"return": 87',
+        b"643}\n",
+    ]
+    guest_agent.connect()
+    assert guest_agent.sync_mode == "delimited"
+    assert stub.messages_sent == [
+        b'{"execute": "guest-fsfreeze-thaw"}',
+        SYNC_DELIMITED,
+    ]
+    assert stub.stale == stub.received == []
+
+
+def test_ga_sync_delimited_timeout(guest_agent, monkeypatch):
+    monkeypatch.setattr("fc.qemu.hazmat.guestagent.SYNC_TIMEOUT", 0)
+    guest_agent._client_stub.received = [b'{"return": 0}\n']
+    with pytest.raises(socket.timeout):
+        guest_agent.connect()
+    assert guest_agent.client is None
+
+
+def test_ga_sync_delimited_connection_closed(guest_agent):
+    with pytest.raises(ClientError):
+        guest_agent.connect()
+    assert guest_agent.client is None
+
+
+def test_ga_sync_delimited_falls_back_to_legacy(guest_agent):
+    stub = guest_agent._client_stub
+    stub.received = [
+        b'{"return": 0}\n{"error": {"class": "CommandNotFound", '
+        b'"desc": "The command guest-sync-delimited has not been found"}}\n'
+    ]
+    stub.responses = ['{"return": 87643}']
+    guest_agent.connect()
+    assert guest_agent.sync_mode == "legacy"
+    assert stub.messages_sent == [
+        b'{"execute": "guest-fsfreeze-thaw"}',
+        SYNC_DELIMITED,
+        b'{"execute": "guest-sync", "arguments": {"id": 87643}}',
+    ]
+
+
+def test_ga_session_pipelines_writes_and_execs(guest_agent):
+    stub = guest_agent._client_stub
+    stub.received = [b'\xff{"return": 87643}\n']
+    stub.responses = [
+        '{"return": 1}',
+        '{"return": 2}',
+        '{"return": {"count": 3}}',
+        '{"return": {}}',
+        '{"return": {"count": 3}}',
+        '{"return": {}}',
+        '{"return": {"pid": 42}}',
+        '{"return": {"exited": false}}',
+        '{"return": {"exited": true, "exitcode": 0}}',
+    ]
+    errors = []
+    session = GuestSession(guest_agent)
+    session.write_file("/tmp/foo", b"foo", on_error=errors.append)
+    bar = session.write_file("/tmp/bar", b"bar", on_error=errors.append)
+    chmod = session.exec("chmod", ["0600", "/tmp/bar"], after=bar)
+    session.run()
+    assert errors == []
+    assert chmod.done and chmod.error is None
+    assert [json.loads(m)["execute"] for m in stub.messages_sent[2:]] == [
+        "guest-file-open",
+        "guest-file-open",
+        "guest-file-write",
+        "guest-file-close",
+        "guest-file-write",
+        "guest-file-close",
+        "guest-exec",
+        "guest-exec-status",
+        "guest-exec-status",
+    ]
+
+
+def test_ga_session_reports_errors_per_operation(guest_agent):
+    stub = guest_agent._client_stub
+    stub.received = [b'\xff{"return": 87643}\n']
+    stub.responses = [
+        '{"error": {"class": "GenericError", "desc": "read-only"}}',
+        '{"return": 2}',
+        '{"return": {"count": 3}}',
+        '{"return": {}}',
+        '{"return": {"pid": 42}}',
+        '{"return": {"exited": true, "exitcode": 1}}',
+    ]
+    errors = []
+    session = GuestSession(guest_agent)
+    foo = session.write_file("/tmp/foo", b"foo", on_error=errors.append)
+    session.exec("chmod", ["0600", "/tmp/foo"], after=foo)
+    session.write_file("/tmp/bar", b"bar")
+    session.exec("true", [], on_error=errors.append)
+    session.run()
+    assert len(errors) == 2
+    assert isinstance(errors[0], ClientError)
+    assert str(errors[1]) == "Command failed with exitcode 1"
+    # The skipped command was never sent.
+    assert [json.loads(m)["execute"] for m in stub.messages_sent[2:]] == [
+        "guest-file-open",
+        "guest-file-open",
+        "guest-file-write",
+        "guest-file-close",
+        "guest-exec",
+        "guest-exec-status",
+    ]
+
+
+def test_ga_session_connection_failure(guest_agent):
+    errors = []
+    session = GuestSession(guest_agent)
+    session.write_file("/tmp/foo", b"foo", on_error=errors.append)
+    session.exec("true", [], on_error=errors.append)
+    session.run()
+    assert len(errors) == 2
+    assert all(isinstance(e, ClientError) for e in errors)
+
+
+def test_ga_session_skips_unchanged_files(guest_agent, tmp_path):
+    stub = guest_agent._client_stub
+    stub.received = [b'\xff{"return": 87643}\n']
+    stub.responses = [
+        '{"return": 1}',
+        '{"return": {"count": 3}}',
+        '{"return": {}}',
+        '{"return": {"pid": 42}}',
+        '{"return": {"exited": true, "exitcode": 0}}',
+    ]
+    path = tmp_path / "qemu.testvm.guest-files.json"
+
+    def session(start=1000.0, refresh_interval=60):
+        cache = GuestFileCache(path, start, refresh_interval, log)
+        session = GuestSession(guest_agent, cache)
+        keys = session.write_file("/root/.ssh/authorized_keys_fc", b"keys")
+        chmod = session.exec("chmod", ["0600", "/tmp/foo"], after=keys)
+        return session, keys, chmod
+
+    s, keys, chmod = session()
+    s.run()
+    assert not keys.skipped and not chmod.skipped
+    assert len(stub.messages_sent) == 7
+
+    # Neither the write nor the command depending on it are sent again.
+    s, keys, chmod = session()
+    s.run()
+    assert keys.skipped and chmod.skipped
+    assert len(stub.messages_sent) == 7
+
+    # The cache is only valid for the same Qemu process and some time.
+    assert not session(start=1001.0)[1].skipped
+    assert not session(refresh_interval=0)[1].skipped
+    cache = GuestFileCache(path, 1000.0, 60, log)
+    assert not cache.unchanged("/root/.ssh/authorized_keys_fc", b"other")
+    cache.files["/root/.ssh/authorized_keys_fc"]["written"] -= 61
+    assert not cache.unchanged("/root/.ssh/authorized_keys_fc", b"keys")
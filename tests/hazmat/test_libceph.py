@@ -4,7 +4,8 @@ from subprocess import CalledProcessError
 import pytest
 
 from fc.qemu import util
-from fc.qemu.hazmat.libceph import Image, ImageBusy, ImageNotFound
+from fc.qemu.hazmat.libceph import Image, ImageBusy, ImageNotFound, Rados
+from fc.qemu.util import log
 
 
 @pytest.mark.live
@@ -82,6 +83,8 @@ def test_rbd_unexpected_output_does_not_cause_image_not_found(
     ceph_inst, monkeypatch
 ):
     pool = ceph_inst.ioctxs["rbd.ssd"]
+    # The error parsing is specific to the CLI backend.
+    monkeypatch.setattr(pool.rados, "backend_kind", "cli")
 
     def failing_cmd(*args, **kw):
         raise CalledProcessError(returncode=1, cmd="foo", output="foobar")
@@ -96,6 +99,8 @@ def test_rbd_unexpected_exception_does_not_cause_image_not_found(
     ceph_inst, monkeypatch
 ):
     pool = ceph_inst.ioctxs["rbd.ssd"]
+    # The error parsing is specific to the CLI backend.
+    monkeypatch.setattr(pool.rados, "backend_kind", "cli")
 
     def failing_cmd(*args, **kw):
         raise KeyError()
@@ -103,3 +108,72 @@ def test_rbd_unexpected_exception_does_not_cause_image_not_found(
     monkeypatch.setattr(util, "cmd", failing_cmd)
     with pytest.raises(KeyError):
         Image(pool, "test")
+
+
+class CountingBackend:
+    kind = "test"
+
+    def __init__(self, pools):
+        self.pools = pools
+        self.calls = 0
+
+    def list_pools(self):
+        self.calls += 1
+        return list(self.pools)
+
+
+@pytest.fixture
+def pool_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(Rados, "POOLS_CACHE", [])
+    return tmp_path / "pools.json"
+
+
+def rados_with_cache(backend, pool_cache, ttl=300):
+    return Rados(
+        "/etc/ceph/ceph.conf",
+        "client.admin",
+        log,
+        backend=backend,
+        pool_cache=str(pool_cache),
+        pool_cache_ttl=ttl,
+    )
+
+
+def test_pool_cache_is_shared_between_processes(pool_cache, monkeypatch):
+    backend = CountingBackend(["rbd", "rbd.ssd"])
+    assert rados_with_cache(backend, pool_cache).list_pools() == [
+        "rbd",
+        "rbd.ssd",
+    ]
+    assert backend.calls == 1
+    assert pool_cache.exists()
+
+    # Another process only has the cache file.
+    monkeypatch.setattr(Rados, "POOLS_CACHE", [])
+    backend.pools.append("rbd.hdd")
+    assert rados_with_cache(backend, pool_cache).list_pools() == [
+        "rbd",
+        "rbd.ssd",
+    ]
+    assert backend.calls == 1
+
+    # Missing pools invalidate the cache.
+    rados = rados_with_cache(backend, pool_cache)
+    rados.invalidate_pools()
+    assert not pool_cache.exists()
+    assert rados.list_pools() == ["rbd", "rbd.ssd", "rbd.hdd"]
+    assert backend.calls == 2
+
+
+def test_pool_cache_expires(pool_cache, monkeypatch):
+    backend = CountingBackend(["rbd"])
+    rados_with_cache(backend, pool_cache).list_pools()
+    monkeypatch.setattr(Rados, "POOLS_CACHE", [])
+    rados_with_cache(backend, pool_cache, ttl=0).list_pools()
+    assert backend.calls == 2
+
+    # Broken cache files are ignored.
+    monkeypatch.setattr(Rados, "POOLS_CACHE", [])
+    pool_cache.write_text("{")
+    assert rados_with_cache(backend, pool_cache).list_pools() == ["rbd"]
+    assert backend.calls == 3
@@ -0,0 +1,120 @@
+import pytest
+
+from fc.qemu.hazmat import libceph
+from fc.qemu.hazmat.libceph import RBD, Image, ImageBusy, ImageNotFound, Rados
+from fc.qemu.util import log
+
+
+@pytest.fixture
+def pool(native_backend):
+    rados = Rados(
+        "/etc/ceph/ceph.conf", "client.admin", log, backend=native_backend
+    )
+    return rados.open_ioctx("rbd.ssd")
+
+
+def test_native_connects_once_and_caches_ioctx(
+    fake_cluster, native_backend, pool
+):
+    assert fake_cluster.connected
+    assert fake_cluster.calls == ["rados_create2", "rados_connect"]
+    assert native_backend.list_pools() == ["rbd", "rbd.ssd", "rbd.hdd"]
+    RBD().create(pool, "test", 1024)
+    RBD().create(pool, "test2", 1024)
+    assert fake_cluster.calls.count("rados_ioctx_create") == 1
+    native_backend.shutdown()
+    assert not fake_cluster.connected
+    assert fake_cluster.calls[-2:] == ["rados_ioctx_destroy", "rados_shutdown"]
+
+
+def test_native_basic_api(fake_cluster, pool):
+    with pytest.raises(ImageNotFound):
+        Image(pool, "test")
+
+    RBD().create(pool, "test", 1000)
+    assert RBD().list(pool) == ["test"]
+
+    image = Image(pool, "test")
+    assert image._info()["name"] == "test"
+
+    assert image.size() == 1000
+    image.resize(2000)
+    assert image.size() == 2000
+
+    assert image.list_lockers()["lockers"] == []
+    image.lock_exclusive("test")
+    assert image.list_lockers()["lockers"] == [
+        ("client.4242", "test", "192.168.0.1:0/1234")
+    ]
+    # allow double locking
+    image.lock_exclusive("test")
+    assert image.list_lockers()["lockers"][0][1] == "test"
+
+    with pytest.raises(ImageBusy):
+        image.lock_exclusive("foobar")
+    assert image.list_lockers()["lockers"][0][1] == "test"
+
+    image.unlock("test")
+    assert image.list_lockers()["lockers"] == []
+
+    with pytest.raises(ImageBusy):
+        image.unlock("foobar")
+
+    assert image.list_snaps() == []
+    image.create_snap("foo")
+    snaps = image.list_snaps()
+    assert len(snaps) == 1
+    snap = snaps[0]
+    assert set(snap) == {"id", "name", "protected", "size", "timestamp"}
+    snap.pop("id")
+    snap.pop("timestamp")
+    assert snap == {"name": "foo", "protected": "false", "size": 2000}
+
+    snap_image = Image(pool, "test", "foo")
+    image.resize(3000)
+    assert snap_image.size() == 2000
+    assert image.size() == 3000
+
+    image.remove_snap("foo")
+    assert image.list_snaps() == []
+
+    RBD().remove(pool, "test")
+    with pytest.raises(ImageNotFound):
+        Image(pool, "test")
+
+    # Every image handle got closed again.
+    assert fake_cluster.calls.count("rbd_open") == fake_cluster.calls.count(
+        "rbd_close"
+    )
+
+
+def test_native_grows_buffers(fake_cluster, native_backend, pool):
+    RBD().create(pool, "test", 1000)
+    image = Image(pool, "test")
+    for i in range(20):
+        image.create_snap(f"snap-{i}")
+    assert len(image.list_snaps()) == 20
+
+    cookie = "a-very-long-cookie-" * 20
+    image.lock_exclusive(cookie)
+    assert image.list_lockers()["lockers"][0][1] == cookie
+
+    fake_cluster.pools.update({f"pool-{i:04d}": {} for i in range(200)})
+    assert len(native_backend.list_pools()) == 203
+
+
+def test_rados_falls_back_to_cli(monkeypatch):
+    def unavailable(conffile, name, log):
+        return None
+
+    monkeypatch.setattr(libceph, "open_native_backend", unavailable)
+    monkeypatch.setattr(Rados, "BACKENDS", {})
+    rados = Rados("/etc/ceph/ceph.conf", "client.admin", log)
+    assert rados.backend is rados.cli
+
+    rados = Rados("/etc/ceph/ceph.conf", "client.admin", log, backend="native")
+    with pytest.raises(RuntimeError):
+        rados.backend
+
+    rados = Rados("/etc/ceph/ceph.conf", "client.admin", log, backend="cli")
+    assert rados.backend is rados.cli
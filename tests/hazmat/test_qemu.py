@@ -1,7 +1,11 @@
+import time
+
 import pytest
 
 from fc.qemu.hazmat.qemu import Qemu
 
+from .test_qmp import FakeQMPServer
+
 
 def test_write_file_expects_bytes(guest_agent):
     qemu = Qemu({"name": "vm00", "id": 2345})
@@ -16,9 +20,9 @@ def test_write_file_no_error(guest_agent):
     qemu = Qemu({"name": "vm00", "id": 2345})
     # the emulated answers of the guest agent:
 
+    # sync ID, hard-coded in fixture
+    guest_agent._client_stub.received = [b'\xff{"return": 87643}\n']
     guest_agent._client_stub.responses = [
-        # sync ID, hard-coded in fixture
-        '{"return": 87643}',
         # emulated non-empty result of executions:
         # guest-file-open
         '{"return": "file-handle-1"}',
@@ -35,8 +39,30 @@ def test_write_file_no_error(guest_agent):
 
     assert guest_agent.client.messages_sent == [
         b'{"execute": "guest-fsfreeze-thaw"}',
-        b'{"execute": "guest-sync", "arguments": {"id": 87643}}',
+        b'\xff{"execute": "guest-sync-delimited", "arguments": {"id": 87643}}',
         b'{"execute": "guest-file-open", "arguments": {"path": "/tmp/foo", "mode": "w"}}',
         b'{"execute": "guest-file-write", "arguments": {"handle": "file-handle-1", "buf-b64": "ImFzZGYi\\n"}}',
         b'{"execute": "guest-file-close", "arguments": {"handle": "file-handle-1"}}',
     ]
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_poll_migration_status_wakes_up_on_events(tmp_path, pipelined):
+    server = FakeQMPServer(tmp_path / "qmp.sock")
+    server.returns["query-migrate"] = {"status": "active"}
+    qemu = Qemu({"name": "vm00", "id": 2345})
+    qemu.qmp_socket = tmp_path / "qmp.sock"
+    qemu.qmp_pipelined = pipelined
+
+    start = time.monotonic()
+    statuses = []
+    for info in qemu.poll_migration_status():
+        statuses.append(info["status"])
+        if len(statuses) == 1:
+            server.returns["query-migrate"] = {"status": "completed"}
+            server.event("MIGRATION", {"status": "completed"})
+    # We didn't have to wait for the next poll interval.
+    assert time.monotonic() - start < 0.9
+    assert statuses == ["active", "completed"]
+    qemu.qmp.close()
+    server.close()
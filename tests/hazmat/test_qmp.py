@@ -0,0 +1,229 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from fc.qemu.hazmat.qmp import (
+    PipelinedQEMUMonitorProtocol,
+    QEMUMonitorProtocol,
+    QMPConnectError,
+    QMPTimeoutError,
+)
+from fc.qemu.util import log
+
+
+class FakeQMPServer:
+    """Answers QMP commands on a unix socket.
+
+    `hold` collects commands with that name and answers them in reverse
+    order once `release` arrives. `emit` sends the given events before
+    responding, `emit-after` sends them together with the response. Other
+    commands return what is configured in `returns`.
+
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.received = []
+        self.returns = {"query-status": {"status": "running"}}
+        self.write_lock = threading.Lock()
+        self.file = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        conn, _ = self.sock.accept()
+        self.conn = conn
+        self.file = conn.makefile("rwb")
+        send = self.send
+        send({"QMP": {"version": {}, "capabilities": []}})
+        held = []
+        decoder = json.JSONDecoder()
+        buffer = ""
+        while data := conn.recv(4096):
+            buffer += data.decode("ascii")
+            while buffer:
+                try:
+                    command, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    break
+                buffer = buffer[end:].lstrip()
+                self.received.append(command)
+                name = command["execute"]
+                args = command.get("arguments", {})
+                response = {"return": {}, "id": command.get("id")}
+                if name == "hold":
+                    held.append(response)
+                    continue
+                if name == "release":
+                    for h in reversed(held):
+                        send(h)
+                    held = []
+                elif name == "emit":
+                    for event in args["events"]:
+                        send({"event": event, "data": {"n": len(held)}})
+                elif name == "emit-after":
+                    # Response and events in a single write.
+                    messages = [response] + [
+                        {"event": event, "data": {}} for event in args["events"]
+                    ]
+                    with self.write_lock:
+                        self.file.write(
+                            b"".join(
+                                json.dumps(m).encode("ascii") + b"\n"
+                                for m in messages
+                            )
+                        )
+                        self.file.flush()
+                    continue
+                elif name in self.returns:
+                    response["return"] = self.returns[name]
+                elif name == "hang":
+                    continue
+                send(response)
+        conn.close()
+
+    def send(self, message):
+        with self.write_lock:
+            self.file.write(json.dumps(message).encode("ascii") + b"\n")
+            self.file.flush()
+
+    def event(self, event, data=None):
+        self.send({"event": event, "data": data or {}})
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def qmp_server(tmp_path):
+    server = FakeQMPServer(tmp_path / "qmp.sock")
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def qmp(qmp_server):
+    qmp = PipelinedQEMUMonitorProtocol(qmp_server.path, log)
+    qmp.settimeout(5)
+    qmp.connect()
+    yield qmp
+    qmp.close()
+
+
+def test_pipelined_commands_are_matched_by_id(qmp, qmp_server):
+    first = qmp.submit("hold")
+    second = qmp.submit("hold")
+    # Responses arrive in reverse order.
+    assert qmp.command("release") == {}
+    assert first.result(1)["id"] < second.result(1)["id"]
+    ids = [c["id"] for c in qmp_server.received]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 4
+
+
+def test_pipelined_drop_in_interface(qmp):
+    assert qmp.command("query-status") == {"status": "running"}
+    assert qmp.cmd("query-status", id="custom")["id"] == "custom"
+    response = qmp.cmd_obj({"execute": "query-status"})
+    assert response["return"] == {"status": "running"}
+
+
+def test_pipelined_timeout(qmp):
+    qmp.settimeout(0.1)
+    with pytest.raises(QEMUMonitorProtocol.timeout):
+        qmp.command("hang")
+    # The connection is still usable afterwards.
+    qmp.settimeout(5)
+    assert qmp.command("query-status") == {"status": "running"}
+
+
+def test_pipelined_events(qmp):
+    qmp.command("emit", events=["STOP", "RESUME", "STOP"])
+    assert qmp.pull_event()["event"] == "STOP"
+    assert [e["event"] for e in qmp.get_events()] == ["RESUME", "STOP"]
+    qmp.clear_events()
+    assert qmp.pull_event() is None
+    with pytest.raises(QMPTimeoutError):
+        qmp.pull_event(wait=0.1)
+
+
+def test_pipelined_event_backlog_is_bounded(qmp_server, monkeypatch):
+    monkeypatch.setattr(PipelinedQEMUMonitorProtocol, "EVENT_BACKLOG", 3)
+    qmp = PipelinedQEMUMonitorProtocol(qmp_server.path, log)
+    qmp.connect()
+    qmp.command("emit", events=["A", "B", "C", "D"])
+    assert [e["event"] for e in qmp.get_events()] == ["B", "C", "D"]
+    qmp.close()
+
+
+def test_pipelined_subscriptions_and_wait(qmp):
+    seen = []
+    qmp.subscribe("MIGRATION", seen.append)
+
+    def emit():
+        time.sleep(0.1)
+        qmp.command("emit", events=["STOP", "MIGRATION"])
+
+    thread = threading.Thread(target=emit)
+    thread.start()
+    event = qmp.wait_event({"MIGRATION", "MIGRATION_PASS"}, timeout=5)
+    thread.join()
+    assert event["event"] == "MIGRATION"
+    assert [e["event"] for e in seen] == ["MIGRATION"]
+    # Only the matching event has been consumed.
+    assert [e["event"] for e in qmp.get_events()] == ["STOP"]
+
+    qmp.unsubscribe("MIGRATION", seen.append)
+    qmp.command("emit", events=["MIGRATION"])
+    assert len(seen) == 1
+    with pytest.raises(QMPTimeoutError):
+        qmp.wait_event("MIGRATION", 0.1, match=lambda e: e["data"]["n"] > 0)
+
+
+def test_pipelined_connection_lost(qmp, qmp_server):
+    pending = qmp.submit("hang")
+    qmp_server.conn.shutdown(socket.SHUT_RDWR)
+    assert pending.result(5) is None
+    assert qmp.cmd("query-status") is None
+    with pytest.raises(QMPConnectError):
+        qmp.command("query-status")
+    with pytest.raises(QMPConnectError):
+        qmp.wait_event("STOP", timeout=1)
+
+
+def test_legacy_wait_event(qmp_server):
+    qmp = QEMUMonitorProtocol(qmp_server.path, log)
+    qmp.settimeout(5)
+    qmp.connect()
+    qmp.command("emit", events=["STOP", "MIGRATION"])
+    assert qmp.wait_event("MIGRATION", timeout=1)["event"] == "MIGRATION"
+    with pytest.raises(QMPTimeoutError):
+        qmp.wait_event("MIGRATION", timeout=0.1)
+
+    threading.Timer(0.1, qmp_server.event, args=("MIGRATION",)).start()
+    assert qmp.wait_event({"MIGRATION"}, timeout=5)["event"] == "MIGRATION"
+    assert [e["event"] for e in qmp.get_events()] == ["STOP"]
+    # Waiting doesn't change the timeout for commands.
+    assert qmp._QEMUMonitorProtocol__sock.gettimeout() == 5
+    qmp.close()
+
+
+def test_legacy_wait_event_buffered_with_response(qmp_server):
+    qmp = QEMUMonitorProtocol(qmp_server.path, log)
+    qmp.settimeout(5)
+    qmp.connect()
+    qmp.command("emit-after", events=["STOP", "MIGRATION"])
+    # Both events were read into the socket file's buffer together with
+    # the response and nothing else arrives on the socket.
+    start = time.monotonic()
+    assert qmp.wait_event("MIGRATION", timeout=3)["event"] == "MIGRATION"
+    assert qmp.wait_event("STOP", timeout=3)["event"] == "STOP"
+    assert time.monotonic() - start < 1
+    assert qmp._QEMUMonitorProtocol__sock.gettimeout() == 5
+    qmp.close()
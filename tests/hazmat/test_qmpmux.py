@@ -0,0 +1,166 @@
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from fc.qemu.hazmat import qmpmux
+from fc.qemu.hazmat.qemu import Qemu
+from fc.qemu.hazmat.qmp import QMPConnectError, QMPTimeoutError
+from fc.qemu.hazmat.qmpmux import (
+    MultiplexerClient,
+    MultiplexerUnavailable,
+    running_multiplexer,
+)
+from fc.qemu.util import log
+
+from .test_qmp import FakeQMPServer
+
+
+@pytest.fixture(autouse=True)
+def connect_timeout(monkeypatch):
+    # The fake monitor never accepts a second connection.
+    monkeypatch.setattr(qmpmux, "CONNECT_TIMEOUT", 0.5)
+
+
+@pytest.fixture
+def vm_monitor(tmp_path):
+    server = FakeQMPServer(tmp_path / "qemu.simplevm.qmp.sock")
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def multiplexer(tmp_path, vm_monitor):
+    with running_multiplexer(tmp_path / "mux.sock", tmp_path, log) as server:
+        yield server
+
+
+def client(multiplexer, name="simplevm"):
+    qmp = MultiplexerClient(multiplexer.path, name, log)
+    qmp.settimeout(5)
+    qmp.connect()
+    return qmp
+
+
+def test_clients_share_one_monitor_connection(multiplexer, vm_monitor):
+    # The fake monitor only accepts a single connection, just like Qemu.
+    clients = [client(multiplexer) for _ in range(3)]
+    results = []
+
+    def query(qmp):
+        results.append(qmp.command("query-status"))
+
+    threads = [threading.Thread(target=query, args=(c,)) for c in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [{"status": "running"}] * 3
+    for qmp in clients:
+        qmp.close()
+
+
+def test_read_only_commands_are_cached(multiplexer, vm_monitor):
+    qmp = client(multiplexer)
+    assert qmp.command("query-status") == {"status": "running"}
+    assert qmp.cmd("query-status", id="foo")["id"] == "foo"
+    names = [c["execute"] for c in vm_monitor.received]
+    assert names.count("query-status") == 1
+
+    # Other commands are passed through and invalidate the cache.
+    assert qmp.command("stop") == {}
+    assert qmp.command("query-status") == {"status": "running"}
+    names = [c["execute"] for c in vm_monitor.received]
+    assert names[-2:] == ["stop", "query-status"]
+    qmp.close()
+
+
+def test_cache_expires(tmp_path, vm_monitor):
+    with running_multiplexer(
+        tmp_path / "mux.sock", tmp_path, log, cache_ttl=0
+    ) as multiplexer:
+        qmp = client(multiplexer)
+        qmp.command("query-status")
+        qmp.command("query-status")
+        qmp.close()
+    names = [c["execute"] for c in vm_monitor.received]
+    assert names.count("query-status") == 2
+
+
+def test_unknown_vm_behaves_like_refused_connection(multiplexer):
+    with pytest.raises(socket.error):
+        client(multiplexer, "othervm")
+
+
+def test_multiplexer_not_running(tmp_path):
+    qmp = MultiplexerClient(tmp_path / "mux.sock", "simplevm", log)
+    with pytest.raises(MultiplexerUnavailable):
+        qmp.connect()
+
+
+def test_monitor_connection_lost(multiplexer, vm_monitor):
+    qmp = client(multiplexer)
+    qmp.command("query-status")
+    vm_monitor.conn.shutdown(socket.SHUT_RDWR)
+    with pytest.raises((QMPConnectError, socket.error)):
+        qmp.command("stop")
+    qmp.close()
+
+
+def test_discover(multiplexer, vm_monitor):
+    multiplexer.discover()
+    assert list(multiplexer.monitors) == ["simplevm"]
+    vm_monitor.conn.shutdown(socket.SHUT_RDWR)
+    multiplexer.monitors["simplevm"]._reader.join()
+    multiplexer.discover()
+    assert multiplexer.monitors == {}
+
+
+def test_qemu_uses_multiplexer_if_running(multiplexer, tmp_path):
+    qemu = Qemu({"name": "simplevm", "id": 2345})
+    qemu.qmp_multiplexer_socket = str(multiplexer.path)
+    assert qemu.qmp_multiplexed
+    assert isinstance(qemu.qmp, MultiplexerClient)
+    assert qemu.qmp.command("query-status") == {"status": "running"}
+
+    qemu = Qemu({"name": "simplevm", "id": 2345})
+    qemu.qmp_multiplexer_socket = str(tmp_path / "missing.sock")
+    assert not qemu.qmp_multiplexed
+
+
+def test_wait_event(multiplexer, vm_monitor):
+    qmp = client(multiplexer)
+    with pytest.raises(QMPTimeoutError):
+        qmp.wait_event("MIGRATION", timeout=0.1)
+    threading.Timer(0.1, vm_monitor.event, args=("MIGRATION",)).start()
+    assert qmp.wait_event({"MIGRATION"}, timeout=5)["event"] == "MIGRATION"
+    qmp.close()
+
+
+def test_poll_migration_status_through_multiplexer(multiplexer, vm_monitor):
+    vm_monitor.returns["query-migrate"] = {"status": "active"}
+    qemu = Qemu({"name": "simplevm", "id": 2345})
+    qemu.qmp_multiplexer_socket = str(multiplexer.path)
+
+    start = time.monotonic()
+    statuses = []
+    for info in qemu.poll_migration_status():
+        statuses.append(info["status"])
+        if len(statuses) == 1:
+            vm_monitor.returns["query-migrate"] = {"status": "completed"}
+            vm_monitor.event("MIGRATION", {"status": "completed"})
+    # The event woke us up and the cached status was discarded.
+    assert time.monotonic() - start < 0.9
+    assert statuses == ["active", "completed"]
+    qemu.qmp.close()
+
+
+def test_multiplexer_socket_is_private_from_the_start(
+    tmp_path, permissive_umask
+):
+    path = tmp_path / "mux.sock"
+    with running_multiplexer(path, tmp_path, log):
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
@@ -1,11 +1,13 @@
+import datetime
 import os.path
 import subprocess
 import time
+from pathlib import Path
 
 import pytest
 
-from fc.qemu.hazmat import libceph
-from fc.qemu.timeout import TimeOut
+from fc.qemu.hazmat import devices, libceph
+from fc.qemu.timeout import TimeOut, TimeoutError
 
 
 @pytest.fixture
@@ -28,6 +30,7 @@ def tmp_spec(ceph_inst):
 
     try:
         for volume in ceph_inst.opened_volumes:
+            volume.refresh()
             lock = volume.lock_status()
             if lock is not None:
                 volume.rbdimage.break_lock(*lock)
@@ -83,6 +86,32 @@ def test_purge_snapshots(tmp_spec):
     assert len(volume.snapshots) == 0
 
 
+def test_snapshot_list_is_cached(tmp_spec):
+    tmp_spec.ensure_presence()
+    volume = tmp_spec.volume
+    volume.snapshots.create("s0")
+    assert len(volume.snapshots) == 1
+    # Not noticed until we change snapshots ourselves.
+    volume.rbdimage.create_snap("s1")
+    assert len(volume.snapshots) == 1
+    volume.snapshots.create("s2")
+    assert [s.snapname for s in volume.snapshots] == ["s0", "s1", "s2"]
+    volume.snapshots["s1"].remove()
+    assert [s.snapname for s in volume.snapshots] == ["s0", "s2"]
+
+
+def test_snapshot_keep_until(tmp_spec):
+    tmp_spec.ensure_presence()
+    volume = tmp_spec.volume
+    for snap in ["backy-1", "daily-keep-until-20240229", "x-keep-until-2024"]:
+        volume.snapshots.create(snap)
+    assert [s.keep_until for s in volume.snapshots] == [
+        None,
+        datetime.date(2024, 2, 29),
+        None,
+    ]
+
+
 def test_snapshot_not_found(tmp_spec):
     tmp_spec.ensure_presence()
     with pytest.raises(KeyError):
@@ -130,6 +159,55 @@ def test_volume_locking(tmp_spec):
     assert volume.lock_status()[1] == "someotherhost"
 
 
+def test_volume_lock_status_is_cached(tmp_spec, monkeypatch):
+    tmp_spec.ensure_presence()
+    volume = tmp_spec.volume
+    queries = []
+    list_lockers = volume.rbdimage.list_lockers
+
+    def count_list_lockers():
+        queries.append(1)
+        return list_lockers()
+
+    monkeypatch.setattr(volume.rbdimage, "list_lockers", count_list_lockers)
+    assert volume.lock_status() is None
+    assert volume.lock_status() is None
+    assert len(queries) == 1
+
+    # Our own changes are written through.
+    volume.lock()
+    assert volume.lock_status() == (None, "host1")
+    volume.unlock()
+    assert volume.lock_status() is None
+    assert len(queries) == 1
+
+    volume.rbdimage.lock_exclusive("someotherhost")
+    assert volume.lock_status() is None
+    volume.refresh()
+    assert volume.lock_status()[1] == "someotherhost"
+    assert len(queries) == 2
+
+
+def test_volume_lock_status_is_cached_per_ceph_session(
+    ceph_inst, monkeypatch
+):
+    ceph_inst.specs["tmp"].ensure_presence()
+    volume = ceph_inst.specs["tmp"].volume
+    assert volume.lock_status() is None
+    volume.rbdimage.lock_exclusive("someotherhost")
+    assert volume.lock_status() is None
+
+    # Our fake pools only live as long as their Rados instance.
+    rados = ceph_inst.rados
+    monkeypatch.setattr(libceph, "Rados", lambda *args, **kw: rados)
+    ceph_inst.__exit__(None, None, None)
+    assert ceph_inst.lock_statuses == {}
+    ceph_inst.__enter__()
+    volume = ceph_inst.specs["tmp"].volume
+    assert volume.lock_status()[1] == "someotherhost"
+    volume.unlock(force=True)
+
+
 def test_force_unlock(tmp_spec):
     tmp_spec.ensure_presence()
     volume = tmp_spec.volume
@@ -214,3 +292,37 @@ def test_mount_snapshot(tmp_spec):
     # test for idempotence
     snap.umount()
     assert not mountpoint.is_mount()
+
+
+def test_wait_for_part1dev_retries_after_settle(
+    ceph_inst, tmp_path, monkeypatch
+):
+    ceph_inst.specs["tmp"].ensure_presence()
+    volume = ceph_inst.specs["tmp"].volume
+    volume.device = tmp_path / "rbd0"
+    partition = tmp_path / "rbd0-part1"
+    partition.touch()
+    monkeypatch.setattr(Path, "is_block_device", Path.exists)
+    calls = []
+    probes_until_ready = 3
+
+    def cmd(cmdline):
+        calls.append(cmdline.split()[0])
+        if cmdline.startswith("blkid") and calls.count("blkid") < (
+            probes_until_ready
+        ):
+            raise subprocess.CalledProcessError(2, cmdline)
+
+    volume.cmd = cmd
+    start = time.monotonic()
+    volume.wait_for_part1dev()
+    # blkid's readiness doesn't cause inotify events, keep probing often.
+    assert time.monotonic() - start < devices.SAFETY_INTERVAL
+    assert volume.part1dev == partition
+    assert calls == ["partprobe", "blkid", "udevadm", "blkid", "blkid"]
+
+    # We don't wait forever.
+    monkeypatch.setattr("fc.qemu.hazmat.volume.PARTITION_TIMEOUT", 0.1)
+    probes_until_ready = float("inf")
+    with pytest.raises(TimeoutError):
+        volume.wait_for_part1dev()
@@ -1,5 +1,7 @@
+import datetime
 import os
 import shutil
+import time
 from pathlib import Path
 
 import mock
@@ -7,9 +9,10 @@ import psutil
 import pytest
 
 import fc.qemu.util as util
-from fc.qemu.agent import Agent, iproute2_json
+from fc.qemu.agent import Agent, RouteDumps, iproute2_json
 from fc.qemu.exc import EnvironmentChanged, VMStateInconsistent
 from fc.qemu.hazmat.qemu import Qemu, detect_current_machine_type
+from tests.conftest import get_log
 
 
 def named_vm_cfg(name, monkeypatch):
@@ -252,6 +255,243 @@ def test_ensure_lock_contention_returns_ex_tempfail(
     assert "status=42" in log_output
 
 
+def test_snapshot_all_freezes_vms_in_parallel(monkeypatch):
+    import threading
+
+    # All three running VMs have to be in the middle of their snapshot at
+    # the same time to get past the barrier.
+    barrier = threading.Barrier(3, timeout=5)
+
+    def fake_vm(name, running, fail=False):
+        vm = mock.MagicMock()
+        vm.name = name
+        vm.qemu.process_exists.return_value = running
+        vm.frozen_time = 1.5
+
+        def snapshot(snapshot, keep, freeze_timeout):
+            assert (snapshot, keep, freeze_timeout) == ("nightly", 3, 300)
+            barrier.wait()
+            if fail:
+                raise RuntimeError("VM not frozen, not making snapshot.")
+
+        vm.snapshot.side_effect = snapshot
+        vm.snapshot_freeze_timeout = 300
+        return vm
+
+    vms = [
+        fake_vm("vm1", True),
+        fake_vm("vm2", True),
+        fake_vm("vm3", True, fail=True),
+        fake_vm("vm4", False),
+    ]
+    monkeypatch.setattr(Agent, "_vm_agents_for_host", lambda: iter(vms))
+    util.test_log_options["show_events"] = ["snapshot-all"]
+    get_log()
+
+    assert Agent.snapshot_all("nightly", keep=3, parallelism=3) == 1
+    assert not vms[3].snapshot.called
+    assert get_log() == (
+        "snapshot-all count=3 parallelism=3\n"
+        "snapshot-all failed=vm3 max_frozen=1.5s result=finished "
+        "snapshots=2 total_frozen=4.5s"
+    )
+
+
+def test_snapshot_commands_succeed_without_vms(monkeypatch):
+    monkeypatch.setattr(Agent, "_vm_agents_for_host", lambda: iter([]))
+    assert Agent.snapshot_all("nightly") == 0
+    assert Agent.snapshot_gc() == 0
+
+
+def test_snapshot_gc_removes_expired_snapshots(monkeypatch):
+    monkeypatch.setattr(util, "today", lambda: datetime.date(2024, 3, 1))
+
+    def fake_snapshot(name, keep_until=None):
+        snapshot = mock.Mock()
+        snapshot.fullname = "rbd.ssd/" + name
+        snapshot.keep_until = keep_until
+        return snapshot
+
+    expired = fake_snapshot(
+        "vm1.root@daily-keep-until-20240229", datetime.date(2024, 2, 29)
+    )
+    vm = mock.MagicMock()
+    vm.name = "vm1"
+    volume = mock.Mock()
+    volume.snapshots = [
+        fake_snapshot("vm1.root@backy-1234"),
+        expired,
+        fake_snapshot(
+            "vm1.root@daily-keep-until-20240301", datetime.date(2024, 3, 1)
+        ),
+    ]
+    vm.ceph.opened_volumes = [volume]
+    monkeypatch.setattr(Agent, "_vm_agents_for_host", lambda: iter([vm]))
+    util.test_log_options["show_events"] = ["snapshot-gc"]
+    get_log()
+
+    assert Agent.snapshot_gc(dry_run=True) == 0
+    assert not expired.remove.called
+    assert get_log() == (
+        "snapshot-gc count=1 dry_run=True today=2024-03-01\n"
+        "snapshot-gc expired=1 failed_snapshots=0 failed_vms=0 removed=0 "
+        "result=finished"
+    )
+
+    assert Agent.snapshot_gc() == 0
+    assert expired.remove.called
+    assert get_log() == (
+        "snapshot-gc count=1 dry_run=False today=2024-03-01\n"
+        "snapshot-gc expired=1 failed_snapshots=0 failed_vms=0 removed=1 "
+        "result=finished"
+    )
+
+
+def test_snapshot_gc_counts_failed_snapshots_and_vms(monkeypatch):
+    monkeypatch.setattr(util, "today", lambda: datetime.date(2024, 3, 1))
+    snapshot = mock.Mock()
+    snapshot.fullname = "rbd.ssd/vm1.root@daily-keep-until-20240229"
+    snapshot.keep_until = datetime.date(2024, 2, 29)
+    snapshot.remove.side_effect = RuntimeError("busy")
+    other = mock.Mock()
+    other.fullname = "rbd.ssd/vm1.root@daily-keep-until-20240228"
+    other.keep_until = datetime.date(2024, 2, 28)
+    other.remove.side_effect = RuntimeError("busy")
+    vm1 = mock.MagicMock()
+    vm1.name = "vm1"
+    volume = mock.Mock()
+    volume.snapshots = [snapshot, other]
+    vm1.ceph.opened_volumes = [volume]
+    vm2 = mock.MagicMock()
+    vm2.name = "vm2"
+    vm2.__enter__.side_effect = RuntimeError("locked")
+    monkeypatch.setattr(
+        Agent, "_vm_agents_for_host", lambda: iter([vm1, vm2])
+    )
+    util.test_log_options["show_events"] = ["snapshot-gc"]
+    get_log()
+
+    assert Agent.snapshot_gc() == 1
+    assert get_log().splitlines()[-1] == (
+        "snapshot-gc expired=2 failed_snapshots=2 failed_vms=1 removed=0 "
+        "result=finished"
+    )
+
+
+@pytest.fixture
+def ensure_all_vms():
+    vmdir = Agent.prefix / "etc/qemu/vm"
+    vmdir.mkdir(parents=True, exist_ok=True)
+    fixture = Path(__file__).parent / "fixtures" / "simplevm.yaml"
+    shutil.copy(fixture, vmdir / "test00.cfg")
+    shutil.copy(fixture, vmdir / "test01.cfg")
+    # A new VM that only has a staged config.
+    shutil.copy(fixture, vmdir / ".test02.cfg.staging")
+
+
+class ConsulClients:
+    """Stand-in for `Agent.consul` that records the created clients."""
+
+    def __init__(self):
+        self.created = []
+
+    def __get__(self, vm, owner):
+        client = object()
+        self.created.append(client)
+        return client
+
+
+def test_ensure_all_shares_state(monkeypatch, ensure_all_vms):
+    ensured = []
+    monkeypatch.setattr(Agent, "__enter__", lambda self: None)
+    monkeypatch.setattr(Agent, "__exit__", lambda self, *args: None)
+    monkeypatch.setattr(Agent, "ensure", lambda self: ensured.append(self))
+    clients = ConsulClients()
+    monkeypatch.setattr(Agent, "consul", clients)
+    util.test_log_options["show_events"] = ["ensure-all"]
+    get_log()
+
+    assert Agent.ensure_all(parallelism=2) == 0
+
+    assert sorted(vm.name for vm in ensured) == ["test00", "test01", "test02"]
+    assert len({id(vm.image_index) for vm in ensured}) == 1
+    assert ensured[0].image_index.ttl == 60
+    assert len({id(vm.host_routes) for vm in ensured}) == 1
+    assert not any(vm.ceph_attach_on_enter for vm in ensured)
+    # Each thread uses its own consul client.
+    assert 1 <= len(clients.created) <= 2
+    assert {id(vm.consul) for vm in ensured} == {
+        id(c) for c in clients.created
+    }
+    log = get_log()
+    assert "ensure-all count=3 parallelism=2" in log
+    assert "failed=0 locked=0 ok=3 result=finished" in log
+
+
+def test_ensure_all_succeeds_without_vms():
+    assert Agent.ensure_all() == 0
+
+
+def test_ensure_all_reports_locked_and_failed_vms(
+    monkeypatch, ensure_all_vms
+):
+    def ensure(self):
+        if self.name == "test00":
+            time.sleep(0.1)
+            return os.EX_TEMPFAIL
+        if self.name == "test01":
+            return 1
+        raise RuntimeError("failed")
+
+    monkeypatch.setattr(Agent, "__enter__", lambda self: None)
+    monkeypatch.setattr(Agent, "__exit__", lambda self, *args: None)
+    monkeypatch.setattr(Agent, "ensure", ensure)
+    monkeypatch.setattr(Agent, "consul", "consul-client")
+    util.test_log_options["show_events"] = ["ensure-all"]
+    get_log()
+
+    assert Agent.ensure_all(parallelism=3) == 1
+
+    log = get_log().splitlines()
+    results = [line.split()[-2:] for line in log if "ensure-all-vm" in line]
+    # Slowest first.
+    assert results[0] == ["machine=test00", "result=locked"]
+    assert sorted(results) == [
+        ["machine=test00", "result=locked"],
+        ["machine=test01", "result=failed"],
+        ["machine=test02", "result=failed"],
+    ]
+    assert "failed=2 locked=1 ok=0 result=finished" in log[-1]
+
+
+def test_route_dumps_list_each_vrf_once(monkeypatch):
+    calls = []
+
+    def iproute2_json(log, args):
+        calls.append(args)
+        if args[0] == "-4":
+            return [
+                {"dst": "192.0.2.23", "dev": "tpub3456"},
+                {"dst": "192.0.2.42", "dev": "tpub4242"},
+            ]
+        return [{"dst": "2001:db8::23", "dev": "tpub3456"}]
+
+    monkeypatch.setattr("fc.qemu.agent.iproute2_json", iproute2_json)
+    routes = RouteDumps()
+    assert routes.routes(util.log, "vrfpub", "tpub3456") == [
+        {"dst": "192.0.2.23", "dev": "tpub3456"},
+        {"dst": "2001:db8::23", "dev": "tpub3456"},
+    ]
+    assert routes.routes(util.log, "vrfpub", "tpub4242") == [
+        {"dst": "192.0.2.42", "dev": "tpub4242"},
+    ]
+    assert routes.routes(util.log, "vrfpub", "tpub0000") == []
+    assert len(calls) == 2
+    routes.invalidate("vrfpub")
+    routes.routes(util.log, "vrfpub", "tpub3456")
+    assert len(calls) == 4
+
+
 def test_iproute2_json_loopback():
     """Basic functional test of iproute2 JSON output handling."""
     data = iproute2_json(util.log, ["address", "show", "lo"])
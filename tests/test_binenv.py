@@ -10,7 +10,6 @@ REQUIRED_BINARIES = set(
         "ip",
         "mkfs.vfat",
         "mkfs.xfs",
-        "mkswap",
         "mount",
         "parted",
         "partprobe",
@@ -46,6 +45,7 @@ TEST_BINARIES = set(
         "top",
         "true",
         "losetup",
+        "mkswap",
     ]
 )
 
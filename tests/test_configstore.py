@@ -0,0 +1,67 @@
+import pytest
+
+from fc.qemu import configstore
+
+
+@pytest.fixture
+def config(tmp_path):
+    return tmp_path / "test00.cfg"
+
+
+@pytest.mark.unit
+def test_write_and_load_roundtrip(config):
+    data = {"name": "test00", "consul-generation": 5, "parameters": {"a": 1}}
+    configstore.write(config, data)
+    with config.open() as f:
+        assert configstore.load(f) == data
+    assert configstore.sidecar_path(config).name == ".test00.cfg.generation"
+
+
+@pytest.mark.unit
+def test_read_generation_uses_sidecar(config, monkeypatch):
+    configstore.write(config, {"consul-generation": 5})
+
+    def load(stream):
+        raise AssertionError("config should not be parsed")
+
+    monkeypatch.setattr(configstore, "load", load)
+    assert configstore.read_generation(config) == 5
+
+
+@pytest.mark.unit
+def test_read_generation_ignores_outdated_sidecar(config):
+    configstore.write(config, {"consul-generation": 5})
+    # Written by someone else, e.g. copied into place.
+    other = config.with_name("other")
+    other.write_text("consul-generation: 123\nname: test00\n")
+    other.replace(config)
+    assert configstore.read_generation(config) == 123
+    # The sidecar has been updated.
+    assert configstore.SIDECAR.unpack(
+        configstore.sidecar_path(config).read_bytes()
+    )[0] == 123
+
+
+@pytest.mark.unit
+def test_read_generation_without_sidecar(config):
+    config.write_text("consul-generation: 7\n")
+    assert configstore.read_generation(config) == 7
+    assert configstore.sidecar_path(config).exists()
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("content", ["", "name: test00\n"])
+def test_read_generation_inconsistent(config, content):
+    config.write_text(content)
+    with pytest.raises(Exception):
+        configstore.read_generation(config)
+    assert not configstore.sidecar_path(config).exists()
+
+
+@pytest.mark.unit
+def test_staging_sidecar_is_hidden(tmp_path):
+    staging = tmp_path / ".test00.cfg.staging"
+    assert (
+        configstore.sidecar_path(staging).name
+        == ".test00.cfg.staging.generation"
+    )
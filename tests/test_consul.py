@@ -9,6 +9,7 @@ import pytest
 from fc.qemu import util
 from fc.qemu.agent import Agent
 from fc.qemu.hazmat.qemu import Qemu
+from fc.qemu.sysconfig import sysconfig
 from tests.conftest import get_log
 from tests.ellipsis import Ellipsis
 
@@ -123,7 +124,7 @@ def test_qemu_config_change(clean_config_test22):
             "environment": "staging",
             "id": 4097,
             "interfaces": {},
-            "kvm_host": "host1",
+            "kvm_host": sysconfig.agent["this_host"],
             "location": "whq",
             "machine": "virtual",
             "memory": 512,
@@ -321,6 +322,7 @@ acquire-lock count=1 machine=simplevm result=locked target=...run/qemu.simplevm.
 snapshot expected=VM running machine=simplevm
 release-lock count=0 machine=simplevm target=...run/qemu.simplevm.lock
 release-lock machine=simplevm result=unlocked target=...run/qemu.simplevm.lock
+event-settled key=snapshot/7468743 latency=...
 finish-handle-key key=snapshot/7468743
 finish-consul-events"""
     )
@@ -375,14 +377,47 @@ def test_multiple_events():
         "handle-key key=node/test22",
         "ignore-consul-event machine=test22 reason=is a physical machine",
         "finish-handle-key key=node/test22",
+        "coalesced-consul-events count=3",
+        "finish-consul-events",
+    ]
+
+
+def test_consul_event_for_other_host_is_settled(clean_config_test22):
+    util.test_log_options["show_events"] = ["consul", "handle-key"]
+    cfg = {
+        "name": "test22",
+        "parameters": {
+            "kvm_host": "otherhost",
+            "machine": "virtual",
+        },
+    }
+
+    event = prepare_consul_event("node/test22", cfg, 123)
+    Agent.handle_consul_event(event)
+    assert util.log_data == [
+        "start-consul-events count=1",
         "handle-key key=node/test22",
-        "ignore-consul-event machine=test22 reason=is a physical machine",
-        "finish-handle-key key=node/test22",
-        "handle-key key=node/test22",
-        "ignore-consul-event machine=test22 reason=is a physical machine",
-        "finish-handle-key key=node/test22",
-        "handle-key key=node/test22",
-        "ignore-consul-event machine=test22 reason=is a physical machine",
+        "ignore-consul-event machine=test22 reason=not assigned to this host",
         "finish-handle-key key=node/test22",
         "finish-consul-events",
     ]
+    assert not (Agent.prefix / "etc/qemu/vm/.test22.cfg.staging").exists()
+
+    # The same generation is discarded right away next time.
+    util.log_data = []
+    event.seek(0)
+    Agent.handle_consul_event(event)
+    assert util.log_data == [
+        "start-consul-events count=1",
+        "skip-settled-consul-events count=1",
+        "finish-consul-events",
+    ]
+
+    # A new generation is looked at again.
+    util.log_data = []
+    event = prepare_consul_event("node/test22", cfg, 124)
+    Agent.handle_consul_event(event)
+    assert (
+        "ignore-consul-event machine=test22 reason=not assigned to this host"
+        in util.log_data
+    )
@@ -0,0 +1,145 @@
+import json
+import threading
+from io import StringIO
+
+import pytest
+
+from fc.qemu.consulevents import (
+    RECORD,
+    AdaptiveRateLimiter,
+    EventQueue,
+    GenerationIndex,
+    iter_events,
+)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("chunk_size", [1, 7, 65536])
+def test_iter_events_across_chunks(chunk_size):
+    events = [
+        {"Key": f"node/test{i}", "ModifyIndex": i, "Value": "x]," * i}
+        for i in range(20)
+    ]
+    payload = StringIO(json.dumps(events, indent=2))
+    assert list(iter_events(payload, chunk_size)) == events
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("payload", ["", "null", "[]", " [ ] \n"])
+def test_iter_events_empty(payload):
+    assert list(iter_events(StringIO(payload))) == []
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize(
+    "payload", ['[{"Key": "a"}', '[{} {}]', '{"Key": "a"}', "[] []"]
+)
+def test_iter_events_invalid(payload):
+    with pytest.raises(ValueError):
+        list(iter_events(StringIO(payload), 2))
+
+
+def event(name, index):
+    return {"Key": f"node/{name}", "ModifyIndex": index}
+
+
+@pytest.mark.unit
+def test_generation_index_persists_settled_events(tmp_path):
+    path = tmp_path / "generations"
+    index = GenerationIndex(path)
+    assert not index.is_settled(event("test00", 1))
+    index.settle(event("test00", 5))
+    index.settle(event("test01", 7))
+    # Snapshot events are never settled.
+    index.settle({"Key": "snapshot/1234", "ModifyIndex": 9})
+    assert index.is_settled(event("test00", 5))
+    assert not index.is_settled(event("test00", 6))
+    index.save()
+    index.close()
+    assert path.stat().st_size == 2 * RECORD.size
+
+    index = GenerationIndex(path)
+    assert index.get("test00") == 5
+    assert index.get("test01") == 7
+    assert index.get("test02") is None
+    assert index.is_settled(event("test01", 3))
+    assert not index.is_settled({"Key": "snapshot/1234", "ModifyIndex": 1})
+    index.close()
+
+
+@pytest.mark.unit
+def test_generation_index_merges_concurrent_saves(tmp_path):
+    path = tmp_path / "generations"
+    first = GenerationIndex(path)
+    second = GenerationIndex(path)
+    first.settle(event("test00", 5))
+    second.settle(event("test00", 3))
+    second.settle(event("test01", 2))
+    first.save()
+    second.save()
+
+    index = GenerationIndex(path)
+    assert index.get("test00") == 5
+    assert index.get("test01") == 2
+    for i in [index, first, second]:
+        i.close()
+
+
+@pytest.mark.unit
+def test_event_queue_keeps_latest_generation():
+    queue = EventQueue(10)
+    queue.put(event("test00", 5), received=1)
+    queue.put(event("test01", 3), received=2)
+    queue.put(event("test00", 7), received=3)
+    queue.put(event("test00", 6), received=4)
+    queue.close()
+    assert queue.coalesced == 2
+    # The latest generation keeps the position and the first receipt time.
+    assert queue.get() == ("node/test00", event("test00", 7), 1)
+    assert queue.get() == ("node/test01", event("test01", 3), 2)
+    assert queue.get() is None
+
+
+@pytest.mark.unit
+def test_event_queue_does_not_hand_out_active_keys():
+    queue = EventQueue(10)
+    queue.put(event("test00", 1))
+    key, _, _ = queue.get()
+    queue.put(event("test00", 2))
+    queue.put(event("test01", 1))
+    # test00 is still being handled.
+    assert queue.get()[0] == "node/test01"
+    queue.done(key)
+    assert queue.get()[1] == event("test00", 2)
+
+
+@pytest.mark.unit
+def test_event_queue_blocks_when_full():
+    queue = EventQueue(1)
+    queue.put(event("test00", 1))
+    producer = threading.Thread(target=queue.put, args=(event("test01", 1),))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+    queue.get()
+    producer.join(1)
+    assert not producer.is_alive()
+
+
+@pytest.mark.unit
+def test_rate_limiter_adapts_to_load_and_failures():
+    load = [0.0]
+    limiter = AdaptiveRateLimiter(
+        10, max_rate=12, load=lambda: (load[0] * limiter.cpus, 0, 0)
+    )
+    limiter.wait()
+    limiter.wait()
+    limiter.wait()
+    assert limiter.rate == 12
+    load[0] = 2.0
+    limiter.wait()
+    assert limiter.rate == 6
+    limiter.failed()
+    limiter.failed()
+    limiter.failed()
+    assert limiter.rate == 1
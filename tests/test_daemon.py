@@ -0,0 +1,86 @@
+import argparse
+import os
+import signal
+import stat
+import sys
+import threading
+
+import pytest
+
+from fc.qemu import daemon
+from fc.qemu.util import log
+
+
+def run(args):
+    print(f"running {args.func} {args.vm} in {os.getpid()}")
+    if args.func == "exit":
+        sys.exit(args.vm)
+    if args.func == "kill":
+        os.kill(os.getpid(), signal.SIGKILL)
+    return int(args.vm)
+
+
+@pytest.fixture
+def agent_daemon(tmp_path):
+    prepared = []
+    server = daemon.AgentDaemon(
+        tmp_path / "agent.sock",
+        run,
+        log,
+        prepare=lambda: prepared.append(True),
+    )
+    server.prepared = prepared
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.stop()
+    thread.join()
+    server.close()
+
+
+def forward(agent_daemon, func, vm):
+    args = argparse.Namespace(func=func, vm=vm)
+    return daemon.forward(args, ["fc-qemu", func, vm], agent_daemon.path)
+
+
+def test_forward_returns_exit_code_and_output(agent_daemon, capfd):
+    assert forward(agent_daemon, "status", 0) == 0
+    assert forward(agent_daemon, "status", 3) == 3
+    out, _ = capfd.readouterr()
+    # The daemon's own log lines end up on stdout, too.
+    lines = [line for line in out.splitlines() if line.startswith("running ")]
+    assert [line.rsplit(" ", 1)[0] for line in lines] == [
+        "running status 0 in",
+        "running status 3 in",
+    ]
+    # Every command runs in a separate worker.
+    pids = {int(line.rsplit(" ", 1)[1]) for line in lines}
+    assert len(pids) == 2
+    assert os.getpid() not in pids
+    assert len(agent_daemon.prepared) == 2
+
+
+def test_forward_keeps_system_exit_codes(agent_daemon, capfd):
+    assert forward(agent_daemon, "exit", 69) == 69
+    assert forward(agent_daemon, "exit", None) == 0
+
+
+def test_forward_reports_killed_worker(agent_daemon, capfd):
+    assert forward(agent_daemon, "kill", 0) == 128 + signal.SIGKILL
+
+
+def test_daemon_socket_is_private_from_the_start(tmp_path, permissive_umask):
+    server = daemon.AgentDaemon(tmp_path / "agent.sock", run, log)
+    assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o600
+    server.close()
+
+
+def test_forward_without_daemon_runs_locally(tmp_path):
+    args = argparse.Namespace(func="status", vm="test")
+    assert daemon.forward(args, [], tmp_path / "missing.sock") is None
+
+
+def test_stopped_daemon_lets_clients_run_locally(agent_daemon):
+    agent_daemon.stop()
+    assert not agent_daemon.path.exists()
+    assert forward(agent_daemon, "status", 0) is None
@@ -0,0 +1,135 @@
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from fc.qemu import runner
+from fc.qemu.util import log
+
+
+def run(argv, **kw):
+    return runner.run_sync(argv, log, **kw)
+
+
+def test_to_argv():
+    assert runner.to_argv('mount "/dev/rbd0p1" /mnt/a\\ b') == [
+        "mount",
+        "/dev/rbd0p1",
+        "/mnt/a b",
+    ]
+    assert runner.to_argv(["ip", "-j", 4]) == ["ip", "-j", "4"]
+
+
+def test_run_without_shell():
+    lines = []
+    returncode, output = run(
+        ["sh", "-c", "echo out; echo err >&2; exit 3"], on_line=lines.append
+    )
+    assert returncode == 3
+    assert output == "out\nerr\n"
+    assert lines == ["out\n", "err\n"]
+
+    # Shell syntax is passed verbatim.
+    assert run(["echo", "$HOME", "|", "cat"]) == (0, "$HOME | cat\n")
+
+
+def test_run_passes_input():
+    assert run(["cat"], input=b"foo\nbar") == (0, "foo\nbar")
+
+
+def test_run_reads_output_while_passing_input():
+    # More than fits into the pipe buffers in either direction.
+    data = b"x\n" * 2_000_000
+    assert run(["cat"], input=data, timeout=10) == (0, data.decode())
+
+
+def test_run_timeout_with_pending_input_cleans_up(tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text(
+        "import subprocess\n"
+        "from fc.qemu import runner\n"
+        "from fc.qemu.util import log\n"
+        "try:\n"
+        "    runner.run_sync(\n"
+        "        ['sleep', '5'], log, input=b'x' * 2_000_000, timeout=0.3\n"
+        "    )\n"
+        "except subprocess.TimeoutExpired:\n"
+        "    print('timeout')\n"
+    )
+    result = subprocess.run(
+        [sys.executable, str(script)],
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+    )
+    assert result.stdout.splitlines()[-1] == "timeout"
+    assert "Traceback" not in result.stderr
+
+
+def test_run_bounds_output():
+    returncode, output = run(
+        ["sh", "-c", "yes | head -c 100000"], max_output=1000
+    )
+    assert returncode == 0
+    assert len(output) == 1000
+
+
+def test_run_kills_process_group_on_timeout(tmp_path):
+    pidfile = tmp_path / "child.pid"
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        run(["sh", "-c", f"sleep 60 & echo $! > {pidfile}; wait"], timeout=0.5)
+    assert time.monotonic() - start < 5
+    # The background child has been killed as well.
+    pid = int(pidfile.read_text())
+    timeout = time.monotonic() + 5
+    while time.monotonic() < timeout:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("child process still running")
+
+
+def test_run_sync_within_event_loop():
+    async def main():
+        return run(["echo", "foo"])
+
+    assert asyncio.run(main()) == (0, "foo\n")
+
+
+def test_command_slots_limit_concurrency(tmp_path):
+    slots = runner.CommandSlots(tmp_path / "slots", 1)
+    results = []
+
+    def sleep():
+        start = time.monotonic()
+        run(["sleep", "0.5"], slots=slots)
+        results.append((start, time.monotonic()))
+
+    threads = [threading.Thread(target=sleep) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    (_, first_end), (_, second_end) = sorted(results, key=lambda r: r[1])
+    assert second_end - first_end >= 0.45
+
+
+def test_command_slots_timeout(tmp_path):
+    slots = runner.CommandSlots(tmp_path / "slots", 1)
+    thread = threading.Thread(
+        target=run, args=(["sleep", "1"],), kwargs={"slots": slots}
+    )
+    thread.start()
+    time.sleep(0.2)
+    with pytest.raises(subprocess.TimeoutExpired):
+        run(["true"], slots=slots, timeout=0.2)
+    thread.join()
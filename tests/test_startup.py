@@ -0,0 +1,58 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+
+def imported_modules(code):
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            code + "\nimport json, sys; print(json.dumps(sorted(sys.modules)))",
+        ]
+    )
+    return set(json.loads(output))
+
+
+@pytest.mark.unit
+def test_client_does_not_import_agent():
+    modules = imported_modules(
+        "from fc.qemu import main\n"
+        "main.build_parser().parse_args(['status', 'test00'])"
+    )
+    assert "fc.qemu.daemon" in modules
+    for module in [
+        "fc.qemu.agent",
+        "fc.qemu.util",
+        "consulate",
+        "pkg_resources",
+        "psutil",
+        "requests",
+        "structlog",
+        "yaml",
+    ]:
+        assert module not in modules
+
+
+@pytest.mark.unit
+def test_agent_loads_services_on_demand():
+    modules = imported_modules("import fc.qemu.agent")
+    for module in [
+        "consulate",
+        "requests",
+        "xmlrpc.client",
+        "fc.qemu.directory",
+        "fc.qemu.hazmat.cpuscan",
+        "fc.qemu.incoming",
+        "fc.qemu.outgoing",
+        "fc.qemu.runner",
+    ]:
+        assert module not in modules
+
+
+@pytest.mark.unit
+def test_supervise_does_not_import_agent():
+    modules = imported_modules("import fc.qemu.hazmat.supervise")
+    assert "fc.qemu.agent" not in modules
@@ -1,4 +1,10 @@
-from fc.qemu.util import parse_export_format
+import subprocess
+import threading
+import time
+
+import pytest
+
+from fc.qemu.util import RateLimit, cmd, log, parse_export_format
 
 
 def test_export_format():
@@ -13,3 +19,63 @@ def test_export_format():
         "UUID": "a5370804-c9b1-4610-8f99-02a7841b8393",
         "DEVNAME": "test",
     }
+
+
+def test_rate_limit():
+    limit = RateLimit(20)
+    start = time.monotonic()
+    threads = [threading.Thread(target=limit.wait) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The first call passes right away, the others are spread out.
+    assert 0.2 <= time.monotonic() - start < 0.5
+
+    unlimited = RateLimit(0)
+    start = time.monotonic()
+    for _ in range(100):
+        unlimited.wait()
+    assert time.monotonic() - start < 0.1
+
+
+def test_cmd_without_shell():
+    assert cmd("echo 'a  b' $HOME | cat", log) == "a  b $HOME | cat"
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        cmd(["false"], log)
+    assert e.value.returncode == 1
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        cmd("does-not-exist", log)
+    assert e.value.returncode == 127
+
+
+def test_cmd_not_executable(tmp_path):
+    script = tmp_path / "script"
+    script.write_text("echo foo\n")
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        cmd([str(script)], log)
+    assert e.value.returncode == 126
+    # Executable, but without an interpreter line.
+    script.chmod(0o755)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        cmd([str(script)], log)
+    assert e.value.returncode == 126
+
+
+def test_cmd_with_shell():
+    assert cmd("echo foo | tr a-z A-Z", log, shell=True) == "FOO"
+
+
+def test_cmd_has_no_timeout_by_default(monkeypatch):
+    from fc.qemu import runner
+
+    timeouts = []
+
+    def run_sync(argv, log, timeout, **kw):
+        timeouts.append(timeout)
+        return 0, ""
+
+    monkeypatch.setattr(runner, "run_sync", run_sync)
+    cmd("true", log)
+    cmd("true", log, timeout=5)
+    assert timeouts == [None, 5]
@@ -83,7 +83,6 @@ fc-create-vm> --------
 /nix/store/zggynl2zs6m9swyqklqf0gr1dnga3dqx-python3.12-fc-agent-1.0/bin/fc-create-vm machine=simplevm returncode=0 subsystem=ceph volume=simplevm.root
 partprobe args=/dev/rbd/rbd.ssd/simplevm.root machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.root
 partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
-waiting interval=0 machine=simplevm remaining=4 subsystem=ceph volume=rbd.ssd/simplevm.root
 blkid args=/dev/rbd/rbd.ssd/simplevm.root-part1 -o export machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.root
 blkid> DEVNAME=/dev/rbd/rbd.ssd/simplevm.root-part1
 blkid> UUID=3337fc07-3c0e-47d2-9c99-9c5d5345f7ba
@@ -95,8 +94,6 @@ blkid machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
 partprobe args=/dev/rbd/rbd.ssd/simplevm.root machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.root
 partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
 found-partition machine=simplevm path=/dev/rbd/rbd.ssd/simplevm.root-part1 subsystem=ceph target=/dev/rbd0p1 volume=rbd.ssd/simplevm.root
-udevadm args=settle machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.root
-udevadm machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
 blkid args=/dev/rbd/rbd.ssd/simplevm.root-part1 machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.root
 blkid> /dev/rbd/rbd.ssd/simplevm.root-part1: UUID="b65d0590-6d3d-4112-a9d6-c7d718a47707" BLOCK_SIZE="512" TYPE="xfs" PARTLABEL="ROOT" PARTUUID="5bf1aed1-70b4-45b6-a0af-5333ff9a0437"
 blkid machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
@@ -121,10 +118,7 @@ lock machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.swap
 ensure-size machine=simplevm subsystem=ceph volume_spec=swap
 start machine=simplevm subsystem=ceph volume_spec=swap
 start-swap machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.swap
-mkswap args=-f -L "swap" /dev/rbd/rbd.ssd/simplevm.swap machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.swap
-mkswap> Setting up swapspace version 1, size = 1024 MiB (1073737728 bytes)
-mkswap> LABEL=swap, UUID=2ed4bc8c-77af-4eed-b044-fb8678b34210
-mkswap machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.swap
+write-image machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.swap
 pre-start machine=simplevm subsystem=ceph volume_spec=tmp
 ensure-presence machine=simplevm subsystem=ceph volume_spec=tmp
 lock machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.tmp
@@ -141,7 +135,6 @@ sgdisk> The operation has completed successfully.
 sgdisk machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.tmp
 partprobe args=/dev/rbd/rbd.ssd/simplevm.tmp machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.tmp
 partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.tmp
-waiting interval=0 machine=simplevm remaining=4 subsystem=ceph volume=rbd.ssd/simplevm.tmp
 mkfs.xfs args=-q -f -K -m crc=1,finobt=1 -d su=4m,sw=1 -L "tmp" /dev/rbd/rbd.ssd/simplevm.tmp-part1 machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.tmp
 mkfs.xfs> mkfs.xfs: Specified data stripe unit 8192 is not the same as the volume stripe unit 128
 mkfs.xfs> log stripe unit (4194304 bytes) is too large (maximum is 256KiB)
@@ -162,29 +155,9 @@ lock machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
 ensure-size machine=simplevm subsystem=ceph volume_spec=cidata
 start machine=simplevm subsystem=ceph volume_spec=cidata
 start-cloud-init machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-create-fs machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-sgdisk args=-o "/dev/rbd/rbd.ssd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-sgdisk> Creating new GPT entries in memory.
-sgdisk> The operation has completed successfully.
-sgdisk machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
-sgdisk args=-n 1:: -c "1:cidata" -t 1:8300 "/dev/rbd/rbd.ssd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-sgdisk> The operation has completed successfully.
-sgdisk machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
-partprobe args=/dev/rbd/rbd.ssd/simplevm.cidata machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
-waiting interval=0 machine=simplevm remaining=4 subsystem=ceph volume=rbd.ssd/simplevm.cidata
-mkfs.vfat args=-n "cidata" /dev/rbd/rbd.ssd/simplevm.cidata-part1 machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-mkfs.vfat> mkfs.fat: Warning: lowercase labels might not work properly on some systems
-mkfs.vfat> mkfs.fat 4.2 (2021-01-31)
-mkfs.vfat machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
 seed-fc machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-partprobe args=/dev/rbd/rbd.ssd/simplevm.cidata machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
-mount args="/dev/rbd/rbd.ssd/simplevm.cidata-part1" "/mnt/rbd/rbd.ssd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-mount machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
 guest-properties machine=simplevm properties={'binary_generation': 2, 'rbd_pool': 'rbd.ssd'} subsystem=ceph volume=rbd.ssd/simplevm.cidata
-umount args="/mnt/rbd/rbd.ssd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-umount machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
+write-image machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
 generate-config machine=simplevm
 acquire-global-lock machine=simplevm subsystem=qemu target=/run/fc-qemu.lock
 global-lock-acquire machine=simplevm result=locked subsystem=qemu target=/run/fc-qemu.lock
@@ -266,10 +239,7 @@ lock machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.swap
 ensure-size machine=simplevm subsystem=ceph volume_spec=swap
 start machine=simplevm subsystem=ceph volume_spec=swap
 start-swap machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.swap
-mkswap args=-f -L "swap" /dev/rbd/rbd.ssd/simplevm.swap machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.swap
-mkswap> Setting up swapspace version 1, size = 1024 MiB (1073737728 bytes)
-mkswap> LABEL=swap, UUID=...-...-...-...-...
-mkswap machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.swap
+write-image machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.swap
 
 pre-start machine=simplevm subsystem=ceph volume_spec=tmp
 ensure-presence machine=simplevm subsystem=ceph volume_spec=tmp
@@ -303,27 +273,9 @@ lock machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
 ensure-size machine=simplevm subsystem=ceph volume_spec=cidata
 start machine=simplevm subsystem=ceph volume_spec=cidata
 start-cloud-init machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-create-fs machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-sgdisk args=-o "/dev/rbd/rbd.ssd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-sgdisk> The operation has completed successfully.
-sgdisk machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
-sgdisk args=-n 1:: -c "1:cidata" -t 1:8300 "/dev/rbd/rbd.ssd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-sgdisk> The operation has completed successfully.
-sgdisk machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
-partprobe args=/dev/rbd/rbd.ssd/simplevm.cidata machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
-mkfs.vfat args=-n "cidata" /dev/rbd/rbd.ssd/simplevm.cidata-part1 machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-mkfs.vfat> mkfs.fat: Warning: lowercase labels might not work properly on some systems
-mkfs.vfat> mkfs.fat ...
-mkfs.vfat machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
 seed-fc machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-partprobe args=/dev/rbd/rbd.ssd/simplevm.cidata machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
-mount args="/dev/rbd/rbd.ssd/simplevm.cidata-part1" "/mnt/rbd/rbd.ssd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-mount machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
 guest-properties machine=simplevm properties={'binary_generation': 2, 'rbd_pool': 'rbd.ssd'} subsystem=ceph volume=rbd.ssd/simplevm.cidata
-umount args="/mnt/rbd/rbd.ssd/simplevm.cidata" machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
-umount machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.cidata
+write-image machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.cidata
 generate-config machine=simplevm
 acquire-global-lock machine=simplevm subsystem=qemu target=/run/fc-qemu.lock
 global-lock-acquire machine=simplevm result=locked subsystem=qemu target=/run/fc-qemu.lock
@@ -363,7 +315,6 @@ release-lock machine=simplevm result=unlocked target=/run/qemu.simplevm.lock
         """
 sgdisk> Creating new GPT entries in memory.
 rbd> /dev/rbd0
-waiting interval=0 machine=simplevm remaining=... subsystem=ceph volume=rbd.ssd/...
 sgdisk> Setting name!
 sgdisk> partNum is 0
 sgdisk> Warning: The kernel is still using the old partition table.
@@ -376,8 +327,6 @@ mkfs.xfs> log stripe unit (... bytes) is too large (maximum is ...)
 mkfs.xfs> log stripe unit adjusted to ...
 mkfs.xfs> mkfs.xfs: small data volume, ignoring data volume stripe unit ... and stripe width ...
 found-partition ...
-udevadm args=settle machine=simplevm subsystem=ceph volume=rbd.ssd/...
-udevadm machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/...
 blkid args=/dev/rbd/rbd.ssd/simplevm...-part1 machine=simplevm subsystem=ceph volume=rbd.ssd/...
 blkid> /dev/rbd/rbd.ssd/simplevm...-part1: ...
 blkid machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm...
@@ -405,7 +354,6 @@ partprobe args=/dev/rbd/rbd.ssd/simplevm.root machine=simplevm subsystem=ceph vo
 partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
 """
     )
-    # need to split the continuous blocks as there can be the optional "waiting" line in between
     bootstrap.continuous(
         """
 blkid args=/dev/rbd/rbd.ssd/simplevm.root-part1 -o export machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.root
@@ -419,8 +367,6 @@ blkid machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
 partprobe args=/dev/rbd/rbd.ssd/simplevm.root machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.root
 partprobe machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
 found-partition machine=simplevm path=/dev/rbd/rbd.ssd/simplevm.root-part1 subsystem=ceph target=/dev/rbd0p1 volume=rbd.ssd/simplevm.root
-udevadm args=settle machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.root
-udevadm machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
 blkid args=/dev/rbd/rbd.ssd/simplevm.root-part1 machine=simplevm subsystem=ceph volume=rbd.ssd/simplevm.root
 blkid> /dev/rbd/rbd.ssd/simplevm.root-part1: ...
 blkid machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
@@ -439,7 +385,6 @@ xfs_db machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.root
     # Things that happen depending on timing:
     bootstrap.optional(
         """
-waiting interval=0 machine=simplevm remaining=... subsystem=ceph volume=rbd.ssd/...
 qmp_capabilities arguments={} id=None machine=simplevm subsystem=qemu/qmp
 """
     )
@@ -513,11 +458,6 @@ xfs_admin machine=simplevm returncode=0 subsystem=ceph volume=rbd.ssd/simplevm.r
 
     second_start = patterns.second_start
     second_start.merge("start", "no_bootstrap")
-    second_start.in_order(
-        """
-mkswap> mkswap: /dev/rbd/rbd.ssd/simplevm.swap: warning: wiping old swap signature.
-"""
-    )
 
     assert second_start == out
 
@@ -1314,7 +1254,7 @@ simplevm         ceph unlock                         volume='rbd.ssd/simplevm.ci
 simplevm              prepare-remote-environment
 simplevm              start-migration                target='tcp:...:...'
 simplevm         qemu migrate
-simplevm     qemu/qmp migrate-set-capabilities       arguments={'capabilities': [{'capability': 'xbzrle', 'state': False}, {'capability': 'auto-converge', 'state': True}]} id=None
+simplevm     qemu/qmp migrate-set-capabilities       arguments={'capabilities': [{'capability': 'xbzrle', 'state': False}, {'capability': 'auto-converge', 'state': True}, {'capability': 'events', 'state': True}]} id=None
 simplevm     qemu/qmp migrate-set-parameters         arguments={'compress-level': 0, 'downtime-limit': 4000, 'max-bandwidth': 22500} id=None
 simplevm     qemu/qmp migrate                        arguments={'uri': 'tcp:...:...'} id=None
 
@@ -1420,7 +1360,7 @@ simplevm         ceph unlock                         volume='rbd.ssd/simplevm.ci
 simplevm              prepare-remote-environment
 simplevm              start-migration                target='tcp:...:2345'
 simplevm         qemu migrate
-simplevm     qemu/qmp migrate-set-capabilities       arguments={'capabilities': [{'capability': 'xbzrle', 'state': False}, {'capability': 'auto-converge', 'state': True}]} id=None
+simplevm     qemu/qmp migrate-set-capabilities       arguments={'capabilities': [{'capability': 'xbzrle', 'state': False}, {'capability': 'auto-converge', 'state': True}, {'capability': 'events', 'state': True}]} id=None
 simplevm     qemu/qmp migrate-set-parameters         arguments={'compress-level': 0, 'downtime-limit': 4000, 'max-bandwidth': 22500} id=None
 simplevm     qemu/qmp migrate                        arguments={'uri': 'tcp:...:2345'} id=None
 simplevm     qemu/qmp query-migrate-parameters       arguments={} id=None
@@ -1699,7 +1639,7 @@ simplevm         ceph unlock                         volume='rbd.ssd/simplevm.ci
 simplevm              prepare-remote-environment
 simplevm              start-migration                target='tcp:...:2345'
 simplevm         qemu migrate
-simplevm     qemu/qmp migrate-set-capabilities       arguments={'capabilities': [{'capability': 'xbzrle', 'state': False}, {'capability': 'auto-converge', 'state': True}]} id=None
+simplevm     qemu/qmp migrate-set-capabilities       arguments={'capabilities': [{'capability': 'xbzrle', 'state': False}, {'capability': 'auto-converge', 'state': True}, {'capability': 'events', 'state': True}]} id=None
 simplevm     qemu/qmp migrate-set-parameters         arguments={'compress-level': 0, 'downtime-limit': 4000, 'max-bandwidth': 22500} id=None
 simplevm     qemu/qmp migrate                        arguments={'uri': 'tcp:...:2345'} id=None
 simplevm     qemu/qmp query-migrate-parameters       arguments={} id=None
@@ -2230,6 +2170,7 @@ def test_clean_up_exited_vm_that_lives_remotely(
     while len(vm.qemu.existing_run_files()) != 0:
         time.sleep(1)
 
+    vm.ceph.refresh_locks()
     assert vm.ceph.locked_by_me() is False
 
 
@@ -2255,6 +2196,7 @@ def test_clean_up_exited_local_vm_if_intended_offline(
 
     # This will have restarted the VM
     assert vm.qemu.is_running() is True
+    vm.ceph.refresh_locks()
     assert vm.ceph.locked_by_me() is True
 
     vm.enc["parameters"]["online"] = False
@@ -2269,4 +2211,5 @@ def test_clean_up_exited_local_vm_if_intended_offline(
 
     # This will clean up the VM now
     assert vm.qemu.is_running() is False
+    vm.ceph.refresh_locks()
     assert vm.ceph.locked_by_me() is False